@@ -79,6 +79,12 @@ class FmaskConfig(object):
     verbose = False
     strictFmask = False
     tempDir = '.'
+    # Hold the intermediate rasters in memory (GDAL's /vsimem/) instead of tempDir
+    intermediatesInMemory = False
+    # Directory to keep the results of the stages of fmask, to re-use them
+    stageCacheDir = None
+    # A fmask.profiling.StageProfiler to record the profile of each stage
+    profiler = None
     TOARefScaling = 10000.0
     TOARefDNoffsetDict = None
     # Minimum number of pixels in a single cloud (before buffering). A non-zero value
@@ -109,6 +115,35 @@ class FmaskConfig(object):
     sen2displacementTest = False
     sen2cdiWindow = 7
 
+    # Stop the shadow matching search at the first good match, instead of 
+    # searching the whole transect for the best one
+    shadowMatchEarlyStop = False
+    
+    # Number of worker processes or threads to use in the parts of fmask which 
+    # can be run in parallel. A value of 1 means everything is done serially. 
+    numWorkers = 1
+    
+    # The type of RIOS job manager used to run the block-by-block passes
+    # in parallel, when numWorkers is greater than 1. With threads, the 
+    # blocks are shared in memory instead of pickled to other processes
+    jobManagerType = 'threads'
+    
+    # Read and write the blocks of the RIOS passes in separate threads, 
+    # overlapped with the processing of the current block
+    pipelineIO = False
+    
+    # Use numexpr to evaluate the tests in the first pass of the cloud layer
+    useNumexpr = False
+    
+    # Size (in pixels) of the tiles used to fill the minima of the NIR band
+    # when making the potential shadows. None means the whole band is 
+    # done at once, in memory
+    fillMinimaTileSize = None
+    
+    # Number of rows in each strip of the cloud mask when clumping the clouds.
+    # None means the whole cloud mask is clumped at once
+    clumpBlockRows = None
+
     def __init__(self, sensor):
         """
         Pass in the sensor (one of: FMASK_LANDSAT47, FMASK_LANDSAT8 or
@@ -282,6 +317,49 @@ class FmaskConfig(object):
         """
         self.tempDir = tempDir
         
+    def setIntermediatesInMemory(self, intermediatesInMemory):
+        """
+        Set to True to hold the intermediate rasters (the two passes of the 
+        cloud layer, the interim cloud and shadow masks and the potential 
+        shadows) in memory, as uncompressed GeoTIFFs in GDAL's /vsimem/ 
+        filesystem, instead of as temporary files in the temp directory. 
+        This saves writing them to disk and reading them back, but needs 
+        enough memory for all of them at once, i.e. several bytes per pixel 
+        of the scene. Defaults to False. 
+        
+        If setKeepIntermediates has been called with True, the /vsimem/ 
+        filenames are returned by fmask.fmask.doFmask, and these can only 
+        be opened from within the same process. 
+        
+        """
+        self.intermediatesInMemory = intermediatesInMemory
+        
+    def setStageCacheDir(self, stageCacheDir):
+        """
+        Set a directory in which to keep the results of the stages of 
+        fmask (the passes of the cloud layer, the potential shadows and the 
+        shadow matching), so that a later run on the same input files only 
+        re-runs the stages which depend on parameters that have changed. 
+        This is intended for trying several sets of thresholds on a scene. 
+        
+        The intermediate rasters are then not deleted at the end, they are 
+        left in the temp directory (or in memory, see setIntermediatesInMemory, 
+        in which case they can only be re-used in the same process). It is 
+        up to the caller to remove them. Defaults to None, for no cache.
+        
+        """
+        self.stageCacheDir = stageCacheDir
+        
+    def setProfiler(self, profiler):
+        """
+        Set an instance of :class:`fmask.profiling.StageProfiler`, to record
+        the wall and CPU time, bytes read and written and peak memory of 
+        each stage of fmask, in its records attribute. Defaults to None, 
+        for no profiling. 
+        
+        """
+        self.profiler = profiler
+        
     def setDefaultExtension(self, extension):
         """
         Sets the default extension used by temporary files created by
@@ -393,6 +471,87 @@ class FmaskConfig(object):
         """
         self.sen2displacementTest = useDisplacementTest
     
+    def setShadowMatchEarlyStop(self, earlyStop):
+        """
+        Set to True to stop the search for each cloud's shadow at the first good
+        match (similarity above 0.95, or the first peak in similarity above the 
+        0.3 acceptance threshold), rather than searching the whole transect
+        for the best match. This is faster, but can give different shadows.
+        Defaults to False. 
+        
+        """
+        self.shadowMatchEarlyStop = earlyStop
+    
+    def setNumWorkers(self, numWorkers):
+        """
+        Set the number of workers used in the parts of fmask which can be run
+        in parallel. These are currently the RIOS passes over the image
+        (see setJobManagerType), the matching of cloud shadows (in 
+        separate processes), and the tiled filling of minima for the potential
+        shadows (in threads, see setFillMinimaTileSize). The workers of the 
+        RIOS passes are started once, and kept for the rest of the process.
+        Defaults to 1, i.e. everything is done serially in the current process. 
+        
+        """
+        self.numWorkers = numWorkers
+    
+    def setJobManagerType(self, jobManagerType):
+        """
+        Set the type of RIOS job manager (see rios.parallel.jobmanager) used
+        to process blocks in parallel in the RIOS passes, when the number 
+        of workers is greater than 1. Defaults to 'threads', which shares the 
+        blocks with the workers in memory, as most of the work in the passes
+        is done by numpy, which releases the GIL. 
+        
+        """
+        self.jobManagerType = jobManagerType
+    
+    def setPipelineIO(self, pipelineIO):
+        """
+        Set to True to read ahead and write behind the blocks of the RIOS 
+        passes over the image in separate threads, while the current block 
+        is processed (see rios.applier.ApplierControls.setPipelineIO). 
+        This hides most of the time spent reading and writing, e.g. on 
+        network storage. The results are the same. Defaults to False. 
+        
+        """
+        self.pipelineIO = pipelineIO
+    
+    def setUseNumexpr(self, useNumexpr):
+        """
+        Set to True to evaluate the tests in the first pass of the potential 
+        cloud layer with the numexpr package, which must then be installed. 
+        This avoids most temporary arrays, and uses numexpr's own threads. The 
+        results are the same. Defaults to False. 
+        
+        """
+        self.useNumexpr = useNumexpr
+    
+    def setFillMinimaTileSize(self, tileSize):
+        """
+        Set the size (in pixels) of the square tiles used when filling the
+        minima of the NIR band for the potential shadows. If set, the NIR band
+        and the filled result are kept in scratch files in the temp directory,
+        and only one tile at a time is held in memory, giving the same output
+        with a bounded amount of memory. Defaults to None, which fills the 
+        whole band at once, in memory. 
+        
+        """
+        self.fillMinimaTileSize = tileSize
+    
+    def setClumpBlockRows(self, blockRows):
+        """
+        Set the number of rows in each strip of the cloud mask, when clumping
+        the clouds into separate cloud objects. If set, the cloud mask is 
+        read and clumped a strip at a time, and the whole image of clumps is 
+        never held in memory. The mask is read twice, and apart from the
+        indexes of the clumps, the memory used depends on the size of a
+        strip, so smaller strips use less. The clumps are exactly the same.
+        Defaults to None, which clumps the whole cloud mask at once.
+        
+        """
+        self.clumpBlockRows = blockRows
+    
     def setGdalDriverName(self, driverName):
         """
         Change the GDAL driver used for writing the final output file. Default
@@ -659,6 +818,25 @@ class AnglesInfo(object):
         """
         Set scaling factor to get radians from angles image values. 
         """
+    
+    def getClumpAngles(self, clumpNdx):
+        """
+        Return the average angles for each of the clumps (e.g. clouds) 
+        in the given :class:`fmask.valueindexes.ValueIndexes` object, as
+        a tuple of arrays (solarZenith, solarAzimuth, viewZenith, viewAzimuth), 
+        each with one element per value in clumpNdx.values. 
+        
+        This default implementation just calls the get*Angle methods for 
+        each clump in turn. Derived classes may do it for all clumps at once. 
+        """
+        angleFuncs = [self.getSolarZenithAngle, self.getSolarAzimuthAngle, 
+            self.getViewZenithAngle, self.getViewAzimuthAngle]
+        anglesList = [[] for func in angleFuncs]
+        for (start, end) in zip(clumpNdx.start, clumpNdx.end):
+            indices = (clumpNdx.indexes[start:end, 0], clumpNdx.indexes[start:end, 1])
+            for (func, angles) in zip(angleFuncs, anglesList):
+                angles.append(func(indices))
+        return tuple([numpy.array(angles) for angles in anglesList])
 
 
 class AnglesFileInfo(AnglesInfo):
@@ -751,6 +929,34 @@ class AnglesFileInfo(AnglesInfo):
         """
         self.scaleToRadians = scale
 
+    def getClumpAngles(self, clumpNdx):
+        """
+        Return the average angles for each of the clumps in the given 
+        :class:`fmask.valueindexes.ValueIndexes` object, as a tuple of
+        arrays (solarZenith, solarAzimuth, viewZenith, viewAzimuth). 
+        
+        For integer angles images (as made by fmask_usgsLandsatMakeAnglesImage),
+        all clumps are done at once, summing the angles of the pixels of
+        each clump with numpy.bincount. This is exact, so the results are 
+        identical to calling the get*Angle methods for each clump. Other
+        images are averaged per clump, as the float32 mean of the get*Angle
+        methods can not be reproduced with a float64 sum. 
+        """
+        dataList = [self.solarZenithData, self.solarAzimuthData, 
+            self.viewZenithData, self.viewAzimuthData]
+        if not all([numpy.issubdtype(data.dtype, numpy.integer) for data in dataList]):
+            return AnglesInfo.getClumpAngles(self, clumpNdx)
+        
+        numClumps = len(clumpNdx.values)
+        clumpNum = numpy.repeat(numpy.arange(numClumps), clumpNdx.counts)
+        indices = (clumpNdx.indexes[:, 0], clumpNdx.indexes[:, 1])
+        anglesList = []
+        for data in dataList:
+            angleSum = numpy.bincount(clumpNum, weights=data[indices].astype(numpy.float64), 
+                minlength=numClumps)
+            anglesList.append(angleSum / clumpNdx.counts * self.scaleToRadians)
+        return tuple(anglesList)
+
 
 class AngleConstantInfo(AnglesInfo):
     """
@@ -788,6 +994,17 @@ class AngleConstantInfo(AnglesInfo):
         """
         return self.viewAzimuthAngle
 
+    def getClumpAngles(self, clumpNdx):
+        """
+        Return the angles for each of the clumps in the given 
+        :class:`fmask.valueindexes.ValueIndexes` object, as a tuple of
+        arrays (solarZenith, solarAzimuth, viewZenith, viewAzimuth). 
+        """
+        numClumps = len(clumpNdx.values)
+        return tuple([numpy.full(numClumps, angle) 
+            for angle in [self.solarZenithAngle, self.solarAzimuthAngle,
+                self.viewZenithAngle, self.viewAzimuthAngle]])
+
 
 def readMTLFile(mtl):
     """
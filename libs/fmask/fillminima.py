@@ -29,6 +29,8 @@ represent potential shadow objects.
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import os
+from concurrent import futures
+
 import numpy
 from scipy.ndimage import grey_dilation
 
@@ -76,3 +78,176 @@ def fillMinima(img, nullval, boundaryval):
     img2[nullmask] = nullval
     
     return img2
+
+
+# Default size (in pixels) of the square tiles used by fillMinimaTiled
+DEFAULT_TILESIZE = 2048
+
+
+def fillMinimaTiled(img, nullval, boundaryval, tileSize=DEFAULT_TILESIZE, out=None,
+        numThreads=1):
+    """
+    Same as fillMinima, but works on one square tile of tileSize pixels 
+    at a time, so that the working memory is bounded by the tile size rather
+    than the size of the whole image. The img array is only ever accessed
+    one tile at a time, so it may be a numpy.memmap of a file on disk. 
+    The out array, if given, is an int16 array of the same shape (which may
+    also be a numpy.memmap), and receives the result. If not given, a new
+    array is allocated. Returns the out array. 
+    
+    The result is identical to fillMinima. Each tile is filled with the usual
+    priority flood, with the current filled values of the pixels surrounding 
+    the tile acting as extra sources. Filled values can only decrease, 
+    so any tile whose edge pixels change causes its neighbours to be
+    filled again, and this is repeated until nothing changes. 
+    
+    If numThreads is greater than 1, tiles are filled in that many threads 
+    at once (the C code does not hold the GIL while filling). The tiles are 
+    taken in four phases, alternating rows and columns of tiles, so that 
+    tiles being filled at the same time are never next to each other. 
+    Builds of the _fillminima extension from before this was possible still 
+    hold the GIL, so with those the tiles are filled one at a time. See 
+    libs/fmask/libs/build_extensions.sh to rebuild it. 
+    
+    """
+    if not getattr(_fillminima, 'RELEASES_GIL', False):
+        numThreads = 1
+
+    (nrows, ncols) = img.shape
+    if out is None:
+        out = numpy.zeros((nrows, ncols), dtype=img.dtype)
+    tileList = [(r0, min(r0 + tileSize, nrows), c0, min(c0 + tileSize, ncols))
+        for r0 in range(0, nrows, tileSize) for c0 in range(0, ncols, tileSize)]
+
+    # Global statistics, gathered one tile at a time
+    hMaxList = []
+    hMinList = []
+    anyNull = False
+    for (r0, r1, c0, c1) in tileList:
+        tile = img[r0:r1, c0:c1]
+        nonNullmask = (tile != nullval)
+        if nonNullmask.any():
+            hMaxList.append(int(tile[nonNullmask].max()))
+            hMinList.append(int(tile[nonNullmask].min()))
+        anyNull = anyNull or (not nonNullmask.all())
+    (hMax, hMin) = (max(hMaxList), min(hMinList))
+    boundaryval = max(boundaryval, hMin)
+
+    for (r0, r1, c0, c1) in tileList:
+        out[r0:r1, c0:c1] = hMax
+
+    numTilesRows = (nrows + tileSize - 1) // tileSize
+    numTilesCols = (ncols + tileSize - 1) // tileSize
+    dirty = numpy.ones((numTilesRows, numTilesCols), dtype=bool)
+    if numThreads > 1:
+        phaseList = [[tile for tile in tileList 
+            if ((tile[0] // tileSize) % 2, (tile[2] // tileSize) % 2) == phase]
+            for phase in [(0, 0), (0, 1), (1, 0), (1, 1)]]
+        phaseList = [tiles for tiles in phaseList if len(tiles) > 0]
+    else:
+        # Each tile is its own phase
+        phaseList = [[tile] for tile in tileList]
+    
+    with futures.ThreadPoolExecutor(max_workers=numThreads) as pool:
+        forward = True
+        while dirty.any():
+            # Alternate the direction of each sweep, so that changes can 
+            # propagate across the image in either direction quickly
+            phaseOrder = phaseList if forward else phaseList[::-1]
+            for phaseTiles in phaseOrder:
+                dirtyTiles = [(r0, r1, c0, c1) for (r0, r1, c0, c1) in phaseTiles
+                    if dirty[r0 // tileSize, c0 // tileSize]]
+                for (r0, r1, c0, c1) in dirtyTiles:
+                    dirty[r0 // tileSize, c0 // tileSize] = False
+                if len(dirtyTiles) == 1:
+                    edgeChangedList = [fillOneTile(img, out, nullval, boundaryval, 
+                        hMin, hMax, anyNull, *dirtyTiles[0])]
+                else:
+                    edgeChangedList = list(pool.map(lambda tile: fillOneTile(img, out, 
+                        nullval, boundaryval, hMin, hMax, anyNull, *tile), dirtyTiles))
+
+                for ((r0, r1, c0, c1), edgeChanged) in zip(dirtyTiles, edgeChangedList):
+                    if edgeChanged:
+                        (tileRow, tileCol) = (r0 // tileSize, c0 // tileSize)
+                        dirty[max(tileRow - 1, 0):tileRow + 2, 
+                            max(tileCol - 1, 0):tileCol + 2] = True
+            forward = not forward
+
+    return out
+
+
+def fillOneTile(img, out, nullval, boundaryval, hMin, hMax, anyNull, r0, r1, c0, c1):
+    """
+    Fill the minima in a single tile of fillMinimaTiled, covering img[r0:r1, c0:c1], 
+    updating the out array. Returns True if any pixels on the edge of the
+    tile changed value. 
+    
+    The tile is padded by two rings of pixels. The inner ring holds the current 
+    filled values of the surrounding pixels, as though they were image values, 
+    and the outer ring is all boundary pixels. The flood from the outer ring 
+    thus enters the tile through the inner ring at exactly the current 
+    filled value of each surrounding pixel. 
+    
+    """
+    (nrows, ncols) = img.shape
+    (tileRows, tileCols) = (r1 - r0, c1 - c0)
+    # Pixels adjacent to the tile, clipped to the image
+    (hr0, hr1, hc0, hc1) = (max(r0 - 1, 0), min(r1 + 1, nrows), max(c0 - 1, 0), 
+        min(c1 + 1, ncols))
+    haloSlice = (slice(hr0 - r0 + 2, hr1 - r0 + 2), slice(hc0 - c0 + 2, hc1 - c0 + 2))
+    tileSlice = (slice(2, tileRows + 2), slice(2, tileCols + 2))
+
+    imgTile = img[r0:r1, c0:c1]
+    oldTile = numpy.array(out[r0:r1, c0:c1])
+
+    # Pixels outside the image, and the outer ring, are treated as null, so 
+    # the flood can only pass through the outer ring into the inner ring
+    tileNullmask = numpy.ones((tileRows + 4, tileCols + 4), dtype=bool)
+    tileNullmask[haloSlice] = (img[hr0:hr1, hc0:hc1] == nullval)
+    nullmask = tileNullmask[tileSlice]
+
+    tileImg = numpy.zeros((tileRows + 4, tileCols + 4), dtype=img.dtype)
+    tileImg[haloSlice] = out[hr0:hr1, hc0:hc1]
+    tileImg[tileSlice] = imgTile
+    tileImg2 = numpy.zeros((tileRows + 4, tileCols + 4), dtype=img.dtype)
+    tileImg2.fill(hMax)
+
+    # The boundary pixels of the whole image which fall in this tile, 
+    # found in the same way as fillMinima does
+    if anyNull:
+        # Pixels outside the image do not count as null for this
+        nullmaskImg = numpy.zeros((tileRows + 2, tileCols + 2), dtype=bool)
+        nullmaskImg[hr0 - r0 + 1:hr1 - r0 + 1, hc0 - c0 + 1:hc1 - c0 + 1] = (
+            img[hr0:hr1, hc0:hc1] == nullval)
+        nullmaskDilated = grey_dilation(nullmaskImg, size=(3, 3))[1:-1, 1:-1]
+        innerBoundary = nullmaskDilated & ~nullmask
+    else:
+        innerBoundary = numpy.zeros((tileRows, tileCols), dtype=bool)
+        if r0 == 0:
+            innerBoundary[0, :] = True
+        if r1 == nrows:
+            innerBoundary[-1, :] = True
+        if c0 == 0:
+            innerBoundary[:, 0] = True
+        if c1 == ncols:
+            innerBoundary[:, -1] = True
+        innerBoundary &= (imgTile != hMax)
+    (boundaryRows, boundaryCols) = numpy.where(innerBoundary)
+    
+    outerRing = numpy.ones((tileRows + 4, tileCols + 4), dtype=bool)
+    outerRing[1:-1, 1:-1] = False
+    (ringRows, ringCols) = numpy.where(outerRing)
+    boundaryRows = numpy.concatenate([boundaryRows + 2, ringRows]).astype(numpy.int64)
+    boundaryCols = numpy.concatenate([boundaryCols + 2, ringCols]).astype(numpy.int64)
+
+    _fillminima.fillMinima(tileImg, tileImg2, hMin, hMax, tileNullmask, boundaryval,
+                        boundaryRows, boundaryCols)
+
+    newTile = tileImg2[tileSlice]
+    newTile[nullmask] = nullval
+    out[r0:r1, c0:c1] = newTile
+
+    changed = (newTile != oldTile)
+    edgeChanged = (changed[0].any() or changed[-1].any() or changed[:, 0].any() or 
+        changed[:, -1].any())
+    return edgeChanged
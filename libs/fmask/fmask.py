@@ -46,12 +46,21 @@ as fmask.fmask.OUTCODE_*
 from __future__ import print_function, division
 
 import os
+import json
+import pickle
+import shutil
+import hashlib
 import tempfile
+import threading
+import uuid
+from concurrent import futures
 
 import numpy
 from osgeo import gdal
+import scipy.ndimage
 from scipy.ndimage import uniform_filter, maximum_filter, label
-import scipy.stats
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 # We use RIOS intensively here
 from rios import applier
@@ -59,17 +68,25 @@ from rios import pixelgrid
 from rios import rat
 from rios import imageio
 from rios import fileinfo
+from rios.parallel import blocktransport
 
 # our wrappers for bits of C that are installed with this package
 from . import fillminima
 from . import valueindexes
 # configuration classes
 from . import config
+from . import profiling
 # exceptions
 from . import fmaskerrors
 # so we can check if thermal all zeroes
 from . import zerocheck
 
+# numexpr is optional, see FmaskConfig.setUseNumexpr
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
 numpy.seterr(all='raise')
 gdal.UseExceptions()
 
@@ -153,61 +170,71 @@ def doFmask(fmaskFilenames, fmaskConfig):
         fmaskConfig.setCloudBufferSize(0)
         fmaskConfig.setShadowBufferSize(3)
     
+    # Results of earlier runs, if fmaskConfig.setStageCacheDir has been called
+    stageCache = None
+    if fmaskConfig.stageCacheDir is not None:
+        stageCache = StageCache(fmaskConfig.stageCacheDir, fmaskConfig.verbose)
+    inputFiles = [fmaskFilenames.toaRef, fmaskFilenames.saturationMask]
+    if not missingThermal:
+        inputFiles.append(fmaskFilenames.thermal)
+    inputSignature = [fileSignature(filename) for filename in inputFiles 
+        if filename is not None]
+    
     if fmaskConfig.verbose:
         print("Cloud layer, pass 1")
-    (pass1file, Twater, Tlow, Thigh, NIR_17, nonNullCount) = doPotentialCloudFirstPass(
-        fmaskFilenames, fmaskConfig, missingThermal)
+    pass1Key = makeStageKey(fmaskConfig, 'pass1', inputSignature, missingThermal)
+    with profiling.stage(fmaskConfig.profiler, 'pass1'):
+        (pass1file, Twater, Tlow, Thigh, NIR_17, nonNullCount) = runStage(stageCache, 
+            'pass1', pass1Key, doPotentialCloudFirstPass, fmaskFilenames, fmaskConfig, 
+            missingThermal)
     if fmaskConfig.verbose:
         print("  Twater=", Twater, "Tlow=", Tlow, "Thigh=", Thigh, "NIR_17=", 
             NIR_17, "nonNullCount=", nonNullCount)
     
     if fmaskConfig.verbose:
         print("Cloud layer, pass 2")
-    (pass2file, landThreshold) = doPotentialCloudSecondPass(fmaskFilenames, 
-        fmaskConfig, pass1file, Twater, Tlow, Thigh, missingThermal, nonNullCount)
+    pass2Key = makeStageKey(fmaskConfig, 'pass2', pass1Key)
+    with profiling.stage(fmaskConfig.profiler, 'pass2'):
+        (pass2file, landThreshold) = runStage(stageCache, 'pass2', pass2Key, 
+            doPotentialCloudSecondPass, fmaskFilenames, fmaskConfig, pass1file, Twater, 
+            Tlow, Thigh, missingThermal, nonNullCount)
     if fmaskConfig.verbose:
         print("  landThreshold=", landThreshold)
 
     if fmaskConfig.verbose:
         print("Cloud layer, pass 3")
-    interimCloudmask = doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, 
-        pass1file, pass2file, landThreshold, Tlow, missingThermal)
+    cloudKey = makeStageKey(fmaskConfig, 'cloud', pass2Key)
+    with profiling.stage(fmaskConfig.profiler, 'pass3'):
+        interimCloudmask = runStage(stageCache, 'cloud', cloudKey, doCloudLayerFinalPass, 
+            fmaskFilenames, fmaskConfig, pass1file, pass2file, landThreshold, Tlow, 
+            missingThermal)
         
     if fmaskConfig.verbose:
         print("Potential shadows")
-    potentialShadowsFile = doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17)
-    
-    if fmaskConfig.verbose:
-        print("Clumping clouds")
-    (clumps, numClumps) = clumpClouds(interimCloudmask)
-    
-    if fmaskConfig.verbose:
-        print("Making 3d clouds")
-    (cloudShape, cloudBaseTemp, cloudClumpNdx) = make3Dclouds(fmaskFilenames, 
-        fmaskConfig, clumps, numClumps, missingThermal)
+    potentialShadowsKey = makeStageKey(fmaskConfig, 'potentialShadows', pass1Key)
+    with profiling.stage(fmaskConfig.profiler, 'potentialShadows'):
+        potentialShadowsFile = runStage(stageCache, 'potentialShadows', 
+            potentialShadowsKey, doPotentialShadows, fmaskFilenames, fmaskConfig, NIR_17)
     
-    if fmaskConfig.verbose:
-        print("Making cloud shadow shapes")
-    shadowShapesDict = makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
-        cloudShape, cloudClumpNdx)
-    
-    if fmaskConfig.verbose:
-        print("Matching shadows")
-    interimShadowmask = matchShadows(fmaskConfig, interimCloudmask, 
-        potentialShadowsFile, shadowShapesDict, cloudBaseTemp, Tlow, Thigh, 
-        pass1file)
+    # The stages within this are profiled separately
+    shadowsKey = makeStageKey(fmaskConfig, 'shadows', cloudKey, potentialShadowsKey)
+    interimShadowmask = runStage(stageCache, 'shadows', shadowsKey, doCloudShadows, 
+        fmaskFilenames, fmaskConfig, interimCloudmask, potentialShadowsFile, Tlow, 
+        Thigh, pass1file, missingThermal)
     
     if fmaskConfig.verbose:
         print("Doing final tidy up")
-    finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask, 
-        pass1file)
+    with profiling.stage(fmaskConfig.profiler, 'finalize'):
+        finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask, 
+            pass1file)
     
-    # Remove temporary files
+    # Remove temporary files, unless they are cached for later runs
     retVal = None
     if not fmaskConfig.keepIntermediates:
-        for filename in [pass1file, pass2file, interimCloudmask, potentialShadowsFile,
-                interimShadowmask]:
-            deleteRaster(filename)
+        if stageCache is None:
+            for filename in [pass1file, pass2file, interimCloudmask, potentialShadowsFile,
+                    interimShadowmask]:
+                deleteRaster(filename)
     else:
         # create a dictionary with the intermediate filenames so we can return them.
         retVal = {'pass1': pass1file, 'pass2': pass2file, 
@@ -221,6 +248,174 @@ def doFmask(fmaskFilenames, fmaskConfig):
     return retVal
 
 
+def doCloudShadows(fmaskFilenames, fmaskConfig, interimCloudmask, potentialShadowsFile,
+        Tlow, Thigh, pass1file, missingThermal):
+    """
+    Make the interim cloud shadow mask, by projecting the clouds onto the 
+    potential shadows. The clouds are clumped into objects, which are made 
+    into 3d clouds, and their shadows matched. Returns the filename of the 
+    interim shadow mask. 
+    
+    """
+    if fmaskConfig.verbose:
+        print("Clumping clouds")
+    with profiling.stage(fmaskConfig.profiler, 'clumping'):
+        if fmaskConfig.clumpBlockRows is not None:
+            clumps = None
+            (cloudClumpNdx, numClumps) = clumpCloudsStreamed(interimCloudmask, 
+                fmaskConfig.clumpBlockRows)
+        else:
+            (clumps, numClumps) = clumpClouds(interimCloudmask)
+            cloudClumpNdx = None
+    
+    if fmaskConfig.verbose:
+        print("Making 3d clouds")
+    with profiling.stage(fmaskConfig.profiler, '3dClouds'):
+        (cloudShape, cloudBaseTemp, cloudClumpNdx) = make3Dclouds(fmaskFilenames, 
+            fmaskConfig, clumps, numClumps, missingThermal, cloudClumpNdx=cloudClumpNdx)
+        del clumps
+    
+    if fmaskConfig.verbose:
+        print("Making cloud shadow shapes")
+    with profiling.stage(fmaskConfig.profiler, 'shadowShapes'):
+        shadowShapesDict = makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
+            cloudShape, cloudClumpNdx)
+    
+    if fmaskConfig.verbose:
+        print("Matching shadows")
+    with profiling.stage(fmaskConfig.profiler, 'matching'):
+        interimShadowmask = matchShadows(fmaskConfig, interimCloudmask, 
+            potentialShadowsFile, shadowShapesDict, cloudBaseTemp, Tlow, Thigh, 
+            pass1file)
+    return interimShadowmask
+
+
+#: FmaskConfig attributes used by each stage of doFmask, as well as those used by 
+#: the stages it depends on. The keys of the stage cache are made from these. 
+STAGE_CONFIG_ATTRS = {
+    'pass1': ['sensor', 'bands', 'thermalInfo', 'TOARefScaling', 'TOARefDNoffsetDict', 
+        'Eqn1Swir2Thresh', 'Eqn1ThermThresh', 'Eqn2WhitenessThresh', 
+        'cirrusBandTestThresh', 'Eqn7Swir2Thresh', 'Eqn20ThermThresh', 
+        'Eqn20NirSnowThresh', 'Eqn20GreenSnowThresh', 'sen2displacementTest', 
+        'sen2cdiWindow'],
+    'pass2': ['cirrusProbRatio', 'Eqn17CloudProbThresh'],
+    'cloud': ['minCloudSize_pixels'],
+    'potentialShadows': ['Eqn19NIRFillThresh'],
+    'shadows': ['anglesInfo', 'shadowBufferSize', 'shadowMatchEarlyStop']
+}
+
+
+class StageCache(object):
+    """
+    Results of the stages of doFmask, kept in cacheDir from one run to the 
+    next, see :func:`fmask.config.FmaskConfig.setStageCacheDir`. Each result 
+    is stored with the key of the stage (see makeStageKey), and is only 
+    used while the intermediate raster it refers to still exists. 
+    
+    """
+    def __init__(self, cacheDir, verbose=False):
+        self.cacheDir = cacheDir
+        self.verbose = verbose
+        
+    def recordFilename(self, stage, key):
+        """
+        Name of the file which holds the result of the stage with the given key
+        """
+        return os.path.join(self.cacheDir, 'fmaskstage_{}_{}.pkl'.format(stage, key))
+
+    def get(self, stage, key):
+        """
+        Return the cached result of the stage with the given key, or None
+        if there is none. 
+        """
+        result = None
+        recordFile = self.recordFilename(stage, key)
+        if os.path.exists(recordFile):
+            with open(recordFile, 'rb') as f:
+                (result, raster) = pickle.load(f)
+            if not rasterExists(raster):
+                result = None
+        return result
+
+    def put(self, stage, key, result, raster):
+        """
+        Store the result of the stage with the given key. raster is the 
+        intermediate raster the result refers to.
+        """
+        recordFile = self.recordFilename(stage, key)
+        with open(recordFile + '.tmp', 'wb') as f:
+            pickle.dump((result, raster), f)
+        os.replace(recordFile + '.tmp', recordFile)
+
+
+def runStage(stageCache, stage, key, stageFunc, *args):
+    """
+    Run one stage of doFmask, i.e. return stageFunc(*args), unless stageCache 
+    (if not None) already has a result for it with the given key. The result
+    is either the filename of the intermediate raster the stage makes, or a
+    tuple starting with it. 
+    
+    """
+    result = None
+    if stageCache is not None:
+        result = stageCache.get(stage, key)
+    if result is None:
+        result = stageFunc(*args)
+        if stageCache is not None:
+            raster = result[0] if isinstance(result, tuple) else result
+            stageCache.put(stage, key, result, raster)
+    elif stageCache.verbose:
+        print("  Using cached", stage)
+    return result
+
+
+def makeStageKey(fmaskConfig, stage, *parts):
+    """
+    Return the key of the given stage of doFmask, for the stage cache. It 
+    is a hash of the FmaskConfig attributes the stage uses (STAGE_CONFIG_ATTRS)
+    and the given parts, i.e. the keys of the stages it depends on, or a 
+    signature of its input files. 
+    
+    """
+    attrs = [(attr, getattr(fmaskConfig, attr)) for attr in STAGE_CONFIG_ATTRS[stage]]
+    text = json.dumps([stage, attrs, parts], sort_keys=True, default=stageKeyValue)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def stageKeyValue(obj):
+    """
+    Used by makeStageKey to convert the values json cannot, e.g. a 
+    :class:`fmask.config.ThermalFileInfo` or numpy arrays. 
+    """
+    if isinstance(obj, numpy.ndarray):
+        value = [str(obj.dtype), obj.shape, hashlib.sha1(obj.tobytes()).hexdigest()]
+    elif isinstance(obj, numpy.generic):
+        value = obj.item()
+    else:
+        value = [type(obj).__name__, vars(obj)]
+    return value
+
+
+def fileSignature(filename):
+    """
+    Return the filename with its size and modification time, so a stage key 
+    changes if the file does
+    """
+    stat = gdal.VSIStatL(filename)
+    if stat is None:
+        signature = [filename]
+    else:
+        signature = [filename, stat.size, stat.mtime]
+    return signature
+
+
+def rasterExists(filename):
+    """
+    True if the given file exists, including in GDAL's /vsimem/
+    """
+    return gdal.VSIStatL(filename) is not None
+
+
 #: An offset so we can scale brightness temperature (BT, in deg C) to the range 0-255, for use in histograms.
 BT_OFFSET = 176    
 
@@ -230,6 +425,18 @@ BYTE_MAX = 255
 #: Gain to scale b4 reflectances to 0-255 for histograms
 B4_SCALE = 500.0
 
+#: Bands of the pass1 intermediate, the bit flags and the variability probability
+PASS1_FLAGS_BAND = 0
+PASS1_VARIABILITY_BAND = 1
+#: Bits of the flags band of the pass1 intermediate, see getPass1Flag
+PASS1_PCP = 1
+PASS1_WATERTEST = 2
+PASS1_CLEARLAND = 4
+PASS1_NULLMASK = 8
+PASS1_SNOWMASK = 16
+PASS1_REFNULLMASK = 32
+PASS1_THERMNULLMASK = 64
+
 #: Global RIOS window size
 RIOS_WINDOW_SIZE = 512
 
@@ -254,9 +461,8 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
     elif fmaskConfig.verbose:
         print('Saturation mask not supplied - saturated areas may not be detected')
     
-    (fd, outfiles.pass1) = tempfile.mkstemp(prefix='pass1', dir=fmaskConfig.tempDir, 
-                                suffix=fmaskConfig.defaultExtension)
-    os.close(fd)
+    outfiles.pass1 = makeIntermediateFilename(fmaskConfig, 'pass1')
+    setIntermediateOutputDriver(controls, fmaskConfig, 'pass1')
     if (fmaskConfig.sensor == config.FMASK_SENTINEL2) and fmaskConfig.sen2displacementTest:
         # needs overlap because of focalVariance
         overlap = int((fmaskConfig.sen2cdiWindow - 1) / 2)
@@ -308,6 +514,8 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
 
     otherargs.bandsForRefNull = numpy.array([fmaskConfig.bands[i] for i in nullBandNdx])
 
+    setParallelControls(controls, fmaskConfig)
+    controls.setReduceFunction(accumFirstPassHists)
     applier.apply(potentialCloudFirstPass, infiles, outfiles, otherargs, controls=controls)
     
     (Twater, Tlow, Thigh) = calcBTthresholds(otherargs)
@@ -328,62 +536,48 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     Called from RIOS. 
     
     Calculate the first pass potential cloud layer (equation 6)
+    
+    All the arithmetic is done in float32, as far as possible in place, 
+    in scratch arrays which are re-used from one block to the next (see 
+    getScratchArray). If fmaskConfig.useNumexpr is set, the main tests are 
+    evaluated with numexpr, which avoids most of the remaining temporary arrays. 
         
     """
     fmaskConfig = otherargs.fmaskConfig
+    shape = inputs.toaref.shape[1:]
 
-    ref = refDNtoUnits(inputs.toaref, fmaskConfig)
+    ref = refDNtoUnits(inputs.toaref, fmaskConfig, 
+        out=getScratchArray('ref', inputs.toaref.shape, numpy.float32))
     # Clamp off any reflectance <= 0
     ref[ref<=0] = 0.00001
 
-    # Extract the bands we need
-    blue = otherargs.refBands[config.BAND_BLUE]
+    # Extract the bands we need here. The rest are used in firstPassTests
     green = otherargs.refBands[config.BAND_GREEN]
-    red = otherargs.refBands[config.BAND_RED]
     nir = otherargs.refBands[config.BAND_NIR]
-    swir1 = otherargs.refBands[config.BAND_SWIR1]
     swir2 = otherargs.refBands[config.BAND_SWIR2]
     if hasattr(inputs, 'thermal'):
         THERM = otherargs.thermalInfo.thermalBand1040um
     
     # Special mask needed only for resets in final pass
     refNullmask = (inputs.toaref[otherargs.bandsForRefNull] == otherargs.refNull).any(axis=0)
+    bt = None
     if hasattr(inputs, 'thermal'):
         thermNullmask = (inputs.thermal[THERM] == otherargs.thermalNull)
         nullmask = (refNullmask | thermNullmask)
         # Brightness temperature in degrees C
         bt = otherargs.thermalInfo.scaleThermalDNtoC(inputs.thermal)
     else:
-        thermNullmask = numpy.zeros_like(ref[0], dtype=bool)
+        thermNullmask = numpy.zeros(shape, dtype=bool)
         nullmask = refNullmask
     
-    # Equation 1
-    ndsi = (ref[green] - ref[swir1]) / (ref[green] + ref[swir1])
-    ndvi = (ref[nir] - ref[red]) / (ref[nir] + ref[red])
-    # In two parts, in case we have no thermal.
-    basicTest = (ref[swir2] > fmaskConfig.Eqn1Swir2Thresh) & (ndsi < 0.8) & (ndvi < 0.8)
-    if hasattr(inputs, 'thermal'):
-        basicTest = (basicTest & (bt < fmaskConfig.Eqn1ThermThresh))
-    
-    # Equation 2
-    meanVis = (ref[blue] + ref[green] + ref[red]) / 3.0
-    whiteness = numpy.zeros(ref[0].shape)
-    for n in [blue, green, red]:
-        whiteness = whiteness + numpy.absolute((ref[n] - meanVis) / meanVis)
-
-    whitenessTest = (whiteness < fmaskConfig.Eqn2WhitenessThresh)
-    
-    # Haze test, equation 3
-    hazeTest = ((ref[blue] - 0.5 * ref[red] - 0.08) > 0)
-    
-    # Equation 4
-    b45test = ((ref[nir] / ref[swir1]) > 0.75)
-    
-    # Equation 5
-    waterTest = numpy.logical_or(
-        numpy.logical_and(ndvi < 0.01, ref[nir] < 0.11),
-        numpy.logical_and(ndvi < 0.1, ref[nir] < 0.05)
-    )
+    # Equations 1-6. The basic, whiteness, haze and B4/B5 tests are 
+    # combined straight into the potential cloud pixels (pcp)
+    if fmaskConfig.useNumexpr:
+        (ndsi, ndvi, meanVis, whiteness, pcp, waterTest) = firstPassTestsNumexpr(ref, 
+            otherargs.refBands, bt, fmaskConfig)
+    else:
+        (ndsi, ndvi, meanVis, whiteness, pcp, waterTest) = firstPassTests(ref, 
+            otherargs.refBands, bt, fmaskConfig)
 
     waterTest[nullmask] = False
     
@@ -392,9 +586,6 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
         cirrus = otherargs.refBands[config.BAND_CIRRUS]
         cirrusBandTest = (ref[cirrus] > fmaskConfig.cirrusBandTestThresh)
     
-    # Equation 6. Potential cloud pixels (first pass)
-    pcp = basicTest & whitenessTest & hazeTest & b45test
-    
     # If Sentinel-2, we can use the Frantz 2018 displacement test
     if (fmaskConfig.sensor == config.FMASK_SENTINEL2) and fmaskConfig.sen2displacementTest:
         (ratio8a8, ratio8a7, v8a8, v8a7, cdi) = calcCDI(ref, fmaskConfig, otherargs.refBands)
@@ -410,7 +601,7 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     # supposed to be combined with previous tests using AND or OR, so I tried both
     # and picked what seemed best. 
     if config.BAND_CIRRUS in otherargs.refBands:
-        pcp = (pcp | cirrusBandTest)
+        pcp |= cirrusBandTest
     
     # This is an extra saturation test added by DERM, and is not part of the Fmask algorithm. 
     # However, some cloud centres are saturated, and thus fail the whiteness and haze tests
@@ -424,50 +615,262 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     pcp[nullmask] = False
     
     # Equation 7
-    clearSkyWater = numpy.logical_and(waterTest, ref[swir2] < fmaskConfig.Eqn7Swir2Thresh)
+    clearSkyWater = (ref[swir2] < fmaskConfig.Eqn7Swir2Thresh)
+    clearSkyWater &= waterTest
     clearSkyWater[nullmask] = False
     
     # Equation 12
-    clearLand = numpy.logical_and(numpy.logical_not(pcp), numpy.logical_not(waterTest))
+    clearLand = ~pcp
+    clearLand &= ~waterTest
     clearLand[nullmask] = False
     
-    # Equation 15
-    # Need to modify ndvi/ndsi by saturation......
-    if hasattr(inputs, 'saturationMask'):
-        modNdvi = numpy.where((inputs.saturationMask[SATURATION_GREEN] != 0), 0, ndvi)
-        modNdsi = numpy.where((inputs.saturationMask[SATURATION_RED] != 0), 0, ndsi)
-    else:
-        modNdvi = ndvi
-        modNdsi = ndsi
-    # Maximum of three indices
-    maxNdx = numpy.absolute(modNdvi)
-    maxNdx = numpy.maximum(maxNdx, numpy.absolute(modNdsi))
-    maxNdx = numpy.maximum(maxNdx, whiteness)
-    variabilityProb = 1 - maxNdx
-    variabilityProb[nullmask] = 0
-    variabilityProbPcnt = numpy.round(variabilityProb * PROB_SCALE)
-    variabilityProbPcnt = variabilityProbPcnt.clip(BYTE_MIN, BYTE_MAX).astype(numpy.uint8)
-    
     # Equation 20
-    # In two parts, in case we are missing thermal
-    snowmask = ((ndsi > 0.15) & (ref[nir] > fmaskConfig.Eqn20NirSnowThresh) & 
-        (ref[green] > fmaskConfig.Eqn20GreenSnowThresh))
+    # In two parts, in case we are missing thermal. Done before equation 15, 
+    # as that modifies ndsi in place
+    snowmask = (ndsi > 0.15)
+    snowmask &= (ref[nir] > fmaskConfig.Eqn20NirSnowThresh)
+    snowmask &= (ref[green] > fmaskConfig.Eqn20GreenSnowThresh)
     if hasattr(inputs, 'thermal'):
-        snowmask = snowmask & (bt < fmaskConfig.Eqn20ThermThresh)
+        snowmask &= (bt < fmaskConfig.Eqn20ThermThresh)
     snowmask[nullmask] = False
     
-    # Output the pcp and water test layers. 
-    outputs.pass1 = numpy.array([pcp, waterTest, clearLand, variabilityProbPcnt, 
-        nullmask, snowmask, refNullmask, thermNullmask])
-    
-    # Accumulate histograms of temperature for land and water separately
+    # Equation 15
+    # Need to modify ndvi/ndsi by saturation......
+    if hasattr(inputs, 'saturationMask'):
+        ndvi[inputs.saturationMask[SATURATION_GREEN] != 0] = 0
+        ndsi[inputs.saturationMask[SATURATION_RED] != 0] = 0
+    # Maximum of three indices. These are the last uses of ndvi and meanVis, 
+    # so their scratch arrays are re-used here. 
+    maxNdx = numpy.absolute(ndvi, out=ndvi)
+    absNdsi = numpy.absolute(ndsi, out=meanVis)
+    numpy.maximum(maxNdx, absNdsi, out=maxNdx)
+    numpy.maximum(maxNdx, whiteness, out=maxNdx)
+    variabilityProb = numpy.subtract(1, maxNdx, out=maxNdx)
+    variabilityProb[nullmask] = 0
+    variabilityProb *= PROB_SCALE
+    numpy.round(variabilityProb, out=variabilityProb)
+    variabilityProbPcnt = variabilityProb.clip(BYTE_MIN, BYTE_MAX, 
+        out=variabilityProb).astype(numpy.uint8)
+    
+    # Output the pcp and water test layers, packed into one layer of flags
+    flags = packPass1Flags([(pcp, PASS1_PCP), (waterTest, PASS1_WATERTEST), 
+        (clearLand, PASS1_CLEARLAND), (nullmask, PASS1_NULLMASK), 
+        (snowmask, PASS1_SNOWMASK), (refNullmask, PASS1_REFNULLMASK), 
+        (thermNullmask, PASS1_THERMNULLMASK)])
+    outputs.pass1 = numpy.array([flags, variabilityProbPcnt])
+    
+    # Histograms of temperature for land and water separately, for this block. 
+    # These are accumulated into otherargs by accumFirstPassHists
+    outputs.waterBT_hist = numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32)
+    outputs.clearLandBT_hist = numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32)
     if hasattr(inputs, 'thermal'):
         scaledBT = (bt + BT_OFFSET).clip(0, BT_HISTSIZE)
-        otherargs.waterBT_hist = accumHist(otherargs.waterBT_hist, scaledBT[clearSkyWater])
-        otherargs.clearLandBT_hist = accumHist(otherargs.clearLandBT_hist, scaledBT[clearLand])
+        outputs.waterBT_hist = accumHist(outputs.waterBT_hist, scaledBT[clearSkyWater])
+        outputs.clearLandBT_hist = accumHist(outputs.clearLandBT_hist, scaledBT[clearLand])
     scaledB4 = (ref[nir] * B4_SCALE).astype(numpy.uint8)
-    otherargs.clearLandB4_hist = accumHist(otherargs.clearLandB4_hist, scaledB4[clearLand])
-    otherargs.nonNullCount += numpy.count_nonzero(~nullmask)
+    outputs.clearLandB4_hist = accumHist(numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32), 
+        scaledB4[clearLand])
+    outputs.nonNullCount = numpy.count_nonzero(~nullmask)
+
+
+def packPass1Flags(flagList):
+    """
+    Pack the given boolean layers into a single uint8 layer of bit flags, 
+    for the first band of the pass1 intermediate. flagList is a list of 
+    tuples of (layer, flagBit), with flagBit one of the PASS1_* values. 
+    
+    """
+    flags = numpy.zeros(flagList[0][0].shape, dtype=numpy.uint8)
+    for (layer, flagBit) in flagList:
+        numpy.bitwise_or(flags, flagBit, out=flags, where=layer)
+    return flags
+
+
+def getPass1Flag(flags, flagBit):
+    """
+    Return the boolean layer for the given flagBit (one of the PASS1_* values),
+    from the flags layer of the pass1 intermediate, i.e. from
+    pass1[PASS1_FLAGS_BAND]. 
+    
+    """
+    return ((flags & flagBit) != 0)
+
+
+def firstPassTests(ref, refBands, bt, fmaskConfig):
+    """
+    Called from potentialCloudFirstPass. 
+    
+    Equations 1 to 6, done in place in float32 scratch arrays. Returns a tuple of
+    (ndsi, ndvi, meanVis, whiteness, pcp, waterTest). 
+    
+    """
+    shape = ref.shape[1:]
+    (blue, green, red, nir, swir1, swir2) = [refBands[band] for band in 
+        [config.BAND_BLUE, config.BAND_GREEN, config.BAND_RED, config.BAND_NIR,
+        config.BAND_SWIR1, config.BAND_SWIR2]]
+    tmp = getScratchArray('tmp', shape, numpy.float32)
+    tmpBool = getScratchArray('tmpBool', shape, bool)
+    tmpBool2 = getScratchArray('tmpBool2', shape, bool)
+    
+    # Equation 1
+    ndsi = numpy.subtract(ref[green], ref[swir1], out=getScratchArray('ndsi', shape, 
+        numpy.float32))
+    ndsi /= numpy.add(ref[green], ref[swir1], out=tmp)
+    ndvi = numpy.subtract(ref[nir], ref[red], out=getScratchArray('ndvi', shape, 
+        numpy.float32))
+    ndvi /= numpy.add(ref[nir], ref[red], out=tmp)
+    pcp = numpy.greater(ref[swir2], fmaskConfig.Eqn1Swir2Thresh, 
+        out=getScratchArray('pcp', shape, bool))
+    pcp &= numpy.less(ndsi, 0.8, out=tmpBool)
+    pcp &= numpy.less(ndvi, 0.8, out=tmpBool)
+    if bt is not None:
+        pcp &= numpy.less(bt, fmaskConfig.Eqn1ThermThresh, out=tmpBool)
+    
+    # Equation 2
+    meanVis = numpy.add(ref[blue], ref[green], out=getScratchArray('meanVis', shape, 
+        numpy.float32))
+    meanVis += ref[red]
+    meanVis /= 3.0
+    whiteness = getScratchArray('whiteness', shape, numpy.float32)
+    whiteness.fill(0)
+    for n in [blue, green, red]:
+        numpy.subtract(ref[n], meanVis, out=tmp)
+        tmp /= meanVis
+        whiteness += numpy.absolute(tmp, out=tmp)
+    pcp &= numpy.less(whiteness, fmaskConfig.Eqn2WhitenessThresh, out=tmpBool)
+    
+    # Haze test, equation 3
+    numpy.multiply(ref[red], 0.5, out=tmp)
+    numpy.subtract(ref[blue], tmp, out=tmp)
+    tmp -= 0.08
+    pcp &= numpy.greater(tmp, 0, out=tmpBool)
+    
+    # Equation 4
+    numpy.divide(ref[nir], ref[swir1], out=tmp)
+    pcp &= numpy.greater(tmp, 0.75, out=tmpBool)
+    
+    # Equation 5
+    waterTest = numpy.less(ndvi, 0.01, out=getScratchArray('waterTest', shape, bool))
+    waterTest &= numpy.less(ref[nir], 0.11, out=tmpBool)
+    numpy.less(ndvi, 0.1, out=tmpBool2)
+    tmpBool2 &= numpy.less(ref[nir], 0.05, out=tmpBool)
+    waterTest |= tmpBool2
+    
+    return (ndsi, ndvi, meanVis, whiteness, pcp, waterTest)
+
+
+def firstPassTestsNumexpr(ref, refBands, bt, fmaskConfig):
+    """
+    Called from potentialCloudFirstPass. 
+    
+    Same as firstPassTests, but evaluates each equation with numexpr, 
+    which needs no temporary arrays. All the constants are passed in as 
+    float32 values, so the arithmetic is done in exactly the same 
+    way as in firstPassTests. 
+    
+    """
+    if numexpr is None:
+        msg = 'Use of numexpr was requested, but numexpr is not installed'
+        raise fmaskerrors.FmaskInstallationError(msg)
+
+    shape = ref.shape[1:]
+    f32 = numpy.float32
+    variables = {'blue': ref[refBands[config.BAND_BLUE]], 
+        'green': ref[refBands[config.BAND_GREEN]], 'red': ref[refBands[config.BAND_RED]], 
+        'nir': ref[refBands[config.BAND_NIR]], 'swir1': ref[refBands[config.BAND_SWIR1]], 
+        'swir2': ref[refBands[config.BAND_SWIR2]], 
+        'swir2Thresh': f32(fmaskConfig.Eqn1Swir2Thresh), 
+        'whitenessThresh': f32(fmaskConfig.Eqn2WhitenessThresh), 
+        'zero': f32(0), 'half': f32(0.5), 'three': f32(3.0), 'c0_01': f32(0.01), 
+        'c0_05': f32(0.05), 'c0_08': f32(0.08), 'c0_1': f32(0.1), 'c0_11': f32(0.11), 
+        'c0_75': f32(0.75), 'c0_8': f32(0.8)}
+    
+    # Equation 1
+    ndsi = numexpr.evaluate("(green - swir1) / (green + swir1)", local_dict=variables,
+        out=getScratchArray('ndsi', shape, numpy.float32))
+    ndvi = numexpr.evaluate("(nir - red) / (nir + red)", local_dict=variables,
+        out=getScratchArray('ndvi', shape, numpy.float32))
+    # Equation 2
+    meanVis = numexpr.evaluate("(blue + green + red) / three", local_dict=variables,
+        out=getScratchArray('meanVis', shape, numpy.float32))
+    variables.update(ndsi=ndsi, ndvi=ndvi, meanVis=meanVis)
+    whiteness = numexpr.evaluate("abs((blue - meanVis) / meanVis) + " + 
+        "abs((green - meanVis) / meanVis) + abs((red - meanVis) / meanVis)", 
+        local_dict=variables, out=getScratchArray('whiteness', shape, numpy.float32))
+    variables['whiteness'] = whiteness
+
+    # Equations 1-4, combined as per equation 6
+    pcpExpr = ("(swir2 > swir2Thresh) & (ndsi < c0_8) & (ndvi < c0_8) & " +
+        "(whiteness < whitenessThresh) & ((blue - half * red - c0_08) > zero) & " + 
+        "((nir / swir1) > c0_75)")
+    if bt is not None:
+        variables['bt'] = bt
+        variables['thermThresh'] = bt.dtype.type(fmaskConfig.Eqn1ThermThresh)
+        pcpExpr += " & (bt < thermThresh)"
+    pcp = numexpr.evaluate(pcpExpr, local_dict=variables, 
+        out=getScratchArray('pcp', shape, bool))
+
+    # Equation 5
+    waterTest = numexpr.evaluate("((ndvi < c0_01) & (nir < c0_11)) | " + 
+        "((ndvi < c0_1) & (nir < c0_05))", local_dict=variables, 
+        out=getScratchArray('waterTest', shape, bool))
+    
+    return (ndsi, ndvi, meanVis, whiteness, pcp, waterTest)
+
+
+# Scratch arrays re-used from one block to the next, kept separately for each 
+# thread, in case blocks are processed in threads. See getScratchArray.
+scratchArrays = threading.local()
+
+
+def getScratchArray(name, shape, dtype):
+    """
+    Return a scratch array of the given shape and dtype, for use under the 
+    given name. The same array is returned each time, for the current thread, 
+    as long as the shape and dtype stay the same, so there is no need to allocate
+    new arrays for every block. The contents are not initialised. 
+    
+    """
+    arrDict = getattr(scratchArrays, 'arrDict', None)
+    if arrDict is None:
+        arrDict = scratchArrays.arrDict = {}
+    arr = arrDict.get(name)
+    if arr is None or arr.shape != tuple(shape) or arr.dtype != dtype:
+        arr = numpy.empty(shape, dtype=dtype)
+        arrDict[name] = arr
+    return arr
+
+
+def accumFirstPassHists(otherargs, outputs):
+    """
+    Called from RIOS, in the main process, after each block of 
+    potentialCloudFirstPass. Accumulates the histograms and counts for
+    the block into the totals on otherargs. 
+    
+    """
+    otherargs.waterBT_hist += outputs.waterBT_hist
+    otherargs.clearLandBT_hist += outputs.clearLandBT_hist
+    otherargs.clearLandB4_hist += outputs.clearLandB4_hist
+    otherargs.nonNullCount += outputs.nonNullCount
+
+
+def setParallelControls(controls, fmaskConfig):
+    """
+    Set the given RIOS controls to process blocks in parallel, as 
+    requested by fmaskConfig.numWorkers. Any changes the user function
+    makes to otherargs are then lost, so any results must be 
+    passed out through a reduce function. The workers are kept 
+    for all the passes (and later runs), rather than started for each 
+    one. The reading and writing is pipelined if requested by 
+    fmaskConfig.pipelineIO. 
+    
+    """
+    if fmaskConfig.numWorkers > 1:
+        controls.setNumThreads(fmaskConfig.numWorkers)
+        controls.setJobManagerType(fmaskConfig.jobManagerType)
+        controls.setPersistentJobManager(True)
+    if fmaskConfig.pipelineIO:
+        controls.setPipelineIO(True)
 
 
 def accumHist(counts, vals):
@@ -500,12 +903,15 @@ def scoreatpcnt(counts, pcnt):
     return n
 
 
-def refDNtoUnits(refDN, fmaskConfig):
+def refDNtoUnits(refDN, fmaskConfig, out=None):
     """
     Convert the given reflectance pixel value array to physical units,
     using parameters given in fmaskConfig. 
 
     Scaling is ref = (dn+offset)/scaleVal
+    
+    If given, out is a float32 array of the same shape as refDN, in which
+    the result is calculated, in place. 
 
     """
     scaleVal = float(fmaskConfig.TOARefScaling)
@@ -515,7 +921,10 @@ def refDNtoUnits(refDN, fmaskConfig):
         ndx = fmaskConfig.bands[idNum]
         bandNdxLookup[ndx] = idNum
 
-    refUnits = numpy.zeros(refDN.shape, dtype=numpy.float32)
+    if out is None:
+        refUnits = numpy.zeros(refDN.shape, dtype=numpy.float32)
+    else:
+        refUnits = out
     numBands = refDN.shape[0]
     for bandNdx in range(numBands):
         offset = 0
@@ -528,7 +937,10 @@ def refDNtoUnits(refDN, fmaskConfig):
         if bandIdNum is not None and fmaskConfig.TOARefDNoffsetDict is not None:
             offset = fmaskConfig.TOARefDNoffsetDict[bandIdNum]
 
-        refUnits[bandNdx] = singleRefDNtoUnits(refDN[bandNdx], scaleVal, offset)
+        # Same as singleRefDNtoUnits, but in place
+        refUnits[bandNdx] = refDN[bandNdx]
+        refUnits[bandNdx] += offset
+        refUnits[bandNdx] /= scaleVal
     return refUnits
 
 
@@ -580,9 +992,8 @@ def doPotentialCloudSecondPass(fmaskFilenames, fmaskConfig, pass1file,
     infiles.toaref = fmaskFilenames.toaRef
     if not missingThermal:
         infiles.thermal = fmaskFilenames.thermal
-    (fd, outfiles.pass2) = tempfile.mkstemp(prefix='pass2', dir=fmaskConfig.tempDir, 
-                                    suffix=fmaskConfig.defaultExtension)
-    os.close(fd)
+    outfiles.pass2 = makeIntermediateFilename(fmaskConfig, 'pass2')
+    setIntermediateOutputDriver(controls, fmaskConfig, 'pass2')
     otherargs.refBands = fmaskConfig.bands
     otherargs.thermalInfo = fmaskConfig.thermalInfo
     
@@ -598,6 +1009,8 @@ def doPotentialCloudSecondPass(fmaskFilenames, fmaskConfig, pass1file,
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
 
+    setParallelControls(controls, fmaskConfig)
+    controls.setReduceFunction(accumSecondPassHist)
     applier.apply(potentialCloudSecondPass, infiles, outfiles, otherargs, controls=controls)
     
     # Equation 17
@@ -634,8 +1047,8 @@ def potentialCloudSecondPass(info, inputs, outputs, otherargs):
     Twater = otherargs.Twater
     (Tlow, Thigh) = (otherargs.Tlow, otherargs.Thigh)
     # Values from first pass
-    clearLand = inputs.pass1[2].astype(bool)
-    variabilityProbPcnt = inputs.pass1[3]
+    clearLand = getPass1Flag(inputs.pass1[PASS1_FLAGS_BAND], PASS1_CLEARLAND)
+    variabilityProbPcnt = inputs.pass1[PASS1_VARIABILITY_BAND]
     variability_prob = variabilityProbPcnt / PROB_SCALE
     
     # Cirrus band. From Zhu et al 2015, equation 1
@@ -677,9 +1090,20 @@ def potentialCloudSecondPass(info, inputs, outputs, otherargs):
         (lCloud_prob * PROB_SCALE).clip(BYTE_MIN, BYTE_MAX)], dtype=numpy.uint8)
     outputs.pass2 = outstack
     
-    # Accumulate histogram of lCloud_prob
+    # Histogram of lCloud_prob for this block, accumulated by accumSecondPassHist
     scaledProb = (lCloud_prob * PROB_SCALE).clip(BYTE_MIN, BYTE_MAX).astype(numpy.uint8)
-    otherargs.lCloudProb_hist = accumHist(otherargs.lCloudProb_hist, scaledProb[clearLand])
+    outputs.lCloudProb_hist = accumHist(numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32), 
+        scaledProb[clearLand])
+
+
+def accumSecondPassHist(otherargs, outputs):
+    """
+    Called from RIOS, in the main process, after each block of 
+    potentialCloudSecondPass. Accumulates the histogram for the block into
+    the total on otherargs. 
+    
+    """
+    otherargs.lCloudProb_hist += outputs.lCloudProb_hist
 
 
 def doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, pass1file, pass2file, 
@@ -702,9 +1126,8 @@ def doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, pass1file, pass2file,
     otherargs.minCloudSize = fmaskConfig.minCloudSize_pixels
     otherargs.sensor = fmaskConfig.sensor
 
-    (fd, outfiles.cloudmask) = tempfile.mkstemp(prefix='interimcloud', 
-        dir=fmaskConfig.tempDir, suffix=fmaskConfig.defaultExtension)
-    os.close(fd)
+    outfiles.cloudmask = makeIntermediateFilename(fmaskConfig, 'interimcloud')
+    setIntermediateOutputDriver(controls, fmaskConfig, 'cloudmask')
     # Need overlap so we can do Fmask's 3x3 fill-in
     overlap = 1
     # Also need overlap for cloud size filter
@@ -717,6 +1140,7 @@ def doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, pass1file, pass2file,
     controls.setCalcStats(False)
     controls.setOmitPyramids(True)
 
+    setParallelControls(controls, fmaskConfig)
     applier.apply(cloudFinalPass, infiles, outfiles, otherargs, controls=controls)
     
     return outfiles.cloudmask
@@ -728,9 +1152,10 @@ def cloudFinalPass(info, inputs, outputs, otherargs):
     
     Final pass of cloud mask layer
     """
-    nullmask = inputs.pass1[4].astype(bool)
-    pcp = inputs.pass1[0].astype(bool)
-    waterTest = inputs.pass1[1].astype(bool)
+    flags = inputs.pass1[PASS1_FLAGS_BAND]
+    nullmask = getPass1Flag(flags, PASS1_NULLMASK)
+    pcp = getPass1Flag(flags, PASS1_PCP)
+    waterTest = getPass1Flag(flags, PASS1_WATERTEST)
     notWater = numpy.logical_not(waterTest)
     notWater[nullmask] = False
     wCloud_prob = inputs.pass2[0] / PROB_SCALE
@@ -785,21 +1210,16 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
     """
     Make potential shadow layer, as per section 3.1.3 of Zhu&Woodcock. 
     """
-    (fd, potentialShadowsFile) = tempfile.mkstemp(prefix='shadows', dir=fmaskConfig.tempDir, 
-                                        suffix=fmaskConfig.defaultExtension)
-    os.close(fd)
+    potentialShadowsFile = makeIntermediateFilename(fmaskConfig, 'shadows')
 
     # convert from numpy (0 based) to GDAL (1 based) indexing
     NIR_lyr = fmaskConfig.bands[config.BAND_NIR] + 1
     
-    # Read in whole of band 4
     ds = gdal.Open(fmaskFilenames.toaRef)
     band = ds.GetRasterBand(NIR_lyr)
     nullval = band.GetNoDataValue()
     if nullval is None:
         nullval = 0
-    # Sentinel2 is uint16 which causes problems...
-    scaledNIR = band.ReadAsArray().astype(numpy.int16)
     # Check for ESA's stoopid offset, for NIR band only
     NIRoffset = 0
     if (fmaskConfig.TOARefDNoffsetDict is not None and 
@@ -807,6 +1227,15 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
         NIRoffset = fmaskConfig.TOARefDNoffsetDict[config.BAND_NIR]
     scaleVal = fmaskConfig.TOARefScaling
     NIR_17_dn = NIR_17 * scaleVal - NIRoffset
+
+    if fmaskConfig.fillMinimaTileSize is not None:
+        potentialShadowsTiled(fmaskConfig, ds, band, nullval, NIR_17_dn, scaleVal,
+            NIRoffset, potentialShadowsFile)
+        return potentialShadowsFile
+    
+    # Read in whole of band 4
+    # Sentinel2 is uint16 which causes problems...
+    scaledNIR = band.ReadAsArray().astype(numpy.int16)
     
     scaledNIR_filled = fillminima.fillMinima(scaledNIR, nullval, NIR_17_dn)
 
@@ -817,8 +1246,8 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
     # Equation 19
     potentialShadows = ((NIR_filled - NIR) > fmaskConfig.Eqn19NIRFillThresh)
     
-    driver = gdal.GetDriverByName(applier.DEFAULTDRIVERNAME)
-    creationOptions = applier.dfltDriverOptions[applier.DEFAULTDRIVERNAME]
+    (driverName, creationOptions) = getIntermediateDriver(fmaskConfig)
+    driver = gdal.GetDriverByName(driverName)
     outds = driver.Create(potentialShadowsFile, ds.RasterXSize, ds.RasterYSize, 
                     1, gdal.GDT_Byte, creationOptions)
     proj = ds.GetProjection()
@@ -833,6 +1262,71 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
     return potentialShadowsFile
 
 
+def potentialShadowsTiled(fmaskConfig, ds, band, nullval, NIR_17_dn, scaleVal, 
+        NIRoffset, potentialShadowsFile):
+    """
+    Called from doPotentialShadows when fmaskConfig.fillMinimaTileSize is set.
+    Does the same thing, but the NIR band and its filled version are 
+    held in scratch files in the temp directory, and everything is done
+    a tile (or a strip of tiles) at a time, so the memory used is bounded 
+    by the tile size. If fmaskConfig.intermediatesInMemory is set, the 
+    NIR band and its filled version are held in memory instead. 
+    
+    """
+    tileSize = fmaskConfig.fillMinimaTileSize
+    (nrows, ncols) = (ds.RasterYSize, ds.RasterXSize)
+    
+    scratchFiles = []
+    if not fmaskConfig.intermediatesInMemory:
+        for prefix in ['nir', 'nirfilled']:
+            (fd, scratchFile) = tempfile.mkstemp(prefix=prefix, dir=fmaskConfig.tempDir, 
+                suffix='.dat')
+            os.close(fd)
+            scratchFiles.append(scratchFile)
+    
+    (driverName, creationOptions) = getIntermediateDriver(fmaskConfig)
+    driver = gdal.GetDriverByName(driverName)
+    outds = driver.Create(potentialShadowsFile, ncols, nrows, 
+                    1, gdal.GDT_Byte, creationOptions)
+    outds.SetProjection(ds.GetProjection())
+    outds.SetGeoTransform(ds.GetGeoTransform())
+    outband = outds.GetRasterBand(1)
+
+    try:
+        if fmaskConfig.intermediatesInMemory:
+            scaledNIR = numpy.empty((nrows, ncols), dtype=numpy.int16)
+            scaledNIR_filled = numpy.empty((nrows, ncols), dtype=numpy.int16)
+        else:
+            scaledNIR = numpy.memmap(scratchFiles[0], dtype=numpy.int16, mode='w+', 
+                shape=(nrows, ncols))
+            scaledNIR_filled = numpy.memmap(scratchFiles[1], dtype=numpy.int16, mode='w+', 
+                shape=(nrows, ncols))
+        for row in range(0, nrows, tileSize):
+            numRows = min(tileSize, nrows - row)
+            # Sentinel2 is uint16 which causes problems...
+            scaledNIR[row:row + numRows] = band.ReadAsArray(0, row, ncols, 
+                numRows).astype(numpy.int16)
+
+        fillminima.fillMinimaTiled(scaledNIR, nullval, NIR_17_dn, tileSize, 
+            out=scaledNIR_filled, numThreads=fmaskConfig.numWorkers)
+
+        for row in range(0, nrows, tileSize):
+            numRows = min(tileSize, nrows - row)
+            NIR = singleRefDNtoUnits(scaledNIR[row:row + numRows], scaleVal, NIRoffset)
+            NIR_filled = singleRefDNtoUnits(scaledNIR_filled[row:row + numRows], 
+                scaleVal, NIRoffset)
+            # Equation 19
+            potentialShadows = ((NIR_filled - NIR) > fmaskConfig.Eqn19NIRFillThresh)
+            outband.WriteArray(potentialShadows, 0, row)
+        del scaledNIR, scaledNIR_filled
+    finally:
+        for scratchFile in scratchFiles:
+            os.remove(scratchFile)
+
+    outband.SetNoDataValue(0)
+    del outds
+
+
 def clumpClouds(cloudmaskfile):
     """
     Clump cloud pixels to make a layer of cloud objects. Currently assumes
@@ -847,10 +1341,130 @@ def clumpClouds(cloudmaskfile):
     return (clumps, numClumps)
 
 
+def clumpCloudsStreamed(cloudmaskfile, blockRows):
+    """
+    Same as clumpClouds, but reads and clumps the cloud mask in strips of
+    blockRows rows, so that the whole image of clumps is never held 
+    in memory. The clumps are numbered in the same order as they would
+    be by clumpClouds. 
+    
+    Rather than an image of clumps, returns a tuple of 
+    (cloudClumpNdx, numClumps), where cloudClumpNdx is the same 
+    valueindexes.ValueIndexes object as would be made from the clumps image. 
+    
+    This is done in two passes over the strips. The first clumps each strip,
+    counts the pixels in each of its clumps, and joins up the clumps which 
+    touch across the boundary rows between strips. The second clumps each 
+    strip again, and adds its pixels to cloudClumpNdx, which is allocated 
+    from the counts. So, apart from cloudClumpNdx itself, the memory used 
+    depends only on the size of a strip and the number of clumps. 
+    
+    """
+    ds = gdal.Open(cloudmaskfile)
+    band = ds.GetRasterBand(1)
+    (nrows, ncols) = (ds.RasterYSize, ds.RasterXSize)
+    stripRowList = list(range(0, nrows, blockRows))
+    
+    # Clump each strip separately. Clump numbers are unique across all strips, 
+    # and are in order of the first pixel of each clump, in the whole image
+    stripCountsList = [numpy.zeros(1, dtype=numpy.int64)]
+    stripOffsetList = []
+    edgeList = []
+    numStripClumps = 0
+    prevLastRow = None
+    for (row, stripClumps, numClumps) in iterClumpedStrips(band, stripRowList, 
+            blockRows, nrows, ncols):
+        stripOffsetList.append(numStripClumps)
+        stripClumps[stripClumps > 0] += numStripClumps
+        stripCountsList.append(numpy.bincount(stripClumps.ravel(), 
+            minlength=numStripClumps + numClumps + 1)[numStripClumps + 1:])
+        numStripClumps += numClumps
+
+        # Pairs of clumps which touch across the boundary with the previous strip
+        if prevLastRow is not None:
+            firstRow = stripClumps[0]
+            for (above, below) in [(prevLastRow, firstRow), 
+                    (prevLastRow[:-1], firstRow[1:]), (prevLastRow[1:], firstRow[:-1])]:
+                touching = (above > 0) & (below > 0)
+                edgeList.append((above[touching], below[touching]))
+        prevLastRow = stripClumps[-1].copy()
+        del stripClumps
+    
+    # Join up the clumps which touch across strips. Each joined clump 
+    # is numbered in the order of the first strip clump in it, which is
+    # also the order of its first pixel. 
+    if len(edgeList) > 0:
+        edgeFrom = numpy.concatenate([edges[0] for edges in edgeList])
+        edgeTo = numpy.concatenate([edges[1] for edges in edgeList])
+    else:
+        edgeFrom = edgeTo = numpy.zeros(0, dtype=numpy.int32)
+    del edgeList
+    graph = coo_matrix((numpy.ones(len(edgeFrom), dtype=numpy.uint8), (edgeFrom, edgeTo)),
+        shape=(numStripClumps + 1, numStripClumps + 1))
+    (numComponents, component) = connected_components(graph, directed=False)
+    del graph, edgeFrom, edgeTo
+    (uniqueComponents, firstStripClump) = numpy.unique(component[1:], return_index=True)
+    numClumps = len(uniqueComponents)
+    clumpFromComponent = numpy.zeros(numComponents, dtype=numpy.int32)
+    clumpFromComponent[uniqueComponents[numpy.argsort(firstStripClump)]] = numpy.arange(
+        1, numClumps + 1, dtype=numpy.int32)
+    clumpFromStripClump = clumpFromComponent[component]
+    clumpFromStripClump[0] = 0
+    
+    # Pixel counts of the joined clumps
+    clumpCounts = numpy.bincount(clumpFromStripClump, 
+        weights=numpy.concatenate(stripCountsList), minlength=numClumps + 1)[1:]
+    del stripCountsList
+    cloudClumpNdx = valueindexes.ValueIndexes.fromValueCounts(
+        numpy.arange(1, numClumps + 1, dtype=numpy.int32), 
+        numpy.round(clumpCounts).astype(numpy.int64), 2, nullVals=[0])
+    
+    # Second pass, adding the pixels of each strip in the order they 
+    # occur in the image
+    if numClumps > 0:
+        for ((row, stripClumps, numInStrip), stripOffset) in zip(
+                iterClumpedStrips(band, stripRowList, blockRows, nrows, ncols), 
+                stripOffsetList):
+            (rows, cols) = numpy.nonzero(stripClumps)
+            pixClumps = clumpFromStripClump[stripClumps[rows, cols] + stripOffset]
+            del stripClumps
+            indexes = numpy.column_stack([(rows + row).astype(numpy.uint32), 
+                cols.astype(numpy.uint32)])
+            cloudClumpNdx.addIndexes(pixClumps, indexes)
+            del rows, cols, pixClumps, indexes
+    del ds
+
+    return (cloudClumpNdx, numClumps)
+
+
+def iterClumpedStrips(band, stripRowList, blockRows, nrows, ncols):
+    """
+    Generator for clumpCloudsStreamed, reading the cloud mask band one strip
+    of blockRows rows at a time, and yielding (row, stripClumps, numClumps) 
+    for each, as returned by label() on the strip. The next strip is read 
+    while the current one is being clumped. 
+    
+    """
+    def readStrip(row):
+        return band.ReadAsArray(0, row, ncols, min(blockRows, nrows - row))
+    
+    with futures.ThreadPoolExecutor(max_workers=1) as reader:
+        nextStrip = reader.submit(readStrip, stripRowList[0]) if nrows > 0 else None
+        for (i, row) in enumerate(stripRowList):
+            cloudmask = nextStrip.result()
+            if i + 1 < len(stripRowList):
+                nextStrip = reader.submit(readStrip, stripRowList[i + 1])
+
+            (stripClumps, numClumps) = label(cloudmask, structure=numpy.ones((3, 3)))
+            del cloudmask
+            yield (row, stripClumps, numClumps)
+
+
 CLOUD_HEIGHT_SCALE = 10
 
 
-def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal):
+def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal,
+        cloudClumpNdx=None):
     """
     Create 3-dimensional cloud objects from the cloud mask, and the thermal 
     information. Assumes a constant lapse rate to convert temperature into height.
@@ -861,6 +1475,9 @@ def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal)
     cloud object, and valueindexes.ValueIndexes object for use in extracting the location of 
     every pixel for a given cloud object. 
     
+    If cloudClumpNdx is given, it is used as the ValueIndexes object for the
+    clumps, and the clumps image itself is not needed, and may be None. 
+    
     """
     # Find out the pixel grid of the toareffile, so we can use that for RIOS.
     # this is necessary because the thermal might be on a different grid,
@@ -880,7 +1497,9 @@ def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal)
         infiles.toaRef = fmaskFilenames.toaRef
         
     otherargs.clumps = clumps
-    otherargs.cloudClumpNdx = valueindexes.ValueIndexes(clumps, nullVals=[0])
+    if cloudClumpNdx is None:
+        cloudClumpNdx = valueindexes.ValueIndexes(clumps, nullVals=[0])
+    otherargs.cloudClumpNdx = cloudClumpNdx
     otherargs.numClumps = numClumps
     otherargs.thermalInfo = fmaskConfig.thermalInfo
     
@@ -918,35 +1537,15 @@ def cloudShapeFunc(info, inputs, outputs, otherargs):
         bt = otherargs.thermalInfo.scaleThermalDNtoC(inputs.thermal)
         cloudShape = numpy.zeros(bt.shape, dtype=numpy.uint8)
         
-        cloudIDlist = otherargs.cloudClumpNdx.values
-        for cloudID in cloudIDlist:
-            cloudNdx = otherargs.cloudClumpNdx.getIndexes(cloudID)
-            btCloud = bt[cloudNdx]
-        
-            numPixInCloud = len(cloudNdx[0])
-        
-            # Equation 22, in several pieces
-            R = numpy.sqrt(numPixInCloud / (2 * numpy.pi))
-            if R >= 8:
-                percentile = 100.0 * (R - 8.0)**2 / (R**2)
-                Tcloudbase = scipy.stats.scoreatpercentile(btCloud, percentile)
-            else:
-                Tcloudbase = btCloud.min()
-        
-            # Equation 23
-            btCloud[btCloud>Tcloudbase] = Tcloudbase
-        
-            # Equation 24 (relative to cloud base). 
-            # N.B. Equation given in paper appears to be wrong, it multiplies by lapse
-            # rate instead of dividing by it. 
-            LAPSE_RATE_WET = 6.5        # degrees/km
-            Htop_relative = (Tcloudbase - btCloud) / LAPSE_RATE_WET
-        
-            # Put this back into the cloudShape array at the right place
-            cloudShape[cloudNdx] = numpy.round(Htop_relative * CLOUD_HEIGHT_SCALE).astype(numpy.uint8)
-        
-            # Save the Tcloudbase for this cloudID
-            cloudBaseTemp[cloudID] = Tcloudbase
+        # All clouds are done together, as segments of the packed indexes of the 
+        # cloudClumpNdx, in chunks of whole clouds so that the temporary 
+        # arrays stay a reasonable size
+        cloudClumpNdx = otherargs.cloudClumpNdx
+        for (firstCloud, lastCloud) in cloudChunks(cloudClumpNdx, CLOUDCHUNK_PIXELS):
+            Tcloudbase = cloudShapeChunk(bt, cloudShape, cloudClumpNdx, 
+                firstCloud, lastCloud)
+            # Save the Tcloudbase for these cloudIDs
+            cloudBaseTemp.update(zip(cloudClumpNdx.values[firstCloud:lastCloud], Tcloudbase))
     else:
         # fake it
         cloudShape = numpy.zeros(inputs.toaRef[0].shape, dtype=numpy.uint8)
@@ -955,6 +1554,114 @@ def cloudShapeFunc(info, inputs, outputs, otherargs):
     otherargs.cloudBaseTemp = cloudBaseTemp
 
 
+# Roughly how many cloud pixels to process at once, when doing all clouds together
+CLOUDCHUNK_PIXELS = 10000000
+
+
+def cloudChunks(cloudClumpNdx, maxPixels):
+    """
+    Generator to split the clouds in the cloudClumpNdx into chunks of whole
+    clouds, of up to about maxPixels pixels (but always at least one cloud). 
+    Yields (firstCloud, lastCloud) tuples, as positions in cloudClumpNdx.values,
+    with lastCloud being one past the end of the chunk. 
+    """
+    numClouds = len(cloudClumpNdx.values)
+    firstCloud = 0
+    while firstCloud < numClouds:
+        lastCloud = firstCloud + numpy.searchsorted(
+            cloudClumpNdx.end[firstCloud:] - cloudClumpNdx.start[firstCloud], 
+            maxPixels, side='right')
+        lastCloud = max(lastCloud, firstCloud + 1)
+        yield (firstCloud, lastCloud)
+        firstCloud = lastCloud
+
+
+def cloudShapeChunk(bt, cloudShape, cloudClumpNdx, firstCloud, lastCloud):
+    """
+    Calculate the cloud base temperature and the relative height of each
+    pixel for the clouds firstCloud to lastCloud-1 (positions in cloudClumpNdx.values),
+    all at once. The heights are put into the cloudShape array, and an array of 
+    the cloud base temperature of each cloud is returned. 
+    
+    The results are identical to doing each cloud separately, with 
+    scipy.stats.scoreatpercentile for the cloud base temperature. 
+    
+    """
+    counts = cloudClumpNdx.counts[firstCloud:lastCloud]
+    ndxStart = cloudClumpNdx.start[firstCloud]
+    ndxEnd = cloudClumpNdx.end[lastCloud - 1]
+    cloudNdx = (cloudClumpNdx.indexes[ndxStart:ndxEnd, 0], 
+        cloudClumpNdx.indexes[ndxStart:ndxEnd, 1])
+    btCloud = bt[cloudNdx]
+    
+    # Sort the temperatures within each cloud, by sorting on 
+    # the cloud number, then on temperature
+    segment = numpy.repeat(numpy.arange(len(counts)), counts)
+    btSorted = btCloud[numpy.lexsort((btCloud, segment))]
+    segmentStart = numpy.cumsum(counts) - counts
+    
+    # Equation 22, in several pieces. The percentile only depends on the number of
+    # pixels in the cloud, so work it out for each distinct count
+    (distinctCounts, countNdx) = numpy.unique(counts, return_inverse=True)
+    percentileParams = numpy.array([cloudBasePercentileParams(numPixInCloud) 
+        for numPixInCloud in distinctCounts]).reshape((-1, 4))
+    (offset, weightLow, weightHigh, weightSum) = percentileParams[countNdx.ravel()].T
+    offset = offset.astype(numpy.int64)
+    
+    lowNdx = segmentStart + offset
+    highNdx = numpy.minimum(lowNdx + 1, segmentStart + counts - 1)
+    Tcloudbase = ((btSorted[lowNdx] * weightLow + btSorted[highNdx] * weightHigh) / 
+        weightSum)
+    # Where the percentile is exactly on a pixel (or is the minimum), take the
+    # value as it is
+    exact = (weightHigh == 0)
+    Tcloudbase[exact] = btSorted[lowNdx[exact]]
+    
+    # Equation 23
+    TcloudbasePerPixel = Tcloudbase[segment]
+    numpy.minimum(btCloud, TcloudbasePerPixel, out=btCloud)
+    
+    # Equation 24 (relative to cloud base). 
+    # N.B. Equation given in paper appears to be wrong, it multiplies by lapse
+    # rate instead of dividing by it. 
+    LAPSE_RATE_WET = 6.5        # degrees/km
+    Htop_relative = (TcloudbasePerPixel - btCloud) / LAPSE_RATE_WET
+    
+    # Put this back into the cloudShape array at the right place
+    cloudShape[cloudNdx] = numpy.round(Htop_relative * CLOUD_HEIGHT_SCALE).astype(numpy.uint8)
+    
+    return Tcloudbase
+
+
+def cloudBasePercentileParams(numPixInCloud):
+    """
+    For a cloud of the given number of pixels, return the parameters to calculate
+    its cloud base temperature from its sorted temperatures (Equation 22), as
+    (offset, weightLow, weightHigh, weightSum). The cloud base is then
+    (sorted[offset] * weightLow + sorted[offset+1] * weightHigh) / weightSum. 
+    
+    Clouds of less than about 400 pixels use the minimum temperature, bigger
+    clouds use a percentile, interpolated in exactly the same way as 
+    scipy.stats.scoreatpercentile. 
+    
+    """
+    numPixInCloud = int(numPixInCloud)
+    R = numpy.sqrt(numPixInCloud / (2 * numpy.pi))
+    if R >= 8:
+        percentile = 100.0 * (R - 8.0)**2 / (R**2)
+        idx = percentile / 100. * (numPixInCloud - 1)
+        i = int(idx)
+        if i == idx:
+            params = (i, 1.0, 0.0, 1.0)
+        else:
+            j = i + 1
+            weights = numpy.array([(j - idx), (idx - i)], float)
+            params = (i, weights[0], weights[1], weights.sum())
+    else:
+        params = (0, 1.0, 0.0, 1.0)
+    return params
+
+
 METRES_PER_KM = 1000.0
 BYTES_PER_VOXEL = 4
 SOLIDCLOUD_MAXMEM = float(1024 * 1024 * 1024)
@@ -977,29 +1684,53 @@ def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
     # tell anglesInfo it may need to read data into memory
     fmaskConfig.anglesInfo.prepareForQuerying()
     
+    # The mean angles for every cloud
+    (sunZen, sunAz, satZen, satAz) = fmaskConfig.anglesInfo.getClumpAngles(cloudClumpNdx)
+    
+    # no more querying needed
+    fmaskConfig.anglesInfo.releaseMemory()
+    
     shadowShapesDict = {}
     
     cloudIDlist = cloudClumpNdx.values
-    for cloudID in cloudIDlist:
-        cloudNdx = cloudClumpNdx.getIndexes(cloudID)
-        
-        sunAz = fmaskConfig.anglesInfo.getSolarAzimuthAngle(cloudNdx)
-        sunZen = fmaskConfig.anglesInfo.getSolarZenithAngle(cloudNdx)
-        satAz = fmaskConfig.anglesInfo.getViewAzimuthAngle(cloudNdx)
-        satZen = fmaskConfig.anglesInfo.getViewZenithAngle(cloudNdx)
-        
-        # Cloudtop height of each pixel in cloud, in metres
-        cloudHgt = METRES_PER_KM * cloudShape[cloudNdx] / CLOUD_HEIGHT_SCALE
-        
-        # Relative (x, y) positions of each pixel in the cloud, in metres. Note 
-        # that the negative yRes flips the Y axis (which is what we want)
-        x = (cloudNdx[1] * xRes)
-        y = (cloudNdx[0] * yRes)
+    for (firstCloud, lastCloud) in cloudChunks(cloudClumpNdx, CLOUDCHUNK_PIXELS):
+        shadowNdxList = projectCloudShadows(cloudShape, cloudClumpNdx, firstCloud, lastCloud,
+            sunZen[firstCloud:lastCloud], sunAz[firstCloud:lastCloud], xRes, yRes, nrows, ncols)
         
-        maxHgt = numpy.ceil(cloudHgt.max() / xRes) * xRes
-        # Ensure we have at least one layer of voxels
-        maxHgt = max(maxHgt, xRes)
- 
+        # Stash these shapes in a dictionary, along with the corresponding sun and satellite angles
+        for i in range(firstCloud, lastCloud):
+            shadowShapesDict[cloudIDlist[i]] = (shadowNdxList[i - firstCloud], 
+                satAz[i], satZen[i], sunAz[i], sunZen[i])
+    
+    return shadowShapesDict
+
+
+def projectCloudShadows(cloudShape, cloudClumpNdx, firstCloud, lastCloud, sunZen, sunAz,
+        xRes, yRes, nrows, ncols):
+    """
+    Project the clouds firstCloud to lastCloud-1 (positions in cloudClumpNdx.values)
+    along the sun vector, all at once. The sunZen and sunAz arrays are the sun angles
+    of each of these clouds. 
+    
+    Returns a list of the shadow shapes, one per cloud, each as a tuple of
+    (rows, cols) arrays without any duplicate pixels. 
+    """
+    counts = cloudClumpNdx.counts[firstCloud:lastCloud]
+    ndxStart = cloudClumpNdx.start[firstCloud]
+    ndxEnd = cloudClumpNdx.end[lastCloud - 1]
+    cloudNdx = (cloudClumpNdx.indexes[ndxStart:ndxEnd, 0], 
+        cloudClumpNdx.indexes[ndxStart:ndxEnd, 1])
+    # The cloud number (within this chunk) of each pixel
+    segment = numpy.repeat(numpy.arange(len(counts)), counts)
+    
+    # Cloudtop height of each pixel in cloud, in metres
+    cloudHgt = METRES_PER_KM * cloudShape[cloudNdx] / CLOUD_HEIGHT_SCALE
+    
+    # Relative (x, y) positions of each pixel in the cloud, in metres. Note 
+    # that the negative yRes flips the Y axis (which is what we want)
+    x = (cloudNdx[1] * xRes)
+    y = (cloudNdx[0] * yRes)
+    
 # The following commented-out lines are the rigorous approach to constructing
 # the 3-dimensional shape of the cloud. The original paper is not clear about 
 # exactly how they code this, so I initially went for the most rigorous
@@ -1022,46 +1753,50 @@ def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
 #        d = z * numpy.tan(sunZen, dtype=numpy.float32)
 #        del z
 
-        # This is the much less rigorous approach to calculating the projected position
-        # of each part of the cloud. It only uses the top of the cloud on each pixel, 
-        # and assumes that this is sufficient to capture the whole cloud. For a very 
-        # tall thin cloud this might not be true, but I have yet to see an example of 
-        # it failing. It uses substantially less memory, so I am going with this for now. 
-        d = cloudHgt * numpy.tan(sunZen).astype(numpy.float32)
-
-        # (x', y') are coordinates of each voxel projected onto the plane of the cloud base,
-        # for every voxel in the solid cloud
-        xDash = x - d * float(numpy.sin(sunAz))
-        yDash = y - d * float(numpy.cos(sunAz))
-        del d, x, y
-        
-        # Turn these back into row/col coordinates
-        rows = (yDash / yRes).astype(numpy.uint32).clip(0, nrows - 1)
-        cols = (xDash / xRes).astype(numpy.uint32).clip(0, ncols - 1)
-        
-        # Make the row/col arrays have the right shape, and store as a single tuple
-        shadowNdx = (rows.flatten(), cols.flatten())
-        
-        # The row/cols can contain duplicates, as many 3-d points will project
-        # into the same 2-d location at cloudbase height. 
-        # So, we must remove the duplicates and give them the right shape. It seems
-        # that the most efficient way of doing this is to use them as indexes to 
-        # set pixels, then get back the indexes of the pixels which were set. Seems
-        # a bit roundabout, but I can't think of a better way. 
-        # Sadly, I have had to comment this bit out, as it makes the whole
-        # thing take several times as long. Obviously I need a better method of removing
-        # the duplicates. Sigh.....
-        # blankImg[shadowNdx] = True
-        # shadowNdx = numpy.where(blankImg)
-        # blankImg[shadowNdx] = False
-        
-        # Stash these shapes in a dictionary, along with the corresponding sun and satellite angles
-        shadowShapesDict[cloudID] = (shadowNdx, satAz, satZen, sunAz, sunZen)
-    
-    # no more querying needed
-    fmaskConfig.anglesInfo.releaseMemory()
-    
-    return shadowShapesDict
+    # This is the much less rigorous approach to calculating the projected position
+    # of each part of the cloud. It only uses the top of the cloud on each pixel, 
+    # and assumes that this is sufficient to capture the whole cloud. For a very 
+    # tall thin cloud this might not be true, but I have yet to see an example of 
+    # it failing. It uses substantially less memory, so I am going with this for now. 
+    # The sun angle terms are taken per cloud, with the same scalar arithmetic
+    # as when each cloud was projected on its own, so that the shadows land on
+    # exactly the same pixels (the array versions of the trig functions can
+    # differ in the last bit). 
+    tanSunZen = numpy.array([numpy.tan(zen).astype(numpy.float32) for zen in sunZen], 
+        dtype=numpy.float32)
+    sinSunAz = numpy.array([float(numpy.sin(az)) for az in sunAz], dtype=numpy.float64)
+    cosSunAz = numpy.array([float(numpy.cos(az)) for az in sunAz], dtype=numpy.float64)
+    d = cloudHgt * tanSunZen[segment]
+    del cloudHgt
+
+    # (x', y') are coordinates of each voxel projected onto the plane of the cloud base,
+    # for every voxel in the solid cloud
+    xDash = x - d * sinSunAz[segment]
+    yDash = y - d * cosSunAz[segment]
+    del d, x, y
+    
+    # Turn these back into row/col coordinates
+    rows = (yDash / yRes).astype(numpy.uint32).clip(0, nrows - 1)
+    cols = (xDash / xRes).astype(numpy.uint32).clip(0, ncols - 1)
+    del xDash, yDash
+    
+    # The row/cols can contain duplicates, as many 3-d points will project
+    # into the same 2-d location at cloudbase height. Remove them by taking the
+    # unique values of a single key for (cloud, row, col), which also comes out 
+    # sorted by cloud, so it is easily split up again. 
+    numPix = numpy.int64(nrows) * ncols
+    key = (segment * numPix + rows.astype(numpy.int64) * ncols) + cols
+    del segment, rows, cols
+    key = numpy.unique(key)
+    
+    (keySegment, pixNdx) = numpy.divmod(key, numPix)
+    del key
+    splitPoints = numpy.searchsorted(keySegment, numpy.arange(1, len(counts)))
+    rows = (pixNdx // ncols).astype(numpy.uint32)
+    cols = (pixNdx % ncols).astype(numpy.uint32)
+    
+    shadowNdxList = list(zip(numpy.split(rows, splitPoints), numpy.split(cols, splitPoints)))
+    return shadowNdxList
 
 
 def getIntersectionCoords(filelist):
@@ -1134,38 +1869,35 @@ def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile,
     proj = ds.GetProjection()
     del ds
     ds = gdal.Open(pass1file)
-    band = ds.GetRasterBand(5)
+    band = ds.GetRasterBand(PASS1_FLAGS_BAND + 1)
     (xoff, yoff) = topLeftDict[pass1file]
-    nullmask = band.ReadAsArray(xoff, yoff, ncols, nrows).astype(bool)
+    nullmask = getPass1Flag(band.ReadAsArray(xoff, yoff, ncols, nrows), PASS1_NULLMASK)
     del ds
 
-    (fd, interimShadowmask) = tempfile.mkstemp(prefix='matchedshadows', dir=fmaskConfig.tempDir, 
-                                        suffix=fmaskConfig.defaultExtension)
-    os.close(fd)
+    interimShadowmask = makeIntermediateFilename(fmaskConfig, 'matchedshadows')
     
     shadowmask = numpy.zeros(potentialShadow.shape, dtype=bool)
     
-    unmatchedCount = 0
-    cloudIDlist = shadowShapesDict.keys()
-    for cloudID in cloudIDlist:
-        shadowEntry = shadowShapesDict[cloudID]
-        if cloudID in cloudBaseTemp:
-            Tcloudbase = cloudBaseTemp[cloudID]
-        else:
-            Tcloudbase = 0
-
-        matchedShadowNdx = matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, 
-            Tlow, Thigh, xRes, yRes, cloudID, nullmask)
-        
-        if matchedShadowNdx is not None:
-            shadowmask[matchedShadowNdx] = True
-        else:
-            unmatchedCount += 1
+    # The shadow can only be matched on pixels which are neither cloud nor null
+    clearMask = ~(cloudmask | nullmask)
+    del cloudmask, nullmask
+    potentialShadow &= clearMask
+    
+    cloudIDlist = list(shadowShapesDict.keys())
+    if fmaskConfig.numWorkers > 1 and len(cloudIDlist) > 1:
+        unmatchedCount = matchShadowsParallel(clearMask, potentialShadow, shadowmask, 
+            shadowShapesDict, cloudBaseTemp, Tlow, Thigh, xRes, yRes, 
+            fmaskConfig.shadowMatchEarlyStop, fmaskConfig.numWorkers)
+    else:
+        shadowList = [(shadowShapesDict[cloudID], cloudBaseTemp.get(cloudID, 0))
+            for cloudID in cloudIDlist]
+        unmatchedCount = matchShadowBatch(clearMask, potentialShadow, shadowmask,
+            shadowList, Tlow, Thigh, xRes, yRes, fmaskConfig.shadowMatchEarlyStop)
 
     if fmaskConfig.verbose:
         print("No shadow found for %s of %s clouds " % (unmatchedCount, len(cloudIDlist)))
 
-    del potentialShadow, cloudmask, nullmask
+    del potentialShadow, clearMask
     
     # Now apply a 3-pixel buffer, as per section 3.2 (2nd-last paragraph)
     # I have the buffer size settable from the commandline, with our default
@@ -1176,8 +1908,8 @@ def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile,
     else:
         shadowmaskBuffered = shadowmask
 
-    driver = gdal.GetDriverByName(applier.DEFAULTDRIVERNAME)
-    creationOptions = applier.dfltDriverOptions[applier.DEFAULTDRIVERNAME]
+    (driverName, creationOptions) = getIntermediateDriver(fmaskConfig)
+    driver = gdal.GetDriverByName(driverName)
     ds = driver.Create(interimShadowmask, xsize, ysize, 1, gdal.GDT_Byte,
                 creationOptions)
     ds.SetProjection(proj)
@@ -1189,52 +1921,119 @@ def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile,
     return interimShadowmask
 
 
+def matchShadowBatch(clearMask, potentialShadow, shadowmask, shadowList, 
+        Tlow, Thigh, xRes, yRes, earlyStop):
+    """
+    Match each of a list of cloud shadow shapes to the potential shadow, 
+    setting the matched pixels in the shadowmask array. The shadowList is
+    a list of (shadowEntry, Tcloudbase) tuples. 
+    
+    Returns the number of shadows for which no match was found. 
+    
+    """
+    unmatchedCount = 0
+    for (shadowEntry, Tcloudbase) in shadowList:
+        matchedShadowNdx = matchOneShadowSparse(clearMask, shadowEntry, potentialShadow, 
+            Tcloudbase, Tlow, Thigh, xRes, yRes, earlyStop)
+        
+        if matchedShadowNdx is not None:
+            shadowmask[matchedShadowNdx] = True
+        else:
+            unmatchedCount += 1
+    return unmatchedCount
+
+
+# Number of batches of clouds per worker, when matching shadows in parallel. 
+# Having several helps to even out the load, as cloud sizes vary enormously. 
+SHADOW_MATCH_BATCHESPERWORKER = 4
+
+
+def matchShadowsParallel(clearMask, potentialShadow, shadowmask, shadowShapesDict,
+        cloudBaseTemp, Tlow, Thigh, xRes, yRes, earlyStop, numWorkers):
+    """
+    Same as matchShadowBatch, but spreads the clouds across a pool of 
+    numWorkers processes. The three whole-image arrays are written to memory
+    mapped scratch files (as RIOS does for its blocks, see 
+    :mod:`rios.parallel.blocktransport`), so they are not copied to each 
+    worker. The workers only ever set pixels to True in the shared shadowmask, 
+    so they cannot conflict. 
+    
+    The matched pixels are copied into the given shadowmask array. 
+    Returns the number of shadows for which no match was found. 
+    
+    """
+    # Spread the largest clouds across the batches first
+    cloudIDlist = sorted(shadowShapesDict.keys(), 
+        key=lambda cloudID: -len(shadowShapesDict[cloudID][0][0]))
+    numBatches = min(numWorkers * SHADOW_MATCH_BATCHESPERWORKER, len(cloudIDlist))
+    batchList = [cloudIDlist[i::numBatches] for i in range(numBatches)]
+
+    scratchDir = tempfile.mkdtemp(prefix='fmask_shadows_', 
+        dir=blocktransport.DEFAULT_BLOCKTRANSPORTDIR)
+    try:
+        sharedArrInfo = []
+        for (name, arr) in [('clear', clearMask), ('potentialshadow', potentialShadow), 
+                ('shadow', shadowmask)]:
+            filename = os.path.join(scratchDir, name + '.dat')
+            sharedArr = numpy.memmap(filename, dtype=arr.dtype, mode='w+', shape=arr.shape)
+            sharedArr[:] = arr
+            sharedArr.flush()
+            del sharedArr
+            sharedArrInfo.append((filename, arr.shape, arr.dtype.str))
+
+        with futures.ProcessPoolExecutor(max_workers=numWorkers) as pool:
+            futureList = []
+            for batch in batchList:
+                shadowList = [(shadowShapesDict[cloudID], cloudBaseTemp.get(cloudID, 0))
+                    for cloudID in batch]
+                futureList.append(pool.submit(matchSharedShadowBatch, sharedArrInfo,
+                    shadowList, Tlow, Thigh, xRes, yRes, earlyStop))
+            unmatchedCount = sum(fut.result() for fut in futureList)
+
+        (filename, shape, dtype) = sharedArrInfo[2]
+        sharedArr = numpy.memmap(filename, dtype=dtype, mode='r', shape=shape)
+        shadowmask[:] = sharedArr
+        del sharedArr
+    finally:
+        shutil.rmtree(scratchDir, ignore_errors=True)
+
+    return unmatchedCount
+
+
+def matchSharedShadowBatch(sharedArrInfo, shadowList, Tlow, Thigh, xRes, yRes, 
+        earlyStop):
+    """
+    Runs in a worker process for matchShadowsParallel. Maps the clearMask,
+    potentialShadow (read only) and shadowmask arrays from the scratch
+    files given by the (filename, shape, dtype) tuples in sharedArrInfo, 
+    and calls matchShadowBatch on them. 
+    
+    """
+    (clearMask, potentialShadow, shadowmask) = [
+        numpy.memmap(filename, dtype=dtype, mode=mode, shape=shape)
+        for ((filename, shape, dtype), mode) in zip(sharedArrInfo, ['r', 'r', 'r+'])]
+    unmatchedCount = matchShadowBatch(clearMask, potentialShadow, shadowmask, 
+        shadowList, Tlow, Thigh, xRes, yRes, earlyStop)
+    shadowmask.flush()
+    return unmatchedCount
+
+
 def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Thigh, 
         xRes, yRes, cloudID, nullmask):
     """
     Given the temperatures and sun angles for a single cloud object, and a shadow
     shape, search along the sun vector for a matching shadow object. 
     
+    This is the original, straightforward version of the search, which masks and
+    compares the whole bounding box of the shadow at each step. It is kept as 
+    the reference for :func:`matchOneShadowSparse`, which gives the same 
+    results much faster and is what :func:`matchShadows` uses. 
+    
     """
     (imgNrows, imgNcols) = cloudmask.shape
 
-    # Not enough clear land to work out temperature thresholds, so guess. 
-    if Tlow is None:
-        Tlow = 0.0
-    if Thigh is None:
-        Thigh = 10.0
-    
-    # Equation 21. Convert these to metres instead of kilometres
-    Hcloudbase_min = max(0.2, (Tlow - 4 - Tcloudbase) / 9.8) * METRES_PER_KM
-    Hcloudbase_max = min(12, (Thigh + 4 - Tcloudbase)) * METRES_PER_KM
-    
     # Entry for this cloud shadow object
-    (shapeNdx, satAz, satZen, sunAz, sunZen) = shadowEntry
-    
-    tanSunZen = numpy.tan(sunZen)
-    sinSunAz = numpy.sin(sunAz)
-    cosSunAz = numpy.cos(sunAz)
-    tanSatZen = numpy.tan(satZen)
-    sinSatAz = numpy.sin(satAz)
-    cosSatAz = numpy.cos(satAz)
-    
-    # We want to shift the cloud up, from Hcloudbase_min to Hcloudbase_max.
-    # Given the sun angles, this corresponds to shifting the shadow along
-    # the ground from Dmin to Dmax. 
-    Dmin = Hcloudbase_min * tanSunZen
-    Dmax = Hcloudbase_max * tanSunZen
-    
-    # This corresponds to the following offsets in X and Y
-    Xoff_min = Dmin * sinSunAz
-    Xoff_max = Dmax * sinSunAz
-    Yoff_min = Dmin * cosSunAz
-    Yoff_max = Dmax * cosSunAz
-    
-    # We want the step to be xRes in at least one direction. 
-    longestShift = max(abs(Xoff_max - Xoff_min), abs(Yoff_max - Yoff_min))
-    numSteps = max(1, int(numpy.ceil(longestShift / xRes)))      # Assumes square pixels
-    Xstep = (Xoff_max - Xoff_min) / numSteps
-    Ystep = (Yoff_max - Yoff_min) / numSteps
+    shapeNdx = shadowEntry[0]
     
     # shadowTemplate is a rectangle containing just the shadow shape to be shifted
     row0 = int(shapeNdx[0].min())
@@ -1246,26 +2045,12 @@ def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Th
     shadowTemplate[shapeNdx[0] - row0, shapeNdx[1] - col0] = True
     
     # Step this template across the potential shadows until we match. 
-    i = 0
     bestSimilarity = 0
     bestRC = (0, 0)
     bestOverlapRegion = None
-    for i in range(numSteps):
-        # Cloudbase height for this step
-        H = (Xoff_min + i * Xstep) / (tanSunZen * sinSunAz)
-        # Calculate the shift in the cloud position due to the view angle and the cloud elevation
-        D_viewoffset = H * tanSatZen
-        X_viewoffset = D_viewoffset * sinSatAz
-        Y_viewoffset = D_viewoffset * cosSatAz
-        
-        # Shadow shift in metres
-        Xoff = Xoff_min + i * Xstep - X_viewoffset
-        Yoff = Yoff_min + i * Ystep - Y_viewoffset
-        
-        # Shift in pixels. Note that negative yRes inverts the row axis
-        rowOff = int(Yoff / yRes)
-        colOff = int(Xoff / xRes)
-        
+    (rowOffList, colOffList) = shadowSearchOffsets(shadowEntry, Tcloudbase, Tlow, Thigh, 
+        xRes, yRes)
+    for (rowOff, colOff) in zip(rowOffList.tolist(), colOffList.tolist()):
         # Extract the potential shadow, and also the cloud, from the shifted region of
         # the full images
         r = row0 - rowOff
@@ -1302,7 +2087,7 @@ def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Th
                 bestSimilarity = similarity
                 bestOverlapRegion = overlap
     
-    if bestSimilarity > 0.3:
+    if bestSimilarity > SHADOW_MATCH_MINSIMILARITY:
         # We accept the match, now save the index for the pixels in the overlap region
         overlapNdx = numpy.where(bestOverlapRegion)
         matchedShadowNdx = (bestRC[0] + overlapNdx[0], bestRC[1] + overlapNdx[1])
@@ -1312,6 +2097,179 @@ def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Th
     return matchedShadowNdx
 
 
+# A shadow match is accepted if the best similarity is greater than this
+SHADOW_MATCH_MINSIMILARITY = 0.3
+# With the early stopping search, stop as soon as the similarity reaches this
+SHADOW_MATCH_STOPSIMILARITY = 0.95
+# Roughly how many shadow pixels to count at once, over several steps of the search
+SHADOW_MATCH_CHUNKPIXELS = 1000000
+
+
+def matchOneShadowSparse(clearMask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Thigh,
+        xRes, yRes, earlyStop=False):
+    """
+    Given the temperatures and sun angles for a single cloud object, and a shadow
+    shape, search along the sun vector for a matching shadow object. 
+    
+    The clearMask is True where pixels are neither cloud nor null, and the
+    potentialShadow must already be masked with it (i.e. False wherever 
+    clearMask is False). 
+    
+    Gives the same result as :func:`matchOneShadow`, but only looks at the pixels
+    of the shadow shape, rather than its whole bounding box, at each step of 
+    the search, by taking them straight from the flattened arrays. 
+    
+    If earlyStop is True, the search stops at the first step where the
+    similarity reaches SHADOW_MATCH_STOPSIMILARITY, or where the similarity
+    falls again after it has passed SHADOW_MATCH_MINSIMILARITY (i.e. at the
+    first acceptable peak), similar to the termination condition of 
+    Zhu & Woodcock. This is faster, but can give a different match. 
+    
+    """
+    (imgNrows, imgNcols) = clearMask.shape
+    clearFlat = clearMask.ravel()
+    potShadowFlat = potentialShadow.ravel()
+    
+    # The shadow shape, as offsets into the flattened image, from 
+    # the top left of its bounding box
+    shapeNdx = shadowEntry[0]
+    row0 = int(shapeNdx[0].min())
+    rowN = int(shapeNdx[0].max())
+    col0 = int(shapeNdx[1].min())
+    colN = int(shapeNdx[1].max())
+    (nrows, ncols) = ((rowN - row0 + 1), (colN - col0 + 1))
+    shapeRows = shapeNdx[0].astype(numpy.int64) - row0
+    shapeCols = shapeNdx[1].astype(numpy.int64) - col0
+    shapeOffsets = numpy.unique(shapeRows * imgNcols + shapeCols)
+    
+    # The positions of the shape at each step of the search, for those steps
+    # where it lies entirely within the image. Consecutive steps which land on 
+    # the same position are only counted once, as they cannot change the result. 
+    (rowOff, colOff) = shadowSearchOffsets(shadowEntry, Tcloudbase, Tlow, Thigh, 
+        xRes, yRes)
+    r = row0 - rowOff
+    c = col0 - colOff
+    inside = (r >= 0) & (r + nrows <= imgNrows) & (c >= 0) & (c + ncols <= imgNcols)
+    (r, c) = (r[inside], c[inside])
+    changed = numpy.ones(len(r), dtype=bool)
+    changed[1:] = (r[1:] != r[:-1]) | (c[1:] != c[:-1])
+    positions = list(zip(r[changed].tolist(), c[changed].tolist()))
+    
+    # Step this shape across the potential shadows until we match. The pixel counts
+    # are done for several steps at once, limiting the size of the arrays
+    stepsPerChunk = max(1, SHADOW_MATCH_CHUNKPIXELS // len(shapeOffsets))
+    bestSimilarity = 0
+    bestRC = (0, 0)
+    prevSimilarity = 0
+    stopSearch = False
+    chunkStart = 0
+    while chunkStart < len(positions) and not stopSearch:
+        chunkPositions = positions[chunkStart:chunkStart + stepsPerChunk]
+        chunkStart += stepsPerChunk
+        
+        shiftedOffsets = (numpy.array([r * imgNcols + c for (r, c) in chunkPositions])[:, numpy.newaxis] +
+            shapeOffsets)
+        # Calculate overlap area (by counting pixels)
+        overlapAreas = numpy.count_nonzero(potShadowFlat[shiftedOffsets], axis=1)
+        # Remaining area of shadow shape, excluding cloud and null
+        shadowAreas = numpy.count_nonzero(clearFlat[shiftedOffsets], axis=1)
+        del shiftedOffsets
+        
+        for i in range(len(chunkPositions)):
+            similarity = 0
+            if shadowAreas[i] > 0:
+                similarity = float(overlapAreas[i]) / shadowAreas[i]
+            
+            if similarity > bestSimilarity:
+                bestRC = chunkPositions[i]
+                bestSimilarity = similarity
+            
+            if earlyStop and (bestSimilarity >= SHADOW_MATCH_STOPSIMILARITY or
+                    (similarity < prevSimilarity and 
+                        bestSimilarity > SHADOW_MATCH_MINSIMILARITY)):
+                stopSearch = True
+                break
+            prevSimilarity = similarity
+    
+    if bestSimilarity > SHADOW_MATCH_MINSIMILARITY:
+        # We accept the match, now save the index for the pixels in the overlap
+        (r, c) = bestRC
+        bestOverlap = potShadowFlat[shapeOffsets + (r * imgNcols + c)]
+        overlapOffsets = shapeOffsets[bestOverlap]
+        matchedShadowNdx = (r + overlapOffsets // imgNcols, 
+            c + overlapOffsets % imgNcols)
+    else:
+        matchedShadowNdx = None
+    
+    return matchedShadowNdx
+
+
+def shadowSearchOffsets(shadowEntry, Tcloudbase, Tlow, Thigh, xRes, yRes):
+    """
+    Work out the steps of the search along the sun vector for the shadow
+    of a single cloud. Returns a tuple of arrays (rowOff, colOff), of the shift 
+    of the shadow shape, in pixels, for each step. 
+    
+    """
+    # Not enough clear land to work out temperature thresholds, so guess. 
+    if Tlow is None:
+        Tlow = 0.0
+    if Thigh is None:
+        Thigh = 10.0
+    
+    # Equation 21. Convert these to metres instead of kilometres
+    Hcloudbase_min = max(0.2, (Tlow - 4 - Tcloudbase) / 9.8) * METRES_PER_KM
+    Hcloudbase_max = min(12, (Thigh + 4 - Tcloudbase)) * METRES_PER_KM
+    
+    # Entry for this cloud shadow object
+    (shapeNdx, satAz, satZen, sunAz, sunZen) = shadowEntry
+    
+    tanSunZen = numpy.tan(sunZen)
+    sinSunAz = numpy.sin(sunAz)
+    cosSunAz = numpy.cos(sunAz)
+    tanSatZen = numpy.tan(satZen)
+    sinSatAz = numpy.sin(satAz)
+    cosSatAz = numpy.cos(satAz)
+    
+    # We want to shift the cloud up, from Hcloudbase_min to Hcloudbase_max.
+    # Given the sun angles, this corresponds to shifting the shadow along
+    # the ground from Dmin to Dmax. 
+    Dmin = Hcloudbase_min * tanSunZen
+    Dmax = Hcloudbase_max * tanSunZen
+    
+    # This corresponds to the following offsets in X and Y
+    Xoff_min = Dmin * sinSunAz
+    Xoff_max = Dmax * sinSunAz
+    Yoff_min = Dmin * cosSunAz
+    Yoff_max = Dmax * cosSunAz
+    
+    # We want the step to be xRes in at least one direction. 
+    longestShift = max(abs(Xoff_max - Xoff_min), abs(Yoff_max - Yoff_min))
+    numSteps = max(1, int(numpy.ceil(longestShift / xRes)))      # Assumes square pixels
+    Xstep = (Xoff_max - Xoff_min) / numSteps
+    Ystep = (Yoff_max - Yoff_min) / numSteps
+    
+    # All steps at once
+    i = numpy.arange(numSteps)
+    # Cloudbase height for this step
+    H = (Xoff_min + i * Xstep) / (tanSunZen * sinSunAz)
+    # Calculate the shift in the cloud position due to the view angle and the cloud elevation
+    D_viewoffset = H * tanSatZen
+    X_viewoffset = D_viewoffset * sinSatAz
+    Y_viewoffset = D_viewoffset * cosSatAz
+    
+    # Shadow shift in metres
+    Xoff = Xoff_min + i * Xstep - X_viewoffset
+    Yoff = Yoff_min + i * Ystep - Y_viewoffset
+    
+    # Shift in pixels (truncated, as int() would). Note that negative 
+    # yRes inverts the row axis
+    rowOff = (Yoff / yRes).astype(numpy.int64)
+    colOff = (Xoff / xRes).astype(numpy.int64)
+    
+    return (rowOff, colOff)
+
+
 def finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask, 
         pass1file):
     """
@@ -1339,6 +2297,7 @@ def finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask
     if fmaskConfig.cloudBufferSize > 0:
         otherargs.bufferkernel = makeBufferKernel(fmaskConfig.cloudBufferSize)
 
+    setParallelControls(controls, fmaskConfig)
     applier.apply(maskAndBuffer, infiles, outfiles, otherargs, controls=controls)
     
     rat.setColorTable(outfiles.out, numpy.array([[2, 255, 0, 255, 255],
@@ -1373,13 +2332,14 @@ def maskAndBuffer(info, inputs, outputs, otherargs):
            mask, even after buffering, etc. 
     
     """
-    snow = inputs.pass1[5].astype(bool)
-    nullmask = inputs.pass1[4].astype(bool)
+    flags = inputs.pass1[PASS1_FLAGS_BAND]
+    snow = getPass1Flag(flags, PASS1_SNOWMASK)
+    nullmask = getPass1Flag(flags, PASS1_NULLMASK)
     resetNullmask = nullmask
 
     cloud = inputs.cloud[0].astype(bool)
     shadow = inputs.shadow[0].astype(bool)
-    water = inputs.pass1[1].astype(bool)
+    water = getPass1Flag(flags, PASS1_WATERTEST)
     
     # Buffer the cloud
     if hasattr(otherargs, 'bufferkernel'):
@@ -1435,6 +2395,57 @@ def calcCDI(ref, fmaskConfig, refBands):
     return (ratio8a8, ratio8a7, v8a8, v8a7, cdi)
 
 
+#: GDAL driver and creation options for intermediate rasters held in memory. 
+#: These are not compressed, as the point is to save time. 
+MEMORY_INTERMEDIATE_DRIVER = 'GTiff'
+MEMORY_INTERMEDIATE_CREATIONOPTIONS = ['TILED=YES', 'INTERLEAVE=BAND', 'BIGTIFF=IF_SAFER']
+
+
+def makeIntermediateFilename(fmaskConfig, prefix):
+    """
+    Return a new filename for an intermediate raster, starting with the 
+    given prefix. If fmaskConfig.intermediatesInMemory is set, this is in 
+    GDAL's /vsimem/ in-memory filesystem, otherwise it is a new temporary 
+    file in fmaskConfig.tempDir. 
+    
+    """
+    if fmaskConfig.intermediatesInMemory:
+        filename = '/vsimem/fmask/{}{}.tif'.format(prefix, uuid.uuid4().hex)
+    else:
+        (fd, filename) = tempfile.mkstemp(prefix=prefix, dir=fmaskConfig.tempDir, 
+            suffix=fmaskConfig.defaultExtension)
+        os.close(fd)
+    return filename
+
+
+def getIntermediateDriver(fmaskConfig):
+    """
+    Return a tuple of (driverName, creationOptions) to use when
+    creating intermediate rasters with GDAL. 
+    
+    """
+    if fmaskConfig.intermediatesInMemory:
+        driverInfo = (MEMORY_INTERMEDIATE_DRIVER, MEMORY_INTERMEDIATE_CREATIONOPTIONS)
+    else:
+        driverInfo = (applier.DEFAULTDRIVERNAME, 
+            applier.dfltDriverOptions[applier.DEFAULTDRIVERNAME])
+    return driverInfo
+
+
+def setIntermediateOutputDriver(controls, fmaskConfig, imagename):
+    """
+    Set up the given RIOS controls to write the named output as an 
+    intermediate raster. This only changes anything when they are
+    held in memory, as the RIOS default driver might not be able to 
+    write to /vsimem/ (e.g. KEA). 
+    
+    """
+    if fmaskConfig.intermediatesInMemory:
+        (driverName, creationOptions) = getIntermediateDriver(fmaskConfig)
+        controls.setOutputDriverName(driverName, imagename)
+        controls.setCreationOptions(creationOptions, imagename)
+
+
 def deleteRaster(filename):
     """
     Use GDAL's Driver.Delete() method to fully delete the given raster file
@@ -25,6 +25,8 @@ import numpy
 from osgeo import gdal
 from rios import applier, cuiprogress, fileinfo
 from . import config
+from . import landsatangles
+from . import saturationcheck
 
 gdal.UseExceptions()
 
@@ -205,3 +207,93 @@ def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
     ds = gdal.Open(outfile, gdal.GA_Update)
     for i in range(ds.RasterCount):
         ds.GetRasterBand(i + 1).SetNoDataValue(otherinputs.outNull)
+
+
+def riosAnglesSaturationTOA(info, inputs, outputs, otherinputs):
+    """
+    Called from RIOS
+
+    Runs :func:`fmask.landsatangles.makeAngles`, 
+    :func:`fmask.saturationcheck.riosSaturationMask` and :func:`riosTOA`
+    on the same block of the input radiance. The angles are passed
+    straight on to the TOA calculation, as they would have been read
+    back from the angles file. 
+
+    """
+    landsatangles.makeAngles(info, inputs, outputs, otherinputs)
+    inputs.angles = outputs.angles
+
+    if otherinputs.doSaturation:
+        inputs.radiance = inputs.infile
+        saturationcheck.riosSaturationMask(info, inputs, outputs, otherinputs)
+
+    riosTOA(info, inputs, outputs, otherinputs)
+
+
+def makeAnglesSaturationTOA(infile, mtlFile, anglesfile, saturationfile, outfile,
+        fmaskConfig, nadirLine, extentSunAngles, satAzimuth):
+    """
+    Does the same as :func:`fmask.landsatangles.makeAnglesImage`, 
+    :func:`fmask.saturationcheck.makeSaturationMask` and 
+    :func:`makeTOAReflectance`, but in a single pass over the input
+    radiance image, so it is read only once and the angles image is not 
+    read back for the TOA reflectance. 
+
+    The anglesfile, saturationfile and outfile are written with the same 
+    contents as the separate functions would give. The saturationfile 
+    may be None, in which case no saturation mask is made. The fmaskConfig
+    is used to determine which bands are visible, and the nadirLine, 
+    extentSunAngles and satAzimuth are as for 
+    :func:`fmask.landsatangles.makeAnglesImage`. 
+
+    """
+    mtlInfo = config.readMTLFile(mtlFile)
+    spaceCraft = mtlInfo['SPACECRAFT_ID']
+    date = mtlInfo['DATE_ACQUIRED']
+    date = date.replace('-', '')
+    imgInfo = fileinfo.ImageInfo(infile)
+
+    inputs = applier.FilenameAssociations()
+    inputs.infile = infile
+
+    outputs = applier.FilenameAssociations()
+    outputs.angles = anglesfile
+    outputs.outfile = outfile
+    if saturationfile is not None:
+        outputs.mask = saturationfile
+
+    otherinputs = applier.OtherInputs()
+    # For the angles
+    (ctrLat, ctrLong) = landsatangles.getCtrLatLong(imgInfo)
+    otherinputs.R = landsatangles.localRadius(ctrLat)
+    otherinputs.nadirLine = nadirLine
+    otherinputs.xMin = imgInfo.xMin
+    otherinputs.xMax = imgInfo.xMax
+    otherinputs.yMin = imgInfo.yMin
+    otherinputs.yMax = imgInfo.yMax
+    otherinputs.extentSunAngles = extentSunAngles
+    otherinputs.satAltitude = 705000      # Landsat nominal altitude in metres
+    otherinputs.satAzimuth = satAzimuth
+    otherinputs.radianScale = 100        # Store pixel values as (radians * radianScale)
+    # For the saturation mask
+    otherinputs.doSaturation = (saturationfile is not None)
+    otherinputs.radianceBands = fmaskConfig.bands
+    # For the TOA reflectance
+    otherinputs.earthSunDistance = earthSunDistance(date)
+    otherinputs.earthSunDistanceSq = otherinputs.earthSunDistance * otherinputs.earthSunDistance
+    otherinputs.esun = ESUN_LOOKUP[spaceCraft]
+    gains, offsets = readGainsOffsets(mtlInfo)
+    otherinputs.gains = gains
+    otherinputs.offsets = offsets
+    otherinputs.anglesToRadians = 1.0 / otherinputs.radianScale
+    otherinputs.outNull = 32767
+    otherinputs.inNull = imgInfo.nodataval[0]
+
+    controls = applier.ApplierControls()
+    controls.progress = cuiprogress.GDALProgressBar()
+    controls.setStatsIgnore(500, imagename='angles')
+    controls.setStatsIgnore(otherinputs.outNull, imagename='outfile')
+    controls.setCalcStats(False)
+    controls.setOmitPyramids(True)
+
+    applier.apply(riosAnglesSaturationTOA, inputs, outputs, otherinputs, controls=controls)
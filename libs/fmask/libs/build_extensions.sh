@@ -0,0 +1,29 @@
+#!/usr/bin/env bash
+#
+# Build the fmask C extensions (_fillminima and _valueindexes) from src/ for
+# the given python (default python3), and install them in
+# libs/fmask/lin64_py<version> and in libs/fmask, where fmask imports them.
+#
+#   bash libs/fmask/libs/build_extensions.sh [python]
+#
+# Needed after changes to the C sources, e.g. the _fillminima that fills
+# without holding the GIL, which fillMinimaTiled needs to use threads.
+
+set -e
+
+PYTHON=${1:-python3}
+LIBS_DIR=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+FMASK_DIR=$(dirname "$LIBS_DIR")
+PY_VERSION=$($PYTHON -c 'import sys; print("%d%d" % sys.version_info[:2])')
+BUILD_DIR=$(mktemp -d)
+trap 'rm -rf "$BUILD_DIR"' EXIT
+
+cd "$LIBS_DIR"
+$PYTHON setup.py build_ext --build-lib "$BUILD_DIR/lib" --build-temp "$BUILD_DIR/temp"
+
+mkdir -p "$FMASK_DIR/lin64_py$PY_VERSION"
+for NAME in _fillminima _valueindexes; do
+    cp "$BUILD_DIR"/lib/fmask/$NAME*.so "$FMASK_DIR/lin64_py$PY_VERSION/$NAME.so"
+    cp "$BUILD_DIR"/lib/fmask/$NAME*.so "$FMASK_DIR/$NAME.so"
+done
+echo "Installed the fmask extensions for python $PY_VERSION"
@@ -21,7 +21,12 @@ import glob
 
 # If we fail to import the numpy version of setup(), still try to proceed, as it is possibly
 # because we are being run by ReadTheDocs, and so we just need to be able to generate documentation. 
-from numpy.distutils.core import setup, Extension
+# numpy.distutils is gone from numpy 2 and Python 3.12, where setuptools is used instead. 
+import numpy
+try:
+    from numpy.distutils.core import setup, Extension
+except ImportError:
+    from setuptools import setup, Extension
 
 # When building the sdist on Linux we want the extra .bat
 # files that are need for the Windows install. 
@@ -33,9 +38,11 @@ NUMPY_MACROS = ('NPY_NO_DEPRECATED_API', 'NPY_1_7_API_VERSION')
 # This is for a normal build
 fillminimaC = Extension(name='_fillminima',
             define_macros=[NUMPY_MACROS],
+            include_dirs=[numpy.get_include()],
             sources=['src/fillminima.c'])
 valueIndexesC = Extension(name='_valueindexes',
             define_macros=[NUMPY_MACROS],
+            include_dirs=[numpy.get_include()],
             sources=['src/valueindexes.c'])
 extensionsList = [fillminimaC, valueIndexesC]
 
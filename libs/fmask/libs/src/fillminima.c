@@ -46,16 +46,19 @@ static struct FillMinimaState _state;
 #endif
 
 /* Routines for handling the hierarchical pixel queue which the
-   algorithm requires.
+   algorithm requires. Each level of the queue is a FIFO held in a 
+   growable array, rather than a linked list of separately allocated 
+   pixels, so that adding and removing pixels is cheap. None of these 
+   routines touch any Python objects, so they can all be run without 
+   holding the GIL.
 */
-typedef struct PQstruct {
-    int i, j;
-    struct PQstruct *next;
+typedef struct {
+    npy_int32 i, j;
 } PQel;
     
 typedef struct {
-    PQel *first, *last;
-    int n;
+    PQel *pix;
+    npy_intp first, last, size;
 } PQhdr;
     
 typedef struct PQ {
@@ -64,161 +67,172 @@ typedef struct PQ {
     PQhdr *q;
 } PixelQueue;
     
-/* A new pixel structure */
-static PQel *newPix(int i, int j) {
-    PQel *p;
-        
-    p = (PQel *)calloc(1, sizeof(PQel));
-    p->i = i;
-    p->j = j;
-    p->next = NULL;
-    if (i>20000) {
-        printf("i=%d\\n", i);
-        exit(1);
-    }
-    return p;
-}
-    
-/* Initialize pixel queue */
+/* Initialize pixel queue. Returns NULL if out of memory */
 static PixelQueue *PQ_init(int hMin, int hMax) {
     PixelQueue *pixQ;
-    int numLevels, i;
+    int numLevels;
         
     pixQ = (PixelQueue *)calloc(1, sizeof(PixelQueue));
+    if (pixQ == NULL) {
+        return NULL;
+    }
     numLevels = hMax - hMin + 1;
     pixQ->hMin = hMin;
     pixQ->numLevels = numLevels;
+    /* calloc leaves every level empty, with no storage */
     pixQ->q = (PQhdr *)calloc(numLevels, sizeof(PQhdr));
-    for (i=0; i<numLevels; i++) {
-        pixQ->q[i].first = NULL;
-        pixQ->q[i].last = NULL;
-        pixQ->q[i].n = 0;
+    if (pixQ->q == NULL) {
+        free(pixQ);
+        return NULL;
     }
     return pixQ;
 }
+
+/* Free the pixel queue, and all its levels */
+static void PQ_free(PixelQueue *pixQ) {
+    int i;
+
+    for (i=0; i<pixQ->numLevels; i++) {
+        free(pixQ->q[i].pix);
+    }
+    free(pixQ->q);
+    free(pixQ);
+}
     
-/* Add a pixel at level h */
-static void PQ_add(PixelQueue *pixQ, PQel *p, int h) {
+/* Add a pixel at level h. Returns 0 on success, or an error code */
+#define PQ_OK 0
+#define PQ_NOMEMORY 1
+#define PQ_BADLEVEL 2
+static int PQ_add(PixelQueue *pixQ, npy_int32 i, npy_int32 j, int h) {
     int ndx;
-    PQel *current, *newP;
+    npy_intp newSize;
+    PQel *newPix;
     PQhdr *thisQ;
         
-    /* Take a copy of the pixel structure */
-    newP = newPix(p->i, p->j);
-        
     ndx = h - pixQ->hMin;
-    if (ndx > pixQ->numLevels) {
-        printf("Level h=%d too large. ndx=%d, numLevels=%d\\n", h, ndx, pixQ->numLevels);
-        exit(1);
-    }
-    if (ndx < 0) {
-        printf("Ndx is negative, which is not allowed. ndx=%d, h=%d, hMin=%d\n", ndx, h, pixQ->hMin);
-        exit(1);
+    if ((ndx < 0) || (ndx >= pixQ->numLevels)) {
+        return PQ_BADLEVEL;
     }
     thisQ = &(pixQ->q[ndx]);
-    /* Add to end of queue at this level */
-    current = thisQ->last;
-    if (current != NULL) {
-        current->next = newP;
-    }
-    thisQ->last = newP;
-    thisQ->n++;
-    /* If head of queue is NULL, make the new one the head */
-    if (thisQ->first == NULL) {
-        thisQ->first = newP;
+    if (thisQ->last == thisQ->size) {
+        if (thisQ->first > 0) {
+            /* Reclaim the space at the front, from pixels already removed */
+            memmove(thisQ->pix, thisQ->pix + thisQ->first, 
+                (thisQ->last - thisQ->first) * sizeof(PQel));
+            thisQ->last -= thisQ->first;
+            thisQ->first = 0;
+        }
+        if (thisQ->last == thisQ->size) {
+            newSize = (thisQ->size > 0) ? (2 * thisQ->size) : 64;
+            newPix = (PQel *)realloc(thisQ->pix, newSize * sizeof(PQel));
+            if (newPix == NULL) {
+                return PQ_NOMEMORY;
+            }
+            thisQ->pix = newPix;
+            thisQ->size = newSize;
+        }
     }
+    /* Add to end of queue at this level */
+    thisQ->pix[thisQ->last].i = i;
+    thisQ->pix[thisQ->last].j = j;
+    thisQ->last++;
+    return PQ_OK;
 }
     
 /* Return TRUE if queue at level h is empty */
 static int PQ_empty(PixelQueue *pixQ, int h) {
-    int ndx, empty, n;
-    PQel *current;
-        
-    ndx = h - pixQ->hMin;
-    current = pixQ->q[ndx].first;
-    n = pixQ->q[ndx].n;
-    empty = (current == NULL);
-    if (empty && (n != 0)) {
-        printf("Empty, but n=%d\\n", n);
-        exit(1);
-    }
-    if ((n == 0) && (! empty)) {
-        printf("n=0, but not empty\\n");
-        while (current != NULL) {
-            printf("    h=%d i=%d j=%d\\n", h, current->i, current->j);
-            current = current->next;
-        }
-        exit(1);
-    }
-    return empty;
+    PQhdr *thisQ;
+
+    thisQ = &(pixQ->q[h - pixQ->hMin]);
+    return (thisQ->first == thisQ->last);
 }
     
 /* Return the first element in the queue at level h, and remove it
-   from the queue */
-static PQel *PQ_first(PixelQueue *pixQ, int h) {
-    int ndx;
-    PQel *current;
+   from the queue. The queue must not be empty. */
+static PQel PQ_first(PixelQueue *pixQ, int h) {
     PQhdr *thisQ;
+    PQel p;
         
-    ndx = h - pixQ->hMin;
-    thisQ = &(pixQ->q[ndx]);
-    current = thisQ->first;
-    /* Remove from head of queue */
-    if (current != NULL) {
-        thisQ->first = current->next;
-        if (thisQ->first == NULL) {
-            thisQ->last = NULL;
-        }
-        thisQ->n--;
-        if (thisQ->n < 0) {
-            printf("n=%d in PQ_first()\\n", thisQ->n);
-            exit(1);
-        } else if (thisQ->n == 0) {
-            if (thisQ->first != NULL) {
-                printf("n=0, but 'first' != NULL. first(i,j) = %d,%d\\n", 
-                    thisQ->first->i, thisQ->first->j);
-            }
-        }
+    thisQ = &(pixQ->q[h - pixQ->hMin]);
+    p = thisQ->pix[thisQ->first];
+    thisQ->first++;
+    if (thisQ->first == thisQ->last) {
+        /* Now empty, so start again from the front */
+        thisQ->first = 0;
+        thisQ->last = 0;
     }
-    return current;
+    return p;
 }
     
-/* Return a list of neighbouring pixels to given pixel p.  */
-static PQel *neighbours(PQel *p, int nRows, int nCols) {
-    int ii, jj, i, j;
-    PQel *pl, *pNew;
-        
-    pl = NULL;
-    for (ii=-1; ii<=1; ii++) {
-        for (jj=-1; jj<=1; jj++) {
-            if ((ii != 0) && (jj != 0)) {
-                i = p->i + ii;
-                j = p->j + jj;
-                if ((i >= 0) && (i < nRows) && (j >= 0) && (j < nCols)) {
-                    pNew = newPix(i, j);
-                    pNew->next = pl;
-                    pl = pNew;
+#define max(a,b) ((a) > (b) ? (a) : (b))
+
+/* The flood itself. Does not touch any Python objects, so is called 
+   without holding the GIL. Returns PQ_OK, or an error code */
+static int fillFromBoundary(PyArrayObject *pimg, PyArrayObject *pimg2, int hMin, int hMax,
+        PyArrayObject *pNullMask, double dBoundaryVal, PyArrayObject *pBoundaryRows, 
+        PyArrayObject *pBoundaryCols)
+{
+    npy_int64 r, c;
+    npy_intp i, nRows, nCols;
+    npy_int16 imgval, img2val;
+    PixelQueue *pixQ;
+    PQel p;
+    int hCrt, ii, jj, status;
+
+    nRows = PyArray_DIMS(pimg)[0];
+    nCols = PyArray_DIMS(pimg)[1];
+    
+    pixQ = PQ_init(hMin, hMax);
+    if (pixQ == NULL) {
+        return PQ_NOMEMORY;
+    }
+    
+    /* Initialize the boundary */
+    status = PQ_OK;
+    for (i=0; (i<PyArray_DIMS(pBoundaryRows)[0]) && (status == PQ_OK); i++) {
+        r = *((npy_int64*)PyArray_GETPTR1(pBoundaryRows, i));
+        c = *((npy_int64*)PyArray_GETPTR1(pBoundaryCols, i));
+        *((npy_int16*)PyArray_GETPTR2(pimg2, r, c)) = dBoundaryVal;
+        status = PQ_add(pixQ, r, c, dBoundaryVal);
+    }
+    
+    /* Process until stability */
+    hCrt = (int)hMin;
+    while ((hCrt < hMax) && (status == PQ_OK)) {
+        while ((! PQ_empty(pixQ, hCrt)) && (status == PQ_OK)) {
+            p = PQ_first(pixQ, hCrt);
+            /* Note that, as it always has, this only visits the four diagonal 
+               neighbours of each pixel */
+            for (ii=-1; ii<=1; ii+=2) {
+                for (jj=-1; jj<=1; jj+=2) {
+                    r = p.i + ii;
+                    c = p.j + jj;
+                    /* Exclude null area of original image */
+                    if ((r >= 0) && (r < nRows) && (c >= 0) && (c < nCols) &&
+                            (! *((npy_bool*)PyArray_GETPTR2(pNullMask, r, c)))) {
+                        imgval = *((npy_int16*)PyArray_GETPTR2(pimg, r, c));
+                        img2val = *((npy_int16*)PyArray_GETPTR2(pimg2, r, c));
+                        if ((img2val == hMax) && (status == PQ_OK)) {
+                            img2val = max(hCrt, imgval);
+                            *((npy_int16*)PyArray_GETPTR2(pimg2, r, c)) = img2val;
+                            status = PQ_add(pixQ, r, c, img2val);
+                        }
+                    }
                 }
             }
         }
+        hCrt++;
     }
-    return pl;
+    
+    PQ_free(pixQ);
+    return status;
 }
 
-#define max(a,b) ((a) > (b) ? (a) : (b))
-
 static PyObject *fillminima_fillMinima(PyObject *self, PyObject *args)
 {
     PyArrayObject *pimg, *pimg2, *pBoundaryRows, *pBoundaryCols, *pNullMask;
-    int hMin, hMax;
+    int hMin, hMax, status;
     double dBoundaryVal;
-
-    npy_int64 r, c;
-    npy_intp i, nRows, nCols;
-    npy_int16 imgval, img2val;
-    PixelQueue *pixQ;
-    PQel *p, *nbrs, *pNbr, *pNext;
-    int hCrt;
     
     if( !PyArg_ParseTuple(args, "OOiiOdOO:fillMinima", &pimg, &pimg2, &hMin, &hMax,
                             &pNullMask, &dBoundaryVal, &pBoundaryRows, &pBoundaryCols))
@@ -249,55 +263,23 @@ static PyObject *fillminima_fillMinima(PyObject *self, PyObject *args)
         return NULL;
     }
 
-    nRows = PyArray_DIMS(pimg)[0];
-    nCols = PyArray_DIMS(pimg)[1];
-    
-    pixQ = PQ_init(hMin, hMax);
-    
-    /* Initialize the boundary */
-    for (i=0; i<PyArray_DIMS(pBoundaryRows)[0]; i++) {
-        r = *((npy_int*)PyArray_GETPTR1(pBoundaryRows, i));
-        c = *((npy_int*)PyArray_GETPTR1(pBoundaryCols, i));
-        //img2(r, c) = img(r, c);
-        *((npy_int16*)PyArray_GETPTR2(pimg2, r, c)) = dBoundaryVal;
-        
-        p = newPix(r, c);
-        //h = img(r, c);
-        //PQ_add(pixQ, p, img(r, c));
-        PQ_add(pixQ, p, dBoundaryVal);
+    /* All the real work is done without the GIL, so several images (or
+       tiles of an image) can be filled at once from different threads */
+    Py_BEGIN_ALLOW_THREADS
+    status = fillFromBoundary(pimg, pimg2, hMin, hMax, pNullMask, dBoundaryVal, 
+                            pBoundaryRows, pBoundaryCols);
+    Py_END_ALLOW_THREADS
+
+    if( status == PQ_NOMEMORY )
+    {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    else if( status == PQ_BADLEVEL )
+    {
+        PyErr_SetString(GETSTATE(self)->error, "boundary value outside the range hMin to hMax");
+        return NULL;
     }
-    
-    
-    /* Process until stability */
-    hCrt = (int)hMin;
-    do {
-        while (! PQ_empty(pixQ, hCrt)) {
-            p = PQ_first(pixQ, hCrt);
-            nbrs = neighbours(p, nRows, nCols);
-            pNbr = nbrs;
-            while (pNbr != NULL) {
-                r = pNbr->i;
-                c = pNbr->j;
-                /* Exclude null area of original image */
-                if (! *((npy_bool*)PyArray_GETPTR2(pNullMask, r, c))) {
-                    imgval = *((npy_int16*)PyArray_GETPTR2(pimg, r, c));
-                    img2val = *((npy_int16*)PyArray_GETPTR2(pimg2, r, c));
-                    if (img2val == hMax) {
-                        img2val = max(hCrt, imgval);
-                        *((npy_int16*)PyArray_GETPTR2(pimg2, r, c)) = img2val;
-                        PQ_add(pixQ, pNbr, img2val);
-                    }
-                }
-                pNext = pNbr->next;
-                free(pNbr);
-                pNbr = pNext;
-            }
-            free(p);
-        }
-        hCrt++;
-    } while (hCrt < hMax);
-    
-    free(pixQ);
 
     Py_RETURN_NONE;
 }
@@ -381,6 +363,13 @@ struct FillMinimaState *state;
         INITERROR;
     }
 
+    // Tell fillminima.fillMinimaTiled that tiles can be filled in threads
+    if( PyModule_AddIntConstant(pModule, "RELEASES_GIL", 1) != 0 )
+    {
+        Py_DECREF(pModule);
+        INITERROR;
+    }
+
 #if PY_MAJOR_VERSION >= 3
     return pModule;
 #endif
@@ -0,0 +1,157 @@
+"""
+Timing and memory profile of the stages of fmask. An instance of
+StageProfiler is given to :func:`fmask.config.FmaskConfig.setProfiler`,
+and after :func:`fmask.fmask.doFmask` has run, its records attribute
+has one dictionary per stage, with the wall and CPU time, the bytes read
+and written and the peak resident memory of that stage.
+
+The bytes read and written, and the peak resident memory, are only
+available on Linux (from /proc/self), elsewhere they are None. They
+are for the main process only, and so do not include the work done by
+any worker processes (see :func:`fmask.config.FmaskConfig.setNumWorkers`),
+although their CPU time is included once they have finished.
+
+"""
+
+# This file is part of 'python-fmask' - a cloud masking module
+# Copyright (C) 2015  Neil Flood
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from __future__ import print_function, division
+
+import os
+import time
+import contextlib
+
+#: Fields of each record of a StageProfiler, after any tags
+RECORD_FIELDS = ['stage', 'wallTime', 'cpuTime', 'bytesRead', 'bytesWritten',
+    'peakRSS']
+
+
+class StageProfiler(object):
+    """
+    Records the profile of each stage run within its stage() context
+    manager. Stages should not be nested, as the peak memory is reset
+    at the start of each one.
+
+    The tags dictionary is added to each record, e.g. to say which scene
+    the stages belong to.
+
+    """
+    def __init__(self, **tags):
+        self.records = []
+        self.tags = tags
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager to record the profile of the code it wraps, as the
+        given stage name.
+        """
+        resetPeakRSS()
+        (readStart, writtenStart) = readIOCounters()
+        cpuStart = cpuTime()
+        wallStart = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = dict(self.tags)
+            record['stage'] = name
+            record['wallTime'] = time.perf_counter() - wallStart
+            record['cpuTime'] = cpuTime() - cpuStart
+            (readEnd, writtenEnd) = readIOCounters()
+            record['bytesRead'] = None
+            record['bytesWritten'] = None
+            if readStart is not None and readEnd is not None:
+                record['bytesRead'] = readEnd - readStart
+                record['bytesWritten'] = writtenEnd - writtenStart
+            record['peakRSS'] = readPeakRSS()
+            self.records.append(record)
+
+
+def stage(profiler, name):
+    """
+    Return a context manager to profile the given stage with profiler,
+    or one which does nothing if profiler is None.
+
+    """
+    if profiler is None:
+        context = noStage()
+    else:
+        context = profiler.stage(name)
+    return context
+
+
+@contextlib.contextmanager
+def noStage():
+    """
+    A context manager which does nothing, for when there is no profiler
+    (contextlib.nullcontext needs Python 3.7)
+    """
+    yield
+
+
+def cpuTime():
+    """
+    CPU time (user and system) of this process, and its finished child processes
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def readIOCounters():
+    """
+    Return a tuple of (bytesRead, bytesWritten) by this process so far,
+    including those served from or to the file system cache. They are
+    None if not available.
+
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                (name, value) = line.split(':')
+                counters[name] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return (counters.get('rchar'), counters.get('wchar'))
+
+
+def resetPeakRSS():
+    """
+    Reset the peak resident memory of this process (Linux 4.0 or later),
+    so that readPeakRSS gives the peak from now on.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def readPeakRSS():
+    """
+    Return the peak resident memory of this process in bytes, since the
+    last resetPeakRSS, or None if not available.
+    """
+    peakRSS = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peakRSS = int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return peakRSS
@@ -131,15 +131,7 @@ class ValueIndexes(object):
         self.start = self.end - self.counts
         
         if len(self.values) > 0:
-            # A lookup table to make searching for a value very fast.
-            valrange = numpy.array([self.values.min(), self.values.max()])
-            numLookups = valrange[1] - valrange[0] + 1
-            maxUint32 = 2**32 - 1
-            if numLookups > maxUint32:
-                raise RangeError("Range of different values is too great for uint32")
-            self.valLU = numpy.zeros(numLookups, dtype=numpy.uint32)
-            self.valLU.fill(maxUint32)     # A value to indicate "not found", must match _valndxFunc below
-            self.valLU[self.values - self.values[0]] = range(len(self.values))
+            valrange = self.makeValueLookup()
 
             # For use within C. For each value, the current index 
             # into the indexes array. A given element is incremented whenever it finds
@@ -149,6 +141,81 @@ class ValueIndexes(object):
             _valueindexes.valndxFunc(a, self.indexes, valrange[0], valrange[1], 
                         self.valLU, currentIndex)
 
+    @classmethod
+    def fromValueCounts(cls, values, counts, nDims, nullVals=[]):
+        """
+        Creates a ValueIndexes object for the given values, with room for 
+        the given count of indexes for each value, without needing the 
+        original array. The indexes are then filled in with addIndexes(), 
+        which can be done a piece at a time (e.g. a strip of an image at 
+        a time), so the whole of the original array is never needed. 
+        
+        The values must be in increasing order, and should not include
+        any null values. 
+        
+        """
+        self = cls.__new__(cls)
+        if numpy.isscalar(nullVals):
+            self.nullVals = [nullVals]
+        else:
+            self.nullVals = nullVals
+
+        self.values = numpy.asarray(values)
+        self.counts = numpy.asarray(counts, dtype=numpy.int64)
+        self.nDims = nDims
+        self.indexes = numpy.zeros((self.counts.sum(), nDims), dtype=numpy.uint32)
+        self.end = self.counts.cumsum()
+        self.start = self.end - self.counts
+        # Where the next index of each value goes, for addIndexes()
+        self.nextIndex = self.start.copy()
+
+        if len(self.values) > 0:
+            self.makeValueLookup()
+        return self
+
+    def addIndexes(self, pixVals, indexes):
+        """
+        For an object made with fromValueCounts(), add the indexes of some 
+        more pixels. The pixVals array gives the value of each pixel, and 
+        indexes is an array of shape (numPixels, nDims) giving the index of
+        each pixel in the original array. The pixels must not have null values. 
+        
+        The indexes of each value are kept in the order they are added, so 
+        if all pixels are added in the order in which they occur in the 
+        original array, the result is the same as constructing from the 
+        original array. 
+        
+        """
+        if len(pixVals) == 0:
+            return
+        valNdx = self.valLU[pixVals - self.values[0]].astype(numpy.int64)
+        # A stable sort keeps the pixels of each value in their given order
+        sortNdx = numpy.argsort(valNdx, kind='stable')
+        valNdx = valNdx[sortNdx]
+        (uniqueNdx, firstPos, runCounts) = numpy.unique(valNdx, return_index=True, 
+            return_counts=True)
+        # Position of each pixel within the run of its value
+        runPos = numpy.arange(len(valNdx)) - numpy.repeat(firstPos, runCounts)
+        self.indexes[self.nextIndex[valNdx] + runPos] = indexes[sortNdx]
+        self.nextIndex[uniqueNdx] += runCounts
+
+    def makeValueLookup(self):
+        """
+        Make the valLU lookup table, used to find each value in the values 
+        array without explicitly searching. Returns the range of values, as 
+        an array of [min, max]. 
+        
+        """
+        valrange = numpy.array([self.values.min(), self.values.max()])
+        numLookups = valrange[1] - valrange[0] + 1
+        maxUint32 = 2**32 - 1
+        if numLookups > maxUint32:
+            raise RangeError("Range of different values is too great for uint32")
+        self.valLU = numpy.zeros(numLookups, dtype=numpy.uint32)
+        self.valLU.fill(maxUint32)     # A value to indicate "not found", must match _valndxFunc
+        self.valLU[self.values - self.values[0]] = range(len(self.values))
+        return valrange
+
     def getIndexes(self, val):
         """
         Return a set of indexes into the original array, for which the
@@ -23,6 +23,15 @@ point of entry in this module.
 
 import os
 import sys
+import itertools
+import shutil
+import tempfile
+import threading
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
 
 import numpy
 from osgeo import gdal
@@ -36,12 +45,15 @@ from . import vectorreader
 from . import calcstats
 from . import rat
 from .parallel import jobmanager
+from .parallel import blocktransport
 
 # All default values, etc., copied in from their appropriate rios modules. 
 DEFAULT_RESAMPLEMETHOD = "near"
 DEFAULTFOOTPRINT = imagereader.DEFAULTFOOTPRINT
 DEFAULTWINDOWXSIZE = imagereader.DEFAULTWINDOWXSIZE
 DEFAULTWINDOWYSIZE = imagereader.DEFAULTWINDOWYSIZE
+AUTOWINDOW = imagereader.AUTOWINDOW
+"Window size which follows the native block layout of the inputs"
 DEFAULTOVERLAP = imagereader.DEFAULTOVERLAP
 DEFAULTLOGGINGSTREAM = imagereader.DEFAULTLOGGINGSTREAM
 DEFAULTDRIVERNAME = imagewriter.DEFAULTDRIVERNAME
@@ -75,6 +87,21 @@ Whether to use VRTs for resampling inputs. Set by RIOS_NO_VRT_FOR_RESAMPLING
 environment variable. Default is True.
 """
 
+# For overlapping the reading and writing of blocks with the processing
+# of the current block. See ApplierControls.setPipelineIO()
+DEFAULT_PIPELINEIO = os.getenv('RIOS_DFLT_PIPELINEIO', default='0') != '0'
+"""
+Whether to read and write blocks in separate threads, while the current
+block is processed. Set by RIOS_DFLT_PIPELINEIO environment variable. 
+Default is False.
+"""
+DEFAULT_PIPELINEQUEUESIZE = int(os.getenv('RIOS_DFLT_PIPELINEQUEUESIZE', default=2))
+"Default number of blocks waiting to be processed, and to be written, when pipelining"
+
+# With a job manager with dynamicScheduling, the number of blocks running 
+# at once is this many times the number of threads
+JOBWINDOWFACTOR = 2
+
 if sys.version_info[0] > 2:
     # hack for Python 3 which uses str instead of basestring
     # we just use basestring
@@ -130,8 +157,8 @@ class ApplierControls(object):
     has methods for setting each of them to something else. 
     
     Attributes are:
-        * **windowxsize**     X size of rios block (pixels)
-        * **windowysize**     Y size of rios block (pixels)
+        * **windowxsize**     X size of rios block (pixels, or AUTOWINDOW)
+        * **windowysize**     Y size of rios block (pixels, or AUTOWINDOW)
         * **overlap**         Number of pixels in margin for block overlaps
         * **footprint**       :data:`rios.applier.INTERSECTION` or :data:`rios.applier.UNION` or :data:`rios.applier.BOUNDS_FROM_REFERENCE`
         * **drivername**      GDAL driver short name for output
@@ -153,9 +180,14 @@ class ApplierControls(object):
         * **resampleMethod**  String for resample method, when required (as per GDAL)
         * **numThreads**      Number of parallel threads used for processing each image block
         * **jobManagerType**  Which :class:`rios.parallel.jobmanager.JobManager` sub-class to use for parallel processing (by name)
+        * **persistentJobManager** True/False to keep the job manager (and its workers) for re-use by later calls
+        * **blockTransportDir** Directory for scratch files passing blocks to and from worker processes, or None to pickle them
+        * **reduceFunction**  Function called in the main process with the outputs of each block, to combine results into otherArgs
         * **autoColorTableType** Type of color table to be automatically added to thematic output rasters
         * **allowOverviewsGdalwarp** Allow use of overviews in input resample (dangerous, do not use)
         * **approxStats**       Allow approx stats (much faster)
+        * **pipelineIO**      True/False to read and write blocks in threads, while the current block is processed
+        * **pipelineQueueSize** Number of blocks held waiting to be processed, and to be written, when pipelining
     
     Options relating to vector input files
         * **burnvalue**       Value to burn into raster from vector
@@ -201,9 +233,14 @@ class ApplierControls(object):
         self.resampleMethod = DEFAULT_RESAMPLEMETHOD
         self.numThreads = 1
         self.jobManagerType = os.getenv('RIOS_DFLT_JOBMGRTYPE', default=None)
+        self.persistentJobManager = False
+        self.blockTransportDir = blocktransport.DEFAULT_BLOCKTRANSPORTDIR
+        self.reduceFunction = None
         self.autoColorTableType = DEFAULT_AUTOCOLORTABLETYPE
         self.allowOverviewsGdalwarp = False
         self.approxStats = False
+        self.pipelineIO = DEFAULT_PIPELINEIO
+        self.pipelineQueueSize = DEFAULT_PIPELINEQUEUESIZE
 
         # Vector fields
         self.burnvalue = 1
@@ -287,6 +324,13 @@ class ApplierControls(object):
         """
         Set the X size of the blocks used. Images are processed in 
         blocks (windows) of 'windowxsize' columns, and 'windowysize' rows. 
+        
+        Either size can be AUTOWINDOW, which works it out from the native
+        block layout of the input images, so that each of their strips or 
+        tiles is read just once (see 
+        :meth:`rios.imagereader.ImageReader.findAutoWindowSize`). With 
+        striped inputs the blocks are the full width of the image. 
+        The default can be set with $RIOS_DFLT_BLOCKXSIZE=auto. 
         """
         self.windowxsize = windowxsize
         
@@ -294,6 +338,7 @@ class ApplierControls(object):
         """
         Set the Y size of the blocks used. Images are processed in 
         blocks (windows) of 'windowxsize' columns, and 'windowysize' rows. 
+        Can be AUTOWINDOW, see setWindowXsize(). 
         """
         self.windowysize = windowysize
         
@@ -525,8 +570,10 @@ class ApplierControls(object):
         of imagery. Note that these are not threads in the technical sense, 
         but are handled by the JobManager class, and are some form of 
         cooperating parallel processes, depending on the type of job 
-        manager sub-class selected. See :mod:`rios.parallel.jobmanager` 
-        for full details. Note that this is only worth using on very 
+        manager sub-class selected (except for the 'threads' job manager, 
+        which does use threads in the current process). See 
+        :mod:`rios.parallel.jobmanager` for full details. Note that this 
+        is only worth using on very 
         computationally-intensive tasks. Default is 1, i.e. no parallel 
         processing. 
         
@@ -542,6 +589,56 @@ class ApplierControls(object):
         """
         self.jobManagerType = jobMgrType
     
+    def setPersistentJobManager(self, persistentJobManager):
+        """
+        If True, the job manager used for parallel processing (see 
+        setNumThreads), and its workers, are kept after apply() has finished, 
+        and re-used by later calls with the same jobManagerType and 
+        numThreads, instead of starting new ones for each call. They are 
+        shut down at exit, or by 
+        :func:`rios.parallel.jobmanager.shutdownPersistentJobManagers`. 
+        
+        Note that the worker processes of the multiprocessing job manager
+        are started by the first call, so the user functions of later calls
+        must be importable by them, i.e. not defined after the first call 
+        in the main script. Default is False. 
+        
+        """
+        self.persistentJobManager = persistentJobManager
+    
+    def setBlockTransportDir(self, blockTransportDir):
+        """
+        Set the directory for the memory mapped scratch files through which
+        the large blocks are passed to and from the worker processes of 
+        the job managers which run them on this machine (subproc and 
+        multiprocessing), instead of pickling them. See 
+        :mod:`rios.parallel.blocktransport`. This should be on a memory 
+        file system. If None, the blocks are pickled. 
+        
+        Default is taken from $RIOS_BLOCKTRANSPORT_DIR, or /dev/shm if 
+        that exists. 
+        
+        """
+        self.blockTransportDir = blockTransportDir
+    
+    def setReduceFunction(self, reduceFunction):
+        """
+        Set a function to combine results from each block into the otherArgs
+        object. When processing in parallel, the user function runs on a copy 
+        of otherArgs, so any changes it makes to otherArgs are lost. Instead,
+        the user function can put its results for the block as extra attributes
+        on the outputs object (i.e. not among the output image names), and
+        the reduceFunction is then called in the main process as::
+        
+            reduceFunction(otherArgs, outputs)
+        
+        once for each block, in block order, to accumulate them. 
+        This works the same with or without parallel processing. 
+        Default is None, i.e. no reduce function. 
+        
+        """
+        self.reduceFunction = reduceFunction
+    
     def setAutoColorTableType(self, autoColorTableType, imagename=None):
         """
         If this option is set, then thematic raster outputs will have a
@@ -596,6 +693,35 @@ class ApplierControls(object):
         thematic rasters)
         """
         self.approxStats = approxStats
+    
+    def setPipelineIO(self, pipelineIO, queueSize=None):
+        """
+        If True, the input blocks are read ahead in a separate thread, and 
+        the output blocks are written in another thread, while the current
+        block is being processed. The reading of the next blocks and the 
+        writing of the previous ones are then overlapped with the 
+        processing, which mostly hides the time spent on I/O, e.g. on slow 
+        network storage. At most queueSize blocks are held waiting to be 
+        processed, and at most queueSize are held waiting to be written, so 
+        the extra memory used is bounded. The user function is called in 
+        the same way, in the main thread, and the outputs are still 
+        written in block order. 
+        
+        This works with or without a job manager (see setNumThreads). As 
+        the GDAL datasets of the inputs are being read in the other thread, 
+        the user function cannot use them. The 'no data' values are saved 
+        with each block, so info.getNoDataValueFor() still works, but 
+        info.getGDALDatasetFor(), info.getGDALBandFor(), and 
+        info.getAttributeColumn() and the info.global_* functions (unless
+        already cached), raise DatasetNotAvailableError. 
+        
+        Default is taken from $RIOS_DFLT_PIPELINEIO, or False if not set, 
+        and the default queueSize from $RIOS_DFLT_PIPELINEQUEUESIZE, or 2.
+        
+        """
+        self.pipelineIO = pipelineIO
+        if queueSize is not None:
+            self.pipelineQueueSize = queueSize
 
 
 def apply(userFunction, infiles, outfiles, otherArgs=None, controls=None):
@@ -650,6 +776,10 @@ def apply(userFunction, infiles, outfiles, otherArgs=None, controls=None):
 
     There is a page dedicated to :doc:`applierexamples`.
 
+    If controls.pipelineIO is set, the blocks are read and written in 
+    separate threads, overlapping with the processing (see 
+    :meth:`rios.applier.ApplierControls.setPipelineIO`). 
+
     """
     # Get default controls object if none given. 
     if controls is None:
@@ -681,53 +811,267 @@ def apply(userFunction, infiles, outfiles, otherArgs=None, controls=None):
     if controls.numThreads > 1:
         jobmgr = jobmanager.getJobMgrObject(controls)
 
-    done = False
-    iterator = reader.__iter__()
-    while not done:
-        # list of RIOSJobInfo
-        jobInputs = []
+    # Scratch files passing the blocks to and from worker processes, if any. 
+    # All in one directory for this call, which is removed at the end
+    blockTransportDir = None
+    if (jobmgr is not None and jobmgr.localWorkers and 
+            controls.blockTransportDir is not None):
+        blockTransportDir = tempfile.mkdtemp(prefix='rios_blocks_', 
+            dir=controls.blockTransportDir)
+
+    blockIterator = iterInputBlocks(reader, vecreader)
+    prefetcher = None
+    blockWriter = None
+    if controls.pipelineIO:
+        # read ahead, and write behind, in their own threads
+        prefetcher = BlockPrefetcher(blockIterator, controls.pipelineQueueSize)
+        blockIterator = iter(prefetcher)
+        blockWriter = BlockWriter(writerdict, outfiles, controls, controls.pipelineQueueSize)
 
-        for n in range(controls.numThreads):
-            try:
-                info, blockdict = iterator.__next__()
-            except StopIteration:
-                done = True
-                break
+    try:
+        for (info, outputBlocks) in iterOutputBlocks(userFunction, blockIterator,
+                otherArgs, controls, jobmgr, blockTransportDir):
+            if blockWriter is None:
+                writeOutputBlocks(writerdict, outfiles, outputBlocks, 
+                            controls, info)
+            else:
+                blockWriter.write(outputBlocks, info)
+            if controls.reduceFunction is not None:
+                controls.reduceFunction(otherArgs, outputBlocks)
+
+            lastpercent = updateProgress(controls, info, lastpercent)
+    except BaseException:
+        # stop the threads, without hiding the original error
+        if prefetcher is not None:
+            prefetcher.stop()
+        if blockWriter is not None:
+            blockWriter.stop()
+        raise
+    else:
+        if prefetcher is not None:
+            prefetcher.stop()
+        if blockWriter is not None:
+            # wait for the last blocks to be written
+            blockWriter.finish()
+    finally:
+        if blockTransportDir is not None:
+            shutil.rmtree(blockTransportDir, ignore_errors=True)
 
-            inputBlocks = BlockAssociations()
-            inputBlocks.__dict__.update(blockdict)
-            if vecreader is not None:
-                vecblocks = vecreader.rasterize(info)
-                inputBlocks.__dict__.update(vecblocks)
+    if controls.progress is not None:
+        controls.progress.setProgress(100)
 
-            # build a RIOSJobInfo with the params
-            jobInfo = RIOSJobInfo(info, inputBlocks, otherArgs)
-            jobInputs.append(jobInfo)
+    closeOutputImages(writerdict, outfiles, controls)
 
-        if len(jobInputs) == 0:
-            break
 
-        # Now call the function with those args
-        if jobmgr is None:
-            # single threaded - just call it
+def iterInputBlocks(reader, vecreader):
+    """
+    Called by :func:`rios.applier.apply`. Generator of (info, inputBlocks)
+    for each block of the reader, with the rasterized vectors (if any) 
+    added to the inputBlocks. 
+    """
+    for (info, blockdict) in reader:
+        inputBlocks = BlockAssociations()
+        inputBlocks.__dict__.update(blockdict)
+        if vecreader is not None:
+            vecblocks = vecreader.rasterize(info)
+            inputBlocks.__dict__.update(vecblocks)
+        yield (info, inputBlocks)
+
+
+def iterOutputBlocks(userFunction, blockIterator, otherArgs, controls, jobmgr,
+        blockTransportDir=None):
+    """
+    Called by :func:`rios.applier.apply`. Generator of (info, outputBlocks)
+    for each (info, inputBlocks) from blockIterator, in the same order, 
+    running the user function on them. 
+    
+    Without a job manager, the blocks are done one at a time, in this 
+    process. With a job manager with dynamicScheduling, a window of 
+    blocks is kept running, and the next block is started as each one 
+    finishes. Otherwise, the blocks are run in batches of numThreads. 
+    
+    If blockTransportDir is given, the blocks are passed to and from the
+    worker processes in scratch files there (see 
+    :mod:`rios.parallel.blocktransport`). 
+    
+    """
+    jobInputs = (RIOSJobInfo(info, inputBlocks, otherArgs, blockTransportDir) 
+        for (info, inputBlocks) in blockIterator)
+
+    if jobmgr is None:
+        # single threaded - just call it
+        for jobInfo in jobInputs:
             params = jobInfo.getFunctionParams()
             userFunction(*params)
-            outputBlocks = jobInfo.getFunctionResult(params)
-            writeOutputBlocks(writerdict, outfiles, outputBlocks, 
-                            controls, info)
+            yield (jobInfo.info, jobInfo.getFunctionResult(params))
+    elif jobmgr.dynamicScheduling:
+        windowSize = controls.numThreads * JOBWINDOWFACTOR
+        for (jobInfo, outputBlocks) in jobmgr.runSubJobsInOrder(userFunction, 
+                jobInputs, windowSize):
+            jobInfo.releaseSharedBlocks(outputBlocks)
+            yield (jobInfo.info, outputBlocks)
+    else:
+        # multi threaded - get the job manager to run batches of jobs
+        while True:
+            batch = list(itertools.islice(jobInputs, controls.numThreads))
+            if len(batch) == 0:
+                break
+            outBlocksList = jobmgr.runSubJobs(userFunction, batch)
+            for (jobInfo, outputBlocks) in zip(batch, outBlocksList):
+                jobInfo.releaseSharedBlocks(outputBlocks)
+                yield (jobInfo.info, outputBlocks)
+
+
+class BlockPrefetcher(object):
+    """
+    Reads the input blocks ahead, in a separate thread, for 
+    :func:`rios.applier.apply` when pipelining (see 
+    :meth:`rios.applier.ApplierControls.setPipelineIO`). Iterating over 
+    this object gives the same (info, inputBlocks) as the given 
+    blockIterator, in the same order. At most queueSize blocks are 
+    read ahead. Any exception raised when reading is raised again when 
+    iterating. 
+    
+    """
+    # Seconds between checks for stop() while waiting on the queue
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, blockIterator, queueSize):
+        self.blockQueue = queue.Queue(maxsize=max(1, queueSize))
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(blockIterator,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, blockIterator):
+        """
+        Runs in the reading thread. Each item on the queue is a tuple 
+        of (block, exception), and None when there are no more blocks. 
+        
+        Before a block is queued, the info takes a snapshot of what it 
+        needs from the datasets, as they will be read again by this 
+        thread while the block is processed. 
+        """
+        try:
+            for block in blockIterator:
+                (info, inputBlocks) = block
+                info.snapshotDatasets(iterBlockArrays(inputBlocks))
+                if not self.put((block, None)):
+                    return
+        except Exception as e:
+            self.put((None, e))
+            return
+        self.put(None)
+
+    def put(self, item):
+        """
+        Put the item on the queue, waiting for room. Returns False if 
+        stopped while waiting.
+        """
+        while not self.stopEvent.is_set():
+            try:
+                self.blockQueue.put(item, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self.blockQueue.get()
+            if item is None:
+                return
+            (block, exception) = item
+            if exception is not None:
+                raise exception
+            yield block
+
+    def stop(self):
+        """
+        Stop reading, and wait for the reading thread to finish
+        """
+        self.stopEvent.set()
+        self.thread.join()
+
+
+def iterBlockArrays(inputBlocks):
+    """
+    Generator of all the arrays in the given 
+    :class:`rios.applier.BlockAssociations`, including those in lists
+    """
+    for value in inputBlocks.__dict__.values():
+        if isinstance(value, list):
+            for block in value:
+                yield block
         else:
-            # multi threaded - get the job manager to run jobs
-            outBlocksList = jobmgr.runSubJobs(userFunction, jobInputs)
-            for outputBlocks in outBlocksList:
-                writeOutputBlocks(writerdict, outfiles, outputBlocks, 
-                            controls, info)
+            yield value
 
-        lastpercent = updateProgress(controls, info, lastpercent)
 
-    if controls.progress is not None:
-        controls.progress.setProgress(100)
+class BlockWriter(object):
+    """
+    Writes the output blocks with :func:`rios.applier.writeOutputBlocks`, 
+    in a separate thread, for :func:`rios.applier.apply` when pipelining 
+    (see :meth:`rios.applier.ApplierControls.setPipelineIO`). The blocks 
+    are written in the order they are given to write(), with at most 
+    queueSize blocks waiting. An exception raised when writing is raised 
+    again by the next call to write() or finish(), and any remaining 
+    blocks are then discarded. 
+    
+    """
+    def __init__(self, writerdict, outfiles, controls, queueSize):
+        self.writerdict = writerdict
+        self.outfiles = outfiles
+        self.controls = controls
+        self.exception = None
+        self.blockQueue = queue.Queue(maxsize=max(1, queueSize))
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
 
-    closeOutputImages(writerdict, outfiles, controls)
+    def run(self):
+        """
+        Runs in the writing thread, until given None
+        """
+        while True:
+            item = self.blockQueue.get()
+            if item is None:
+                return
+            if self.exception is None:
+                (outputBlocks, info) = item
+                try:
+                    writeOutputBlocks(self.writerdict, self.outfiles, outputBlocks, 
+                        self.controls, info)
+                except Exception as e:
+                    self.exception = e
+
+    def checkException(self):
+        """
+        Raise any exception from the writing thread
+        """
+        if self.exception is not None:
+            raise self.exception
+
+    def write(self, outputBlocks, info):
+        """
+        Queue the output blocks to be written
+        """
+        self.checkException()
+        self.blockQueue.put((outputBlocks, info))
+
+    def stop(self):
+        """
+        Wait for the queued blocks to be written, and the writing thread 
+        to finish. 
+        """
+        self.blockQueue.put(None)
+        self.thread.join()
+
+    def finish(self):
+        """
+        As stop(), and then raise any exception from the writing
+        """
+        self.stop()
+        self.checkException()
 
 
 def closeOutputImages(writerdict, outfiles, controls):
@@ -978,22 +1322,34 @@ class RIOSJobInfo(jobmanager.JobInfo):
     Class that contains information for parameters to a RIOS
     function
     """
-    def __init__(self, info, inputs, otherargs=None):
+    def __init__(self, info, inputs, otherargs=None, blockTransportDir=None):
         self.info = info
         self.inputs = inputs
         self.otherargs = otherargs
         # we don't bother pickling the outputs - start again 
         # with a fresh BlockAssociations
+        
+        # Directory for the scratch files passing the blocks to and from
+        # another process, or None to pickle them. See rios.parallel.blocktransport
+        self.blockTransportDir = blockTransportDir
+        # The scratch files of the input blocks, once they are shared
+        self.sharedFiles = None
 
     def prepareForPickling(self):
         """
         GDAL datasets cannot be pickled
         and neither stderr (in info.logginstream)
         so we clean up the info object a bit
+        
+        The large input blocks are put in scratch files, if 
+        there is a blockTransportDir. 
 
         """
         self.info.blocklookup = {}
         self.info.loggingstream = None
+        if self.blockTransportDir is not None:
+            self.sharedFiles = blocktransport.shareBlocks(self.inputs, 
+                self.blockTransportDir)
         return self
 
     def getFunctionParams(self):
@@ -1007,6 +1363,8 @@ class RIOSJobInfo(jobmanager.JobInfo):
         """
         if self.info.loggingstream is None:
             self.info.loggingstream = imagereader.DEFAULTLOGGINGSTREAM
+        if self.sharedFiles is not None:
+            blocktransport.unshareBlocks(self.inputs)
         outputs = BlockAssociations()
         params = (self.info, self.inputs, outputs)
         if self.otherargs is not None:
@@ -1017,7 +1375,24 @@ class RIOSJobInfo(jobmanager.JobInfo):
     def getFunctionResult(self, params):
         """
         Return the ouputs parameter
+        
+        If the input blocks came in scratch files, the large
+        output blocks are returned the same way. 
+
+        """
+        outputs = params[2]
+        if self.sharedFiles is not None:
+            blocktransport.shareBlocks(outputs, self.blockTransportDir)
+        return outputs
+
+    def releaseSharedBlocks(self, outputs):
+        """
+        Called in the main process once the job is done. Removes the 
+        scratch files of the input blocks, and replaces any shared output 
+        blocks with their arrays, removing their scratch files too. 
 
         """
-        return params[2]
+        if self.sharedFiles is not None:
+            blocktransport.removeFiles(self.sharedFiles)
+            blocktransport.unshareBlocks(outputs, remove=True)
 
@@ -22,6 +22,7 @@ Contains the ImageReader class
 import os
 import sys
 import copy
+import math
 import numpy
 
 from . import imageio
@@ -36,12 +37,54 @@ if sys.version_info[0] > 2:
 
 DEFAULTFOOTPRINT = int(os.getenv('RIOS_DFLT_FOOTPRINT', 
                             default=imageio.INTERSECTION))
-DEFAULTWINDOWXSIZE = int(os.getenv('RIOS_DFLT_BLOCKXSIZE', default=256))
-DEFAULTWINDOWYSIZE = int(os.getenv('RIOS_DFLT_BLOCKYSIZE', default=256))
+AUTOWINDOW = 'auto'
+"Window size which follows the native block layout of the inputs, see ImageReader.findAutoWindowSize()"
+AUTOWINDOWPIXELS = int(os.getenv('RIOS_AUTOWINDOW_PIXELS', default=262144))
+"Approximate number of pixels in a window chosen with AUTOWINDOW"
+
+
+def windowSizeFromEnv(name, default):
+    """
+    Window size from the given environment variable, either a 
+    number of pixels or AUTOWINDOW
+    """
+    windowsize = os.getenv(name, default=str(default))
+    if windowsize != AUTOWINDOW:
+        windowsize = int(windowsize)
+    return windowsize
+
+
+DEFAULTWINDOWXSIZE = windowSizeFromEnv('RIOS_DFLT_BLOCKXSIZE', 256)
+DEFAULTWINDOWYSIZE = windowSizeFromEnv('RIOS_DFLT_BLOCKYSIZE', 256)
 DEFAULTOVERLAP = int(os.getenv('RIOS_DFLT_OVERLAP', default=0))
 DEFAULTLOGGINGSTREAM = sys.stdout
 
 
+def lowestCommonMultiple(values):
+    """
+    Lowest common multiple of the given list of positive integers
+    """
+    multiple = 1
+    for value in values:
+        (a, b) = (multiple, value)
+        while b != 0:
+            (a, b) = (b, a % b)
+        multiple = multiple * value // a
+    return multiple
+
+
+def autoWindowLength(blockLength, targetLength, regionLength):
+    """
+    Length of a window along one axis, for AUTOWINDOW. This is the 
+    largest power of 2 times blockLength which is no more than targetLength
+    (but is at least blockLength), limited to regionLength. 
+    """
+    length = blockLength
+    while length * 2 <= targetLength:
+        length *= 2
+    return max(1, min(length, regionLength))
+
+
 class ImageIterator(object):
     """
     Class to allow iteration across an ImageReader instance.
@@ -121,7 +164,9 @@ class ImageReader(object):
         footprint can be either INTERSECTION, UNION or BOUNDS_FROM_REFERENCE
         
         windowxsize and windowysize specify the size
-        of the block to be read at each iteration
+        of the block to be read at each iteration. Either can be
+        AUTOWINDOW, to follow the native block layout of the inputs
+        (see findAutoWindowSize())
         
         overlap specifies the number of pixels to overlap
         between each block
@@ -365,6 +410,10 @@ class ImageReader(object):
             # user supplied
             self.workingGrid = workingGrid
         
+        if AUTOWINDOW in (self.windowxsize, self.windowysize):
+            (nrows, ncols) = self.workingGrid.getDimensions()
+            (self.windowxsize, self.windowysize) = self.findAutoWindowSize(ncols, nrows)
+        
         # create a statscache if not passed to constructor.
         # Created once per dataset so stats
         # only have to be calculated once per image - it
@@ -377,6 +426,56 @@ class ImageReader(object):
         self.info = readerinfo.ReaderInfo(self.workingGrid, self.statscache, self.ratcache,
                         self.windowxsize, self.windowysize, self.overlap, self.loggingstream)
         
+    def findAutoWindowSize(self, xsize, ysize):
+        """
+        Work out the window size for AUTOWINDOW, from the native block
+        layout (i.e. GetBlockSize()) of the inputs, for a working region 
+        of xsize columns and ysize rows. Either or both of self.windowxsize 
+        and self.windowysize can be AUTOWINDOW, a number given for the 
+        other is kept. 
+        
+        If any of the inputs is in strips (its blocks are the full width 
+        of the image), the windows are the full width of the region, so that 
+        each strip is read and decompressed just once. Otherwise the windows
+        are a whole number of the tiles of every input. Along each axis, 
+        the window is a power of 2 times the lowest common multiple of the
+        inputs' block sizes, to give about AUTOWINDOWPIXELS pixels in
+        each window. 
+        
+        The windows only line up with the native blocks when the working 
+        region starts at the top left of the inputs, as it does when they
+        all cover the same area. 
+        
+        Returns a tuple (windowxsize, windowysize)
+        
+        """
+        striped = False
+        blockXList = []
+        blockYList = []
+        for ds in self.inputs.datasetList:
+            (blockX, blockY) = ds.GetRasterBand(1).GetBlockSize()
+            if blockX >= ds.RasterXSize:
+                striped = True
+            blockXList.append(blockX)
+            blockYList.append(blockY)
+
+        windowxsize = self.windowxsize
+        windowysize = self.windowysize
+        if windowxsize == AUTOWINDOW:
+            if striped:
+                windowxsize = xsize
+            else:
+                if windowysize == AUTOWINDOW:
+                    targetLength = int(math.sqrt(AUTOWINDOWPIXELS))
+                else:
+                    targetLength = AUTOWINDOWPIXELS // windowysize
+                windowxsize = autoWindowLength(lowestCommonMultiple(blockXList), 
+                    targetLength, xsize)
+        if windowysize == AUTOWINDOW:
+            windowysize = autoWindowLength(lowestCommonMultiple(blockYList), 
+                AUTOWINDOWPIXELS // windowxsize, ysize)
+        return (windowxsize, windowysize)
+        
     def readBlock(self, nblock):
         """
         Read a block. This is normally called from the
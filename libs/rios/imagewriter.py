@@ -489,6 +489,24 @@ class ImageWriter(object):
                 else:
                     newCreationoptions.append(optStr)
             
+            def isPowerOf2(n):
+                return (((n - 1) & n) == 0)
+            
+            # A RIOS block which spans the whole width of the image never splits a TIFF block 
+            # across the width, so then the TIFF block width need not be a factor of it (e.g. 
+            # full width blocks from rios.imagereader.AUTOWINDOW on striped inputs, or a small
+            # image in a single block). If the RIOS block width is not a power of 2, then 
+            # unless explicitly requested use GDAL's usual 256 for the TIFF block width. 
+            # Likewise for the height, independently of the width. 
+            if self.xtotalblocks == 1 and not isPowerOf2(riosBlockX):
+                if tiffBlockX is None:
+                    tiffBlockX = 256
+                riosBlockX = tiffBlockX
+            if self.ytotalblocks == 1 and not isPowerOf2(riosBlockY):
+                if tiffBlockY is None:
+                    tiffBlockY = 256
+                riosBlockY = tiffBlockY
+            
             # If no tiff blocksizes were explictly requested, then set them the same as the 
             # RIOS block sizes
             resettingTiffBlocksize = False
@@ -508,8 +526,6 @@ class ImageWriter(object):
                 raise rioserrors.ImageOpenError(msg)
 
             # The GDAL GTiff driver will complain if GTiff block sizes are not powers of 2
-            def isPowerOf2(n):
-                return (((n - 1) & n) == 0)
             if not (isPowerOf2(tiffBlockX) and isPowerOf2(tiffBlockY)):
                 msg = "GTiff block sizes are {}. Must be powers of 2. ".format((tiffBlockX, tiffBlockY))
                 if resettingTiffBlocksize:
@@ -519,7 +535,7 @@ class ImageWriter(object):
                 raise rioserrors.ImageOpenError(msg)
 
             # Now append what we want the block size to be. 
-            newCreationoptions.append('BLOCKXSIZE={}'.format(self.windowxsize))
-            newCreationoptions.append('BLOCKYSIZE={}'.format(self.windowysize))
+            newCreationoptions.append('BLOCKXSIZE={}'.format(riosBlockX))
+            newCreationoptions.append('BLOCKYSIZE={}'.format(riosBlockY))
 
         return newCreationoptions
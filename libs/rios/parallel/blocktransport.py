@@ -0,0 +1,151 @@
+"""
+Passing blocks of data to and from the worker processes of the job managers
+through memory mapped scratch files, instead of pickling them.
+
+When the blocks are sent to a worker process, each large numpy array among
+them is written to a scratch file, and only a small
+:class:`rios.parallel.blocktransport.SharedBlock` describing it is
+pickled. The receiving process maps the file, so the array is not
+serialised, sent through a pipe and deserialised. With the scratch files
+on a memory file system (e.g. /dev/shm), this is just one copy of each
+block each way.
+
+This is used by :func:`rios.applier.apply` for the job managers with
+localWorkers, see :meth:`rios.applier.ApplierControls.setBlockTransportDir`.
+
+Environment Variables
+---------------------
+
++---------------------------------+-----------------------------------------------------------------+
+| Name                            | Description                                                     |
++=================================+=================================================================+
+|RIOS_BLOCKTRANSPORT_DIR          | Directory for the scratch files. Default is /dev/shm if it      |
+|                                 | exists. Set to an empty string to pickle the blocks instead.    |
++---------------------------------+-----------------------------------------------------------------+
+|RIOS_BLOCKTRANSPORT_MINBYTES     | Arrays smaller than this many bytes are pickled as usual.       |
+|                                 | Default is 65536.                                               |
++---------------------------------+-----------------------------------------------------------------+
+
+"""
+# This file is part of RIOS - Raster I/O Simplification
+# Copyright (C) 2012  Sam Gillingham, Neil Flood
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+
+import numpy
+
+DEFAULT_BLOCKTRANSPORTDIR = os.getenv('RIOS_BLOCKTRANSPORT_DIR')
+if DEFAULT_BLOCKTRANSPORTDIR is None and os.path.isdir('/dev/shm'):
+    DEFAULT_BLOCKTRANSPORTDIR = '/dev/shm'
+if DEFAULT_BLOCKTRANSPORTDIR == '':
+    DEFAULT_BLOCKTRANSPORTDIR = None
+MINBYTES = int(os.getenv('RIOS_BLOCKTRANSPORT_MINBYTES', default=65536))
+
+
+class SharedBlock(object):
+    """
+    Describes a numpy array held in a scratch file, and is pickled in
+    place of the array.
+    """
+    def __init__(self, filename, shape, dtype):
+        self.filename = filename
+        self.shape = shape
+        self.dtype = dtype
+
+    def open(self):
+        """
+        Return the array, mapped from the scratch file. It is
+        copy-on-write, so it can be modified without changing the file.
+        """
+        return numpy.memmap(self.filename, dtype=self.dtype, mode='c',
+            shape=self.shape)
+
+
+def shareArray(value, dirname, filenameList):
+    """
+    If value is a numpy array of at least MINBYTES, write it to a new
+    scratch file in dirname and return a SharedBlock for it, appending the
+    filename to filenameList. Otherwise return value unchanged.
+    """
+    if isinstance(value, numpy.ndarray) and value.nbytes >= MINBYTES:
+        (fd, filename) = tempfile.mkstemp(prefix='block_', suffix='.dat',
+            dir=dirname)
+        os.close(fd)
+        scratch = numpy.memmap(filename, dtype=value.dtype, mode='w+',
+            shape=value.shape)
+        scratch[...] = value
+        scratch.flush()
+        del scratch
+        filenameList.append(filename)
+        value = SharedBlock(filename, value.shape, value.dtype.str)
+    return value
+
+
+def shareBlocks(blocks, dirname):
+    """
+    Replace the large numpy arrays which are attributes of the blocks
+    object (e.g. a :class:`rios.applier.BlockAssociations`), or are in
+    lists which are attributes of it, with SharedBlock objects, writing
+    them to scratch files in dirname. Returns a list of the scratch
+    filenames.
+    """
+    filenameList = []
+    for (name, value) in list(blocks.__dict__.items()):
+        if isinstance(value, list):
+            value = [shareArray(v, dirname, filenameList) for v in value]
+        else:
+            value = shareArray(value, dirname, filenameList)
+        blocks.__dict__[name] = value
+    return filenameList
+
+
+def openShared(value, remove):
+    """
+    If value is a SharedBlock, return its array, otherwise value unchanged.
+    If remove is True, the scratch file is removed once it is mapped.
+    """
+    if isinstance(value, SharedBlock):
+        filename = value.filename
+        value = value.open()
+        if remove:
+            removeFiles([filename])
+    return value
+
+
+def unshareBlocks(blocks, remove=False):
+    """
+    The reverse of shareBlocks(), replacing the SharedBlock attributes of
+    the blocks object with their arrays. If remove is True, the scratch
+    files are removed once they are mapped (the arrays stay valid).
+    """
+    for (name, value) in list(blocks.__dict__.items()):
+        if isinstance(value, list):
+            value = [openShared(v, remove) for v in value]
+        else:
+            value = openShared(value, remove)
+        blocks.__dict__[name] = value
+
+
+def removeFiles(filenameList):
+    """
+    Remove the given scratch files, ignoring any which cannot be removed
+    """
+    for filename in filenameList:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
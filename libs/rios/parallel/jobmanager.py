@@ -9,6 +9,9 @@ processing.
 
 It should also be noted that the 'otherargs' parameter to :func:`rios.applier.apply`
 works for passing data into a user function, but updated data is not passed out at present.
+Instead, results can be passed out as extra attributes on the outputs object, and combined
+in the main process with a reduce function, see 
+:meth:`rios.applier.ApplierControls.setReduceFunction`. 
 
 Also, certain functions on the 'info' parameter passed to the user function will not work.
 These are the functions that access the underlying GDAL dataset directly and include, 
@@ -29,8 +32,8 @@ allowing it to manage scheduling of jobs and resource management.
 Alternatively, one can use MPI or Python's own multiprocessing module,
 if this is more appropriate for the system configuration available. 
 
-Sub-classes are provided for using PBS, SLURM, MPI, multiprocessing
-or Python's native subprocess module. Other sub-classes can be made
+Sub-classes are provided for using PBS, SLURM, MPI, multiprocessing,
+threads or Python's native subprocess module. Other sub-classes can be made
 as required, outside this module, and will be visible to the function::
 
     getJobManagerClassByName()
@@ -55,6 +58,17 @@ systems with different configurations. Alternatively, this can be set on
 the controls object, e.g.::
 
     controls.setJobManagerType('pbs')
+
+Starting a job manager can be slow (e.g. starting the worker processes of
+the multiprocessing pool), so it can be kept and re-used by later calls
+to :func:`rios.applier.apply`, see 
+:meth:`rios.applier.ApplierControls.setPersistentJobManager`. 
+
+The job managers with dynamicScheduling (multiprocessing and threads) do
+not process the blocks in fixed batches of numThreads. Instead, a window
+of blocks is kept running, and a new block is started as soon as the 
+oldest one is finished, so a slow block does not leave the other workers 
+idle, see :meth:`rios.parallel.jobmanager.JobManager.runSubJobsInOrder`. 
     
 Environment Variables
 ---------------------
@@ -104,9 +118,13 @@ from __future__ import print_function
 import os
 import sys
 import abc
+import atexit
+import collections
 import subprocess
 import tempfile
 import time
+
+import numpy
 try:
     import cPickle as pickle        # For Python 2.x
 except ImportError:
@@ -181,6 +199,13 @@ class JobManager(object):
     """
     __metaclass__ = abc.ABCMeta
     jobMgrType = None
+    # True if the sub-class implements startOneJob() and gatherOneOutput() for 
+    # a pool of workers which each take the next job as soon as they are free,
+    # so it can be used with runSubJobsInOrder()
+    dynamicScheduling = False
+    # True if the jobs run in other processes on this machine, so the blocks
+    # can be passed to and from them in scratch files, see rios.parallel.blocktransport
+    localWorkers = False
     
     def __init__(self, numSubJobs):
         """
@@ -212,6 +237,53 @@ class JobManager(object):
         outputBlocksList = self.gatherAllOutputs(jobIDlist)
         return outputBlocksList
     
+    def runSubJobsInOrder(self, function, jobInputs, windowSize):
+        """
+        Generator which runs the given function for each of the jobInputs 
+        (an iterable of JobInfo derived objects), as separate asynchronous 
+        jobs, with up to windowSize jobs started at a time. Yields a tuple
+        of (jobInfo, outputs) for each job, in the same order as jobInputs. 
+        
+        A new job is started as each one is yielded, and the workers take 
+        the jobs as soon as they are free, so a slow job only holds up the 
+        yielding of the jobs after it, not the running of them. Only for 
+        sub-classes with dynamicScheduling. 
+        
+        """
+        jobInputs = iter(jobInputs)
+        runningJobs = collections.deque()
+        finished = False
+        while not finished or len(runningJobs) > 0:
+            while not finished and len(runningJobs) < windowSize:
+                try:
+                    jobInfo = next(jobInputs)
+                except StopIteration:
+                    finished = True
+                    break
+                runningJobs.append((jobInfo, self.startOneJob(function, jobInfo)))
+            
+            if len(runningJobs) > 0:
+                (jobInfo, jobID) = runningJobs.popleft()
+                yield (jobInfo, self.gatherOneOutput(jobID))
+    
+    def gatherOneOutput(self, jobID):
+        """
+        Wait for the job with the given jobID (from startOneJob) and return 
+        its outputs object. Must be over-ridden by sub-classes with 
+        dynamicScheduling. 
+        
+        """
+        raise NotImplementedError("Job manager %s does not have dynamicScheduling" % 
+            self.jobMgrType)
+    
+    def shutdown(self):
+        """
+        Release any resources held by the job manager (e.g. a pool of 
+        worker processes), when it will not be used again. Default 
+        implementation does nothing. 
+        
+        """
+    
     def startAllJobs(self, function, jobInputs):
         """
         Start up all of the jobs processing blocks. Default implementation
@@ -290,6 +362,7 @@ class SubprocJobManager(JobManager):
     
     """
     jobMgrType = "subproc"
+    localWorkers = True
     
     def startOneJob(self, userFunc, jobInfo):
         """
@@ -759,25 +832,42 @@ class MultiJobManager(JobManager):
     This is much faster than the SubprocJobManager presumeably due to the
     custom data pickling that Python does.
     
+    The pool has one worker process for each sub-job, and all jobs are run 
+    in the pool, none in the current process. 
+    
     """
     jobMgrType = "multiprocessing"
+    dynamicScheduling = True
+    localWorkers = True
     # an instance of multiprocessing.Pool
     pool = None
 
     def __init__(self, numSubJobs):
         from multiprocessing import Pool
 
-        # base class does one job in current process so we don't
-        # need to create processes for each job
-        self.pool = Pool(numSubJobs - 1)
+        self.pool = Pool(numSubJobs)
 
         # call base class implementation
         JobManager.__init__(self, numSubJobs)
 
     def __del__(self):
-        # shut down the pool object as we have finished.
-        self.pool.close()
-        self.pool.join()
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Shut down the pool of worker processes
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def startAllJobs(self, function, jobInputs):
+        """
+        Start all of the jobs in the pool. 
+        
+        """
+        return [self.startOneJob(function, inputs) for inputs in jobInputs]
 
     def startOneJob(self, userFunc, jobInfo):
         """
@@ -798,27 +888,126 @@ class MultiJobManager(JobManager):
     def waitOnJobs(self, jobIDlist):
         """
         Wait on all the jobs with AsyncResult.wait().
-        The first element of jobIDlist is actually an outputs object
-        so we ignore that.
 
         """
-        for job in jobIDlist[1:]:
+        for job in jobIDlist:
             job.wait(timeout=None)
             
     def gatherAllOutputs(self, jobIDlist):
         """
         Gather up outputs from sub-jobs, and return a list of the
-        outputs objects. Note that we assume that the first element of
-        jobIDlist is actually an outputs object, from running the first sub-array
-        in the current process. 
+        outputs objects. 
 
         """
-        outputBlocks = [jobIDlist[0]]
-        for job in jobIDlist[1:]:
-            output = job.get(timeout=None)            
-            outputBlocks.append(output)
+        return [self.gatherOneOutput(job) for job in jobIDlist]
 
-        return outputBlocks
+    def gatherOneOutput(self, jobID):
+        """
+        Wait for the job and return its outputs object, or raise the 
+        exception from the user function. 
+
+        """
+        return jobID.get(timeout=None)
+
+
+def threadsUserFunc(userFunc, jobInfo, numpyErrorSettings):
+    """
+    This function is run by the ThreadsJobManager to run
+    one job, in a worker thread. The numpy floating point 
+    error settings (see numpy.seterr) belong to each thread,
+    so those of the main thread are used here too, to 
+    behave the same as running in the main thread. 
+    """
+    with numpy.errstate(**numpyErrorSettings):
+        params = jobInfo.getFunctionParams()
+        userFunc(*params)
+
+        result = jobInfo.getFunctionResult(params)
+    return result
+
+
+class ThreadsJobManager(JobManager):
+    """
+    Use a pool of threads in the current process to run individual jobs.
+    
+    The input and output blocks are shared with the threads in memory, 
+    so nothing is pickled or copied between processes. This only gives 
+    a speed up if the user function spends most of its time in code 
+    which releases Python's GIL, such as most numpy operations on large 
+    arrays, otherwise the threads just take turns. 
+    
+    As the threads share the one process, the user function must be 
+    thread safe. In particular, changes it makes to otherargs are seen 
+    by all the threads, and so should not be made (use a reduce function
+    instead, see :meth:`rios.applier.ApplierControls.setReduceFunction`). 
+    
+    """
+    jobMgrType = "threads"
+    dynamicScheduling = True
+    # an instance of multiprocessing.pool.ThreadPool
+    pool = None
+
+    def __init__(self, numSubJobs):
+        from multiprocessing.pool import ThreadPool
+
+        self.pool = ThreadPool(numSubJobs)
+
+        # call base class implementation
+        JobManager.__init__(self, numSubJobs)
+
+    def __del__(self):
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Shut down the pool of threads
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def startAllJobs(self, function, jobInputs):
+        """
+        Start all of the jobs in the pool. 
+        
+        """
+        return [self.startOneJob(function, inputs) for inputs in jobInputs]
+
+    def startOneJob(self, userFunc, jobInfo):
+        """
+        Start one job. Uses the ThreadPool.apply_async call. The 
+        jobInfo is given to the thread as it is, without 
+        prepareForPickling(). 
+        
+        """
+        proc = self.pool.apply_async(threadsUserFunc, 
+            (userFunc, jobInfo, numpy.geterr()))
+        return proc
+
+    def waitOnJobs(self, jobIDlist):
+        """
+        Wait on all the jobs with AsyncResult.wait().
+
+        """
+        for job in jobIDlist:
+            job.wait(timeout=None)
+            
+    def gatherAllOutputs(self, jobIDlist):
+        """
+        Gather up outputs from sub-jobs, and return a list of the
+        outputs objects. 
+
+        """
+        return [self.gatherOneOutput(job) for job in jobIDlist]
+
+    def gatherOneOutput(self, jobID):
+        """
+        Wait for the job and return its outputs object. Any exception 
+        raised by the user function in a thread is raised again here. 
+
+        """
+        return jobID.get(timeout=None)
 
 
 # This mechanism for selecting which job manager sub-class to use is important in 
@@ -859,6 +1048,10 @@ def getJobMgrObject(controls):
     object which meets the needs specified in the controls object. 
     If none is required, or none is available, then return None
     
+    If controls.persistentJobManager is set, a job manager of the same 
+    type and number of sub-jobs kept from an earlier call is returned, or 
+    the new one is kept for later calls. 
+    
     """
     jobmgr = None
     if controls.numThreads > 1:
@@ -867,7 +1060,35 @@ def getJobMgrObject(controls):
         jobMgrTypeList = getAvailableJobManagerTypes()
         if controls.jobManagerType not in jobMgrTypeList:
             raise rioserrors.JobMgrError("JobMgrType '%s' is not known"%controls.jobManagerType)
-        jobmgrClass = getJobManagerClassByType(controls.jobManagerType)
-        jobmgr = jobmgrClass(controls.numThreads)
+        # The process id is part of the key, so a forked process never
+        # uses the workers of its parent
+        key = (os.getpid(), controls.jobManagerType, controls.numThreads)
+        if controls.persistentJobManager and key in persistentJobManagers:
+            jobmgr = persistentJobManagers[key]
+        else:
+            jobmgrClass = getJobManagerClassByType(controls.jobManagerType)
+            jobmgr = jobmgrClass(controls.numThreads)
+            if controls.persistentJobManager:
+                persistentJobManagers[key] = jobmgr
         jobmgr.setTempdir(controls.tempdir)
     return jobmgr
+
+
+# Job managers kept for re-use by getJobMgrObject(), keyed by 
+# (processId, jobMgrType, numSubJobs)
+persistentJobManagers = {}
+
+
+def shutdownPersistentJobManagers():
+    """
+    Shut down all the job managers of this process kept for re-use (see 
+    :meth:`rios.applier.ApplierControls.setPersistentJobManager`). This 
+    is done automatically at exit. 
+    
+    """
+    for key in list(persistentJobManagers.keys()):
+        if key[0] == os.getpid():
+            persistentJobManagers.pop(key).shutdown()
+
+
+atexit.register(shutdownPersistentJobManagers)
@@ -27,6 +27,7 @@ import numpy
 
 from . import imageio
 from . import rat
+from . import rioserrors
 
 
 class StatisticsCache(object):
@@ -145,6 +146,11 @@ class ReaderInfo(object):
         # that corresponds to it, and the original filename
         self.blocklookup = {}
         
+        # dictionary keyed by id() of the number array, 
+        # value is a list of the 'no data' values of each band.
+        # Only set by snapshotDatasets(), otherwise None
+        self.noDataLookup = None
+        
     def setBlockDataset(self, block, dataset, filename):
         """
         Saves a match between the numpy block read
@@ -157,6 +163,36 @@ class ReaderInfo(object):
         """
         self.blocklookup[id(block)] = (dataset, filename)
         
+    def snapshotDatasets(self, blocks):
+        """
+        Saves the 'no data' values of the datasets underlying the
+        given blocks, and then drops the datasets from this object. 
+        Used when the blocks are read ahead in another thread (see 
+        :meth:`rios.applier.ApplierControls.setPipelineIO`), as that 
+        thread is still reading the datasets while the user function 
+        runs. After this, getNoDataValueFor() and getFilenameFor() 
+        still work, but anything needing the dataset itself raises 
+        DatasetNotAvailableError, unless the result is already cached 
+        (e.g. the global_* statistics). 
+        
+        This routine is for internal use by RIOS. Its use in any other
+        context is not sensible. 
+        
+        """
+        blocklookup = {}
+        noDataLookup = {}
+        for block in blocks:
+            key = id(block)
+            if key in self.blocklookup:
+                (ds, fname) = self.blocklookup[key]
+                noDataLookup[key] = [getBandNoDataValue(ds.GetRasterBand(i + 1))
+                    for i in range(ds.RasterCount)]
+                blocklookup[key] = (None, fname)
+        # new dictionaries, so the ones shared with the other blocks 
+        # are left alone
+        self.blocklookup = blocklookup
+        self.noDataLookup = noDataLookup
+        
     def getWindowSize(self):
         """
         Returns the size of the current window. Returns a 
@@ -369,6 +405,10 @@ class ReaderInfo(object):
         Get the underlying GDAL handle of a dataset
         """
         (ds, fname) = self.blocklookup[id(block)]
+        if ds is None:
+            msg = ("The GDAL dataset of %s is not available, as it is being " +
+                "read in another thread (see ApplierControls.setPipelineIO)") % fname
+            raise rioserrors.DatasetNotAvailableError(msg)
         return ds
 
     def getGDALBandFor(self, block, band):
@@ -387,17 +427,11 @@ class ReaderInfo(object):
         The value is cast to the same data type as the 
         dataset.
         """
-        ds = self.getGDALDatasetFor(block)
-        band = ds.GetRasterBand(band)
-        novalue = band.GetNoDataValue()
-
-        # if there is a valid novalue, cast it to the type
-        # of the dataset. Note this creates a numpy 0-d array
-        if novalue is not None:
-            numpytype = imageio.GDALTypeToNumpyType(band.DataType)
-            novalue = numpy.cast[numpytype](novalue)
+        if self.noDataLookup is not None:
+            return self.noDataLookup[id(block)][band - 1]
 
-        return novalue
+        ds = self.getGDALDatasetFor(block)
+        return getBandNoDataValue(ds.GetRasterBand(band))
         
     def getPercent(self):
         """
@@ -412,10 +446,11 @@ class ReaderInfo(object):
         Gets the attribute for the given block and column name
         Caches columns so only first call actually extracts data
         """
-        (ds, fname) = self.blocklookup[id(block)]
+        fname = self.getFilenameFor(block)
 
         column = self.ratcache.getColumn(fname, band, colName)
         if column is None:
+            ds = self.getGDALDatasetFor(block)
             column = rat.readColumn(ds, colName, band)
             self.ratcache.setColumn(fname, band, colName, column)
         
@@ -472,3 +507,20 @@ class ReaderInfo(object):
         Returns the stddev for the whole band
         """
         return self.global_stats(block, band, ignore)[3]
+
+
+def getBandNoDataValue(band):
+    """
+    Returns the 'no data' value of the given GDAL band, cast to the
+    same data type as the band, or None if it has none. 
+    """
+    novalue = band.GetNoDataValue()
+
+    # if there is a valid novalue, cast it to the type
+    # of the dataset. Note this creates a numpy scalar
+    # (numpy.cast is gone from numpy 2)
+    if novalue is not None:
+        numpytype = imageio.GDALTypeToNumpyType(band.DataType)
+        novalue = numpy.dtype(numpytype).type(novalue)
+
+    return novalue
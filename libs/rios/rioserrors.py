@@ -132,3 +132,7 @@ class ColorTableGenerationError(RiosError):
 
 class PermissionError(RiosError):
     "Error due to permissions on temp files"
+
+
+class DatasetNotAvailableError(RiosError):
+    "The GDAL dataset of an input block cannot be used, e.g. when pipelining"
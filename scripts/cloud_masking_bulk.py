@@ -14,18 +14,37 @@ from __future__ import unicode_literals
 
 import os, sys
 import argparse
-import platform
+import csv
+import hashlib
+import json
+import numpy
 import shutil
-import subprocess
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # add project dir to pythonpath
 libs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "libs")
 if libs_dir not in sys.path:
     sys.path.append(libs_dir)
 
-import gdal_merge
-from fmask import fmask, landsatTOA, landsatangles, config, saturationcheck
-from rios import fileinfo
+from osgeo import gdal
+from fmask import fmask, landsatTOA, landsatangles, config, profiling
+from rios import applier, fileinfo
+
+# approximate peak bytes per pixel used by the fmask process of one scene
+SCENE_BYTES_PER_PIXEL = 32
+
+# version of the scene manifests and their stage keys, change it to recompute all scenes
+MANIFEST_VERSION = 1
+# bytes read at a time to make the checksums of the input files
+CHECKSUM_CHUNK_SIZE = 4 * 1024 ** 2
+# value of the nodata pixels in the final mask, the Byte nodata default of gdal_calc used before
+CLOUD_MASK_NODATA = 255
+
+# names of the fmask parameters in the order of fmask_args (as do_fmask), for --sweep
+FMASK_ARG_NAMES = ("min_cloud_size", "cloud_prob_thresh", "cloud_buffer_size", "shadow_buffer_size",
+                   "cirrus_prob_ratio", "nir_fill_thresh", "swir2_thresh", "whiteness_thresh",
+                   "swir2_water_test", "nir_snow_thresh", "green_snow_thresh")
 
 
 def script():
@@ -47,6 +66,21 @@ def script():
     parser.add_argument('--green_snow_thresh', type=float, default=0.1, required=False)
     parser.add_argument('--blue_band_l457', type=int, default=-1, required=False)
     parser.add_argument('--blue_band_l8', type=int, default=-1, required=False)
+    parser.add_argument('--jobs', type=int, default=1, required=False,
+                        help='number of scenes to process in parallel (default: 1)')
+    parser.add_argument('--max-memory', type=float, default=None, required=False,
+                        help='memory in GB that the parallel jobs can use, by default the '
+                             'available memory of the system, used to limit the number of jobs')
+
+    parser.add_argument('--force', action='store_true', default=False, required=False,
+                        help='recompute all the scenes and stages, ignoring what was done in previous runs')
+    parser.add_argument('--sweep', type=str, nargs='+', default=None, required=False, metavar='NAME=V1,V2',
+                        help='make one mask per combination of the values of these fmask parameters '
+                             '(e.g. cloud_prob_thresh=0.2,0.3 shadow_buffer_size=4,6), named '
+                             '<scene>_mask_<name>-<value>.tif, reusing the fmask stages that do not depend on them')
+    parser.add_argument('--profile', type=str, default=None, required=False, metavar='REPORT',
+                        help='write the wall and CPU time, bytes read/written and peak memory of each stage '
+                             'of each scene to this report file, as csv if it ends with .csv, else json')
 
     parser.add_argument('inputs', type=str, help='directories or MTL files to process', nargs='*')
 
@@ -68,63 +102,271 @@ def script():
 
     filters_enabled = {"Fmask Cloud": True, "Fmask Shadow": True, "Fmask Snow": True, "Fmask Water": False}
 
-    for mtl_file in mtl_files:
-        print("PROCESSING: " + os.path.basename(mtl_file).split("_MTL.txt")[0])
-        cloud_masking_files = []
+    fmask_args = (0, args.cloud_prob_thresh, args.cloud_buffer_size, args.shadow_buffer_size,
+                  args.cirrus_prob_ratio, args.nir_fill_thresh, args.swir2_thresh, args.whiteness_thresh,
+                  args.swir2_water_test, args.nir_snow_thresh, args.green_snow_thresh)
+    blue_band_args = (args.blue_band_l457, args.blue_band_l8)
+
+    sweep = None
+    if args.sweep:
+        try:
+            sweep = sweep_settings(args.sweep, fmask_args)
+        except ValueError as err:
+            parser.error(str(err))
+        print("Sweep of {} settings per scene\n".format(len(sweep)))
+
+    jobs = max(1, min(args.jobs, len(mtl_files)))
+    if jobs > 1:
+        max_memory = args.max_memory * 1024 ** 3 if args.max_memory else available_memory()
+        scene_memory = max([estimate_scene_memory(mtl_file) for mtl_file in mtl_files])
+        if max_memory and scene_memory:
+            memory_jobs = max(1, int(max_memory // scene_memory))
+            if memory_jobs < jobs:
+                print("Limiting to {} parallel jobs (~{:.1f} GB per scene, {:.1f} GB available)\n".format(
+                    memory_jobs, scene_memory / 1024 ** 3, max_memory / 1024 ** 3))
+                jobs = memory_jobs
+
+    results = []
+    if jobs == 1:
+        for mtl_file in mtl_files:
+            results.append(process_scene(mtl_file, filters_enabled, fmask_args, blue_band_args, args.force,
+                                         sweep, args.profile is not None))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(process_scene, mtl_file, filters_enabled, fmask_args, blue_band_args,
+                                       args.force, sweep, args.profile is not None): mtl_file
+                       for mtl_file in mtl_files}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    # the worker process died (e.g. killed by out of memory)
+                    scene = os.path.basename(futures[future]).split("_MTL.txt")[0]
+                    results.append({"scene": scene, "success": False, "skipped": False,
+                                    "error": traceback.format_exc(), "profile": []})
+
+    if args.profile is not None:
+        write_profile_report(args.profile, results)
+
+    ### summary of the processing
+    failed = [result for result in results if not result["success"]]
+    skipped = [result for result in results if result["skipped"]]
+    print("\nSUMMARY: {} scenes processed, {} succeeded ({} already done), {} failed".format(
+        len(results), len(results) - len(failed), len(skipped), len(failed)))
+    for result in failed:
+        print("\nFAILED: {}\n{}".format(result["scene"], result["error"]))
+
+    if failed:
+        sys.exit(1)
+
+
+def process_scene(mtl_file, filters_enabled, fmask_args, blue_band_args, force=False, sweep=None, profile=False):
+    """Make the cloud mask for one scene, catching any error so that one bad
+    scene does not stop the rest of the batch.
+
+    The state of the scene is kept in a manifest next to the MTL file (see
+    SceneManifest), so that a scene already done with the same inputs and
+    parameters is skipped, and a scene that failed resumes from its last
+    finished stage, its tmp dir is only removed when it succeeds.
+
+    If sweep is given (see sweep_settings), one mask is made for each of its
+    settings of the fmask parameters instead, reusing the fmask stages that
+    do not depend on the parameters that change.
+
+    With profile, the stages are profiled (see fmask.profiling).
+
+    Returns a dict with the scene name, the success, if it was skipped, the
+    error traceback (if any) and the profile records of the stages (if any),
+    so it can be collected from a worker process.
+    """
+    scene = os.path.basename(mtl_file).split("_MTL.txt")[0]
+    print("PROCESSING: " + scene)
+    # one tmp dir per scene, scenes in the same directory can run at the same time
+    tmp_dir = os.path.join(os.path.dirname(mtl_file), "tmp_dir_" + scene)
+    # (suffix of the mask file, fmask args) of each mask to make
+    settings = sweep if sweep is not None else [("", fmask_args)]
+    profiler = profiling.StageProfiler(scene=scene, setting="") if profile else None
+    profile_records = profiler.records if profile else []
+
+    try:
+        manifest = SceneManifest(mtl_file.split("_MTL.txt")[0] + "_manifest.json", force)
+        # the stages are recomputed if their inputs or parameters change
+        landsat_version, reflective_bands, thermal_bands = scene_band_files(mtl_file)
+        inputs_key = make_key([manifest.checksum(filename)
+                               for filename in [mtl_file] + reflective_bands + thermal_bands])
+        manifest.stage_keys = {"stacks": inputs_key, "toa": inputs_key}
+        for suffix, setting_args in settings:
+            fmask_key = make_key(inputs_key, setting_args, filters_enabled)
+            manifest.stage_keys["fmask" + suffix] = fmask_key
+            manifest.stage_keys["mask" + suffix] = make_key(fmask_key, blue_band_args)
+
+        if all(manifest.is_done("mask" + suffix, [cloud_mask_filename(mtl_file, suffix)])
+               for suffix, _ in settings):
+            print("ALREADY DONE: " + scene)
+            return {"scene": scene, "success": True, "skipped": True, "error": None, "profile": profile_records}
 
-        tmp_dir = os.path.join(os.path.dirname(mtl_file), "tmp_dir")
         if not os.path.isdir(tmp_dir):
             os.makedirs(tmp_dir)
 
-        cloud_masking_files.append(
-            do_fmask(mtl_file, filters_enabled, tmp_dir, 0, args.cloud_prob_thresh, args.cloud_buffer_size,
-                     args.shadow_buffer_size, args.cirrus_prob_ratio, args.nir_fill_thresh, args.swir2_thresh,
-                     args.whiteness_thresh, args.swir2_water_test, args.nir_snow_thresh, args.green_snow_thresh))
+        blue_band = do_blue_band(mtl_file, blue_band_args[0], blue_band_args[1])
 
-        cloud_masking_files.append(do_blue_band(mtl_file, args.blue_band_l457, args.blue_band_l8, tmp_dir))
+        for suffix, setting_args in settings:
+            cloud_mask_file = cloud_mask_filename(mtl_file, suffix)
+            if manifest.is_done("mask" + suffix, [cloud_mask_file]):
+                continue
 
-        cloud_masking_files = [i for i in cloud_masking_files if i is not None]
+            cloud_fmask_file = do_fmask(mtl_file, filters_enabled, tmp_dir, *setting_args, manifest=manifest,
+                                        suffix=suffix, stage_cache=sweep is not None, profiler=profiler)
 
-        cloud_mask_file = mtl_file.split("_MTL.txt")[0] + "_mask.tif"
+            with profiling.stage(profiler, "mask"):
+                make_cloud_mask(cloud_mask_file, cloud_fmask_file, blue_band)
 
-        if len(cloud_masking_files) == 1:
-            cmd = ['gdal_calc' if platform.system() == 'Windows' else 'gdal_calc.py', '--overwrite',
-                   '--calc', '"1*(A==1)+3*(A!=1)"', "--quiet",
-                   '--outfile', '"{}"'.format(cloud_mask_file),
-                   "-A", '"{}"'.format(cloud_masking_files[0])]
+            # copying style
+            try:
+                shutil.copyfile(os.path.join(os.path.dirname(os.path.realpath(__file__)), "style_mask.qml"),
+                                os.path.splitext(cloud_mask_file)[0] + ".qml")
+            except:
+                pass
+            manifest.mark_done("mask" + suffix)
+    except Exception:
+        print("ERROR: " + scene)
+        return {"scene": scene, "success": False, "skipped": False, "error": traceback.format_exc(),
+                "profile": profile_records}
 
-        if len(cloud_masking_files) == 2:
-            cmd = ['gdal_calc' if platform.system() == 'Windows' else 'gdal_calc.py', '--overwrite',
-                   '--calc', '"1*logical_and(A==1,B==1)+3*logical_or(A!=1,B!=1)"', "--quiet",
-                   '--outfile', '"{}"'.format(cloud_mask_file),
-                   "-A", '"{}"'.format(cloud_masking_files[0]),
-                   "-B", '"{}"'.format(cloud_masking_files[1])]
+    shutil.rmtree(tmp_dir, ignore_errors=True)
 
-        subprocess.run(" ".join(cmd), shell=True)
+    ### ending fmask process
+    print("DONE: " + scene)
+    return {"scene": scene, "success": True, "skipped": False, "error": None, "profile": profile_records}
 
-        cmd = ['gdal_edit' if platform.system() == 'Windows' else 'gdal_edit.py',
-               '"{}"'.format(cloud_mask_file), "-unsetnodata"]
-        subprocess.run(" ".join(cmd), shell=True)
 
-        # copying style
-        try:
-            shutil.copyfile(os.path.join(os.path.dirname(os.path.realpath(__file__)), "style_mask.qml"),
-                            mtl_file.split("_MTL.txt")[0] + "_mask.qml")
-        except:
-            pass
+def write_profile_report(report_file, results):
+    """Write the profile records of the stages of all the scenes to the report
+    file, csv or json, and print the total time of each stage of the batch
+    """
+    records = [record for result in results for record in result["profile"]]
+    fields = ["scene", "setting"] + profiling.RECORD_FIELDS
+
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record["stage"], {"wallTime": 0, "cpuTime": 0, "count": 0})
+        total["wallTime"] += record["wallTime"]
+        total["cpuTime"] += record["cpuTime"]
+        total["count"] += 1
+
+    if report_file.lower().endswith(".csv"):
+        with open(report_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(report_file, "w") as f:
+            json.dump({"stages": records, "totals": totals}, f, indent=1)
 
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print("\nPROFILE: total time of each stage, report in {}".format(report_file))
+    batch_time = sum(total["wallTime"] for total in totals.values()) or 1
+    for stage, total in sorted(totals.items(), key=lambda item: -item[1]["wallTime"]):
+        print("  {:<18} {:>10.1f} s wall {:>10.1f} s cpu  {:>5.1f}%  ({} runs)".format(
+            stage, total["wallTime"], total["cpuTime"], 100 * total["wallTime"] / batch_time, total["count"]))
 
-        ### ending fmask process
-        print("DONE\n")
 
+def cloud_mask_filename(mtl_file, suffix=""):
+    """The final mask file of the scene, the suffix is for the settings of a sweep
+    """
+    return mtl_file.split("_MTL.txt")[0] + "_mask" + suffix + ".tif"
 
-def do_fmask(mtl_file, filters_enabled, tmp_dir, min_cloud_size=0, cloud_prob_thresh=0.225, cloud_buffer_size=4,
-             shadow_buffer_size=6, cirrus_prob_ratio=0.04, nir_fill_thresh=0.02, swir2_thresh=0.03,
-             whiteness_thresh=0.7, swir2_water_test=0.03, nir_snow_thresh=0.11, green_snow_thresh=0.1):
 
-    print("Fmask:")
+def sweep_settings(sweep_args, fmask_args):
+    """Make the settings of a sweep from the NAME=V1,V2 arguments, all the
+    combinations of the values given, the rest of the fmask args as given.
+    Returns a list of (suffix of the mask file, fmask args)
+    """
+    settings = [("", fmask_args)]
+    for sweep_arg in sweep_args:
+        name, _, values = sweep_arg.partition("=")
+        if name not in FMASK_ARG_NAMES or not values:
+            raise ValueError("invalid sweep '{}', it must be NAME=V1,V2,... with NAME one of: {}".format(
+                sweep_arg, ", ".join(FMASK_ARG_NAMES)))
+        index = FMASK_ARG_NAMES.index(name)
+        # same type (int/float) as the parameter
+        values = [type(fmask_args[index])(value) for value in values.split(",")]
+        settings = [(suffix + "_{}-{}".format(name, value), args[:index] + (value,) + args[index + 1:])
+                    for suffix, args in settings for value in values]
+    return settings
+
+
+class SceneManifest(object):
+    """Persistent state of the processing of one scene, saved as json. It keeps
+    the checksums of the input files (cached by size and modification time, so
+    they are only recomputed when a file changes) and the stages finished, each
+    with the key of the inputs and parameters it was made with. A stage is done
+    if it was finished with the same key as now (stage_keys) and its files exist.
+    """
+
+    def __init__(self, manifest_file, force=False):
+        self.manifest_file = manifest_file
+        self.stage_keys = {}
+        self.data = {"version": MANIFEST_VERSION, "checksums": {}, "stages": {}}
+        if os.path.isfile(manifest_file):
+            try:
+                with open(manifest_file, 'r') as f:
+                    data = json.load(f)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.data = data
+            except (IOError, OSError, ValueError):
+                # unreadable manifest, e.g. from a killed run, start again
+                pass
+        if force:
+            self.data["stages"] = {}
+
+    def checksum(self, filename):
+        """The sha1 checksum of the file, from the cache if the file has not changed
+        """
+        stat = os.stat(filename)
+        cached = self.data["checksums"].get(filename)
+        if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+            return cached["sha1"]
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+                sha1.update(chunk)
+        self.data["checksums"][filename] = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                                            "sha1": sha1.hexdigest()}
+        self.save()
+        return sha1.hexdigest()
+
+    def is_done(self, stage, files):
+        """True if the stage was finished with its current key and all its files exist
+        """
+        stage_state = self.data["stages"].get(stage)
+        return (stage_state is not None and stage_state["key"] == self.stage_keys[stage] and
+                all(os.path.isfile(filename) for filename in files))
+
+    def mark_done(self, stage):
+        """Record the stage as finished, with its current key
+        """
+        self.data["stages"][stage] = {"key": self.stage_keys[stage]}
+        self.save()
+
+    def save(self):
+        """Write the manifest, through a temporary file so it is never left half written
+        """
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
+
+
+def make_key(*parts):
+    """A short hash of the given json serializable parts, with the manifest version
+    """
+    text = json.dumps([MANIFEST_VERSION, parts], sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
 
+
+def scene_band_files(mtl_file):
+    """Landsat version and the reflective and thermal band files of the scene
+    """
     input_dir = os.path.dirname(mtl_file)
 
     # parser
@@ -170,80 +412,94 @@ def do_fmask(mtl_file, filters_enabled, tmp_dir, min_cloud_size=0, cloud_prob_th
     reflective_bands = [get_prefer_name(file_path) for file_path in reflective_bands]
     thermal_bands = [get_prefer_name(file_path) for file_path in thermal_bands]
 
-    ########################################
-    # reflective bands stack
-
-    # tmp file for reflective bands stack
-    reflective_stack_file = os.path.join(tmp_dir, "reflective_stack.tif")
+    return landsat_version, reflective_bands, thermal_bands
 
-    if not os.path.isfile(reflective_stack_file):
-        gdal_merge.main(["", "-separate", "-of", "GTiff", "-o",
-                         reflective_stack_file] + reflective_bands)
 
-    ########################################
-    # thermal bands stack
+def do_fmask(mtl_file, filters_enabled, tmp_dir, min_cloud_size=0, cloud_prob_thresh=0.225, cloud_buffer_size=4,
+             shadow_buffer_size=6, cirrus_prob_ratio=0.04, nir_fill_thresh=0.02, swir2_thresh=0.03,
+             whiteness_thresh=0.7, swir2_water_test=0.03, nir_snow_thresh=0.11, green_snow_thresh=0.1,
+             manifest=None, suffix="", stage_cache=False, profiler=None):
+    """Make the fmask of the scene in the tmp dir. If the SceneManifest of the
+    scene is given, the stages (stacks, angles/saturation/TOA and fmask) already
+    finished with the same inputs and parameters are not made again. The suffix
+    is added to the fmask file (and stage) name, and with stage_cache the fmask
+    intermediates are kept in the tmp dir to reuse them for other parameters.
+    The stages are profiled with the profiler, if given
+    """
 
-    # tmp file for reflective bands stack
-    thermal_stack_file = os.path.join(tmp_dir, "thermal_stack.tif")
+    print("Fmask:")
 
-    if not os.path.isfile(thermal_stack_file):
-        gdal_merge.main(["", "-separate", "-of", "GTiff", "-o",
-                         thermal_stack_file] + thermal_bands)
+    landsat_version, reflective_bands, thermal_bands = scene_band_files(mtl_file)
 
     ########################################
-    # estimates of per-pixel angles for sun
-    # and satellite azimuth and zenith
-    #
-    # fmask_usgsLandsatMakeAnglesImage.py
-
-    # tmp file for angles
-    angles_file = os.path.join(tmp_dir, "angles.tif")
-
-    mtlInfo = config.readMTLFile(mtl_file)
+    # reflective bands stack
 
-    imgInfo = fileinfo.ImageInfo(reflective_stack_file)
-    corners = landsatangles.findImgCorners(reflective_stack_file, imgInfo)
-    nadirLine = landsatangles.findNadirLine(corners)
+    # tmp file for reflective bands stack, as a virtual raster pointing to the
+    # band files to avoid a full copy of the scene
+    reflective_stack_file = os.path.join(tmp_dir, "reflective_stack.vrt")
 
-    extentSunAngles = landsatangles.sunAnglesForExtent(imgInfo, mtlInfo)
-    satAzimuth = landsatangles.satAzLeftRight(nadirLine)
+    ########################################
+    # thermal bands stack
 
-    landsatangles.makeAnglesImage(reflective_stack_file, angles_file,
-                                  nadirLine, extentSunAngles, satAzimuth, imgInfo)
+    # tmp file for thermal bands stack
+    thermal_stack_file = os.path.join(tmp_dir, "thermal_stack.vrt")
+
+    if profiler is not None:
+        profiler.tags["setting"] = ""
+    if manifest is None:
+        with profiling.stage(profiler, "stacks"):
+            if not os.path.isfile(reflective_stack_file):
+                make_stack_vrt(reflective_stack_file, reflective_bands)
+            if not os.path.isfile(thermal_stack_file):
+                make_stack_vrt(thermal_stack_file, thermal_bands)
+    elif not manifest.is_done("stacks", [reflective_stack_file, thermal_stack_file]):
+        with profiling.stage(profiler, "stacks"):
+            make_stack_vrt(reflective_stack_file, reflective_bands)
+            make_stack_vrt(thermal_stack_file, thermal_bands)
+        manifest.mark_done("stacks")
 
     ########################################
-    # saturation mask
+    # estimates of per-pixel angles for sun and satellite azimuth and zenith,
+    # saturation mask and top of Atmosphere reflectance, all made in a single
+    # pass over the reflective stack
     #
+    # fmask_usgsLandsatMakeAnglesImage.py
     # fmask_usgsLandsatSaturationMask.py
+    # fmask_usgsLandsatTOA.py
 
-    # tmp file for angles
+    # tmp files for angles, saturation mask and toa
+    angles_file = os.path.join(tmp_dir, "angles.tif")
     saturationmask_file = os.path.join(tmp_dir, "saturationmask.tif")
+    toa_file = os.path.join(tmp_dir, "toa.tif")
 
-    if landsat_version == 4:
-        sensor = config.FMASK_LANDSAT47
-    elif landsat_version == 5:
-        sensor = config.FMASK_LANDSAT47
-    elif landsat_version == 7:
-        sensor = config.FMASK_LANDSAT47
-    elif landsat_version in [8, 9]:
-        sensor = config.FMASK_LANDSAT8
+    if manifest is None or not manifest.is_done("toa", [angles_file, saturationmask_file, toa_file]):
+        mtlInfo = config.readMTLFile(mtl_file)
 
-    # needed so the saturation function knows which
-    # bands are visible etc.
-    fmaskConfig = config.FmaskConfig(sensor)
+        imgInfo = fileinfo.ImageInfo(reflective_stack_file)
+        corners = landsatangles.findImgCorners(reflective_stack_file, imgInfo)
+        nadirLine = landsatangles.findNadirLine(corners)
 
-    saturationcheck.makeSaturationMask(fmaskConfig, reflective_stack_file,
-                                       saturationmask_file)
+        extentSunAngles = landsatangles.sunAnglesForExtent(imgInfo, mtlInfo)
+        satAzimuth = landsatangles.satAzLeftRight(nadirLine)
 
-    ########################################
-    # top of Atmosphere reflectance
-    #
-    # fmask_usgsLandsatTOA.py
+        if landsat_version == 4:
+            sensor = config.FMASK_LANDSAT47
+        elif landsat_version == 5:
+            sensor = config.FMASK_LANDSAT47
+        elif landsat_version == 7:
+            sensor = config.FMASK_LANDSAT47
+        elif landsat_version in [8, 9]:
+            sensor = config.FMASK_LANDSAT8
 
-    # tmp file for toa
-    toa_file = os.path.join(tmp_dir, "toa.tif")
+        # needed so the saturation function knows which
+        # bands are visible etc.
+        fmaskConfig = config.FmaskConfig(sensor)
 
-    landsatTOA.makeTOAReflectance(reflective_stack_file, mtl_file, angles_file, toa_file)
+        with profiling.stage(profiler, "toa"):
+            landsatTOA.makeAnglesSaturationTOA(reflective_stack_file, mtl_file, angles_file, saturationmask_file,
+                                               toa_file, fmaskConfig, nadirLine, extentSunAngles, satAzimuth)
+        if manifest is not None:
+            manifest.mark_done("toa")
 
     ########################################
     # cloud mask
@@ -251,7 +507,12 @@ def do_fmask(mtl_file, filters_enabled, tmp_dir, min_cloud_size=0, cloud_prob_th
     # fmask_usgsLandsatStacked.py
 
     # tmp file for cloud
-    cloud_fmask_file = os.path.join(tmp_dir, "fmask.tif")
+    cloud_fmask_file = os.path.join(tmp_dir, "fmask" + suffix + ".tif")
+    if profiler is not None:
+        profiler.tags["setting"] = suffix.lstrip("_")
+
+    if manifest is not None and manifest.is_done("fmask" + suffix, [cloud_fmask_file]):
+        return cloud_fmask_file
 
     # 1040nm thermal band should always be the first (or only) band in a
     # stack of Landsat thermal bands
@@ -281,6 +542,9 @@ def do_fmask(mtl_file, filters_enabled, tmp_dir, min_cloud_size=0, cloud_prob_th
     fmaskConfig.setKeepIntermediates(False)
     fmaskConfig.setVerbose(False)
     fmaskConfig.setTempDir(tmp_dir)
+    if stage_cache:
+        fmaskConfig.setStageCacheDir(tmp_dir)
+    fmaskConfig.setProfiler(profiler)
 
     # Set the settings fmask filters from widget to FmaskConfig
     fmaskConfig.setMinCloudSize(min_cloud_size)
@@ -318,12 +582,16 @@ def do_fmask(mtl_file, filters_enabled, tmp_dir, min_cloud_size=0, cloud_prob_th
 
     # process Fmask
     fmask.doFmask(fmaskFilenames, fmaskConfig)
+    if manifest is not None:
+        manifest.mark_done("fmask" + suffix)
 
     return cloud_fmask_file
     
 
-def do_blue_band(mtl_file, blue_band_l457, blue_band_l8, tmp_dir):
-
+def do_blue_band(mtl_file, blue_band_l457, blue_band_l8):
+    """Select the blue band file and threshold for the blue band filter of the
+    scene, returns (blue_band_file, threshold) or None if the filter is disabled
+    """
     input_dir = os.path.dirname(mtl_file)
 
     # parser
@@ -332,11 +600,6 @@ def do_blue_band(mtl_file, blue_band_l457, blue_band_l8, tmp_dir):
     # get the landsat version
     landsat_version = int(mtl_file_parse['SPACECRAFT_ID'][-1])
 
-    # tmp file for cloud
-    cloud_bb_file = os.path.join(tmp_dir, "bb_mask.tif")
-
-    #if args.blue_band_l457 != 1 and args.blue_band_l8 != 1
-
     ########################################
     # select the Blue Band
     if landsat_version in [4, 5, 7]:
@@ -351,22 +614,89 @@ def do_blue_band(mtl_file, blue_band_l457, blue_band_l8, tmp_dir):
     if bb_threshold == -1:
         return
 
-    print("Blue band: ", end="")
+    print("Blue band: threshold {}".format(bb_threshold))
 
     # fix file name
     blue_band_file = get_prefer_name(blue_band_file)
 
-    ########################################
-    # do blue band filter
-    cmd = ['gdal_calc' if platform.system() == 'Windows' else 'gdal_calc.py', '--overwrite',
-           '--calc', '"1*(A<{threshold})+6*(A>={threshold})"'.format(threshold=bb_threshold), "--quiet",
-           '--outfile', '"{}"'.format(cloud_bb_file), "--type='Byte'",
-           "-A", '"{}"'.format(blue_band_file)]
+    return blue_band_file, bb_threshold
+
+
+def make_cloud_mask(cloud_mask_file, cloud_fmask_file, blue_band=None):
+    """Make the final mask in one pass over the fmask result and the blue band
+    (if the blue band filter is enabled): 1 for valid pixels (clear in fmask
+    and under the blue band threshold), 3 for masked pixels and 255 where any
+    input is nodata, in Byte, as the old gdal_calc expressions. The output has
+    no nodata value set.
+    """
+    inputs = applier.FilenameAssociations()
+    inputs.fmask = cloud_fmask_file
 
-    subprocess.run(" ".join(cmd), shell=True)
+    outputs = applier.FilenameAssociations()
+    outputs.mask = cloud_mask_file
 
-    # save final result of masking
-    return cloud_bb_file
+    otherargs = applier.OtherInputs()
+    otherargs.bb_threshold = None
+    otherargs.fmask_nodata = get_nodata(cloud_fmask_file)
+    otherargs.blue_band_nodata = None
+    if blue_band is not None:
+        inputs.blue_band, otherargs.bb_threshold = blue_band
+        otherargs.blue_band_nodata = get_nodata(inputs.blue_band)
+
+    controls = applier.ApplierControls()
+    controls.setOutputDriverName("GTiff")
+    controls.setStatsIgnore(None)
+    controls.setCalcStats(False)
+    controls.setOmitPyramids(True)
+
+    applier.apply(cloud_mask_block, inputs, outputs, otherargs, controls=controls)
+
+
+def get_nodata(filename):
+    """Nodata value of the first band of the file, None if it has not one
+    """
+    ds = gdal.Open(filename)
+    nodata = ds.GetRasterBand(1).GetNoDataValue()
+    del ds
+    return nodata
+
+
+def cloud_mask_block(info, inputs, outputs, otherargs):
+    """Called from RIOS, make the final mask for the block
+    """
+    fmask_block = inputs.fmask[0]
+    valid = (fmask_block == 1)
+    null_mask = is_nodata(fmask_block, otherargs.fmask_nodata)
+
+    if otherargs.bb_threshold is not None:
+        blue_block = inputs.blue_band[0]
+        valid &= (blue_block < otherargs.bb_threshold)
+        null_mask |= is_nodata(blue_block, otherargs.blue_band_nodata)
+
+    mask = numpy.where(valid, 1, 3).astype(numpy.uint8)
+    mask[null_mask] = CLOUD_MASK_NODATA
+    outputs.mask = numpy.expand_dims(mask, axis=0)
+
+
+def is_nodata(band_block, nodata):
+    """Nodata pixels of the band block, all False if the input has no nodata value
+    """
+    if nodata is None:
+        return numpy.zeros(band_block.shape, dtype=bool)
+    return band_block == nodata
+
+
+def make_stack_vrt(stack_file, band_files):
+    """Stack the band files, one band per file, in a virtual raster. As the
+    old gdal_merge stack the nodata of the bands is not used/set
+    """
+    vrt_options = gdal.BuildVRTOptions(separate=True, srcNodata="None", VRTNodata="None")
+    ds = gdal.BuildVRT(stack_file, band_files, options=vrt_options)
+    if ds is None:
+        raise RuntimeError("Cannot build the stack {} from: {}".format(stack_file, ", ".join(band_files)))
+    # write it to disk
+    ds.FlushCache()
+    del ds
 
 
 def mtl2dict(filename, to_float=True):
@@ -425,5 +755,41 @@ def get_prefer_name(file_path):
     return file_path
 
 
+def estimate_scene_memory(mtl_file):
+    """Rough estimate in bytes of the peak memory used by fmask for the scene,
+    it holds several full scene arrays at once (fillMinima, matchShadows)
+    """
+    mtl_file_parse = mtl2dict(mtl_file)
+    try:
+        lines = int(mtl_file_parse['REFLECTIVE_LINES'])
+        samples = int(mtl_file_parse['REFLECTIVE_SAMPLES'])
+    except (KeyError, ValueError):
+        try:
+            band_file = get_prefer_name(os.path.join(os.path.dirname(mtl_file),
+                                                     mtl_file_parse['FILE_NAME_BAND_1']))
+            ds = gdal.Open(band_file)
+            lines, samples = ds.RasterYSize, ds.RasterXSize
+            del ds
+        except Exception:
+            return None
+    return lines * samples * SCENE_BYTES_PER_PIXEL
+
+
+def available_memory():
+    """Available memory of the system in bytes, or None if unknown
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 if __name__ == '__main__':
     script()
@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright (C) 2016-2018 Xavier Corredor Llano, SMBYC
+#  Email: xcorredorl at ideam.gov.co
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os, sys
+import argparse
+import importlib.util
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy
+from osgeo import gdal, osr
+from scipy import ndimage
+
+# add project dir to pythonpath
+libs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "libs")
+if libs_dir not in sys.path:
+    sys.path.append(libs_dir)
+
+
+def script():
+    """Run as a script with arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog='fmask-benchmark',
+        description='Benchmark parts of the fmask processing')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    fillminima_parser = subparsers.add_parser(
+        'fillminima', help='fill the minima of a band, as done for the potential shadows')
+    fillminima_parser.add_argument('image', type=str, help='image with the band to fill, '
+                                   'e.g. the TOA reflectance or a Landsat NIR band file')
+    fillminima_parser.add_argument('--band', type=int, default=1, required=False,
+                                   help='band to fill, e.g. 4 for the NIR in a Landsat 4-7 TOA stack (default: 1)')
+    fillminima_parser.add_argument('--boundary-percentile', type=float, default=17.5, required=False,
+                                   help='percentile of the band used as the boundary value (default: 17.5)')
+    fillminima_parser.add_argument('--tile-sizes', type=int, nargs='*', default=[2048, 1024], required=False,
+                                   help='tile sizes to run the tiled fill with (default: 2048 1024)')
+    fillminima_parser.add_argument('--threads', type=int, nargs='*', default=[1, 2, 4], required=False,
+                                   help='numbers of threads to run the tiled fill with (default: 1 2 4)')
+    fillminima_parser.add_argument('--baseline', type=str, default=None, required=False,
+                                   help='another build of the _fillminima module (.so) to compare with, '
+                                        'e.g. the previous version')
+    fillminima_parser.add_argument('--repeat', type=int, default=1, required=False,
+                                   help='times to run each case, the best time is reported (default: 1)')
+
+    firstpass_parser = subparsers.add_parser(
+        'firstpass', help='run the first pass of the potential cloud layer on synthetic blocks')
+    firstpass_parser.add_argument('--sensor', type=str, default='landsat8', required=False,
+                                  choices=sorted(FIRSTPASS_SENSORS), help='sensor of the blocks (default: landsat8)')
+    firstpass_parser.add_argument('--block-size', type=int, default=256, required=False,
+                                  help='size in pixels of the (square) blocks (default: 256, as RIOS)')
+    firstpass_parser.add_argument('--blocks', type=int, default=20, required=False,
+                                  help='number of blocks to run (default: 20)')
+    firstpass_parser.add_argument('--baseline-libs', type=str, default=None, required=False,
+                                  help='libs directory of another version of fmask to compare with, '
+                                       'e.g. a checkout of the previous version')
+    firstpass_parser.add_argument('--libs-dir', type=str, default=None, required=False,
+                                  help=argparse.SUPPRESS)
+
+    synthetic_parser = subparsers.add_parser(
+        'synthetic', help='run fmask and some of its stages on a synthetic Landsat 8 scene, made offline')
+    synthetic_parser.add_argument('--size', type=int, default=2000, required=False,
+                                  help='size in pixels of the (square) scene (default: 2000)')
+    synthetic_parser.add_argument('--cloud-fraction', type=float, default=0.3, required=False,
+                                  help='fraction of the scene covered by clouds (default: 0.3)')
+    synthetic_parser.add_argument('--seed', type=int, default=0, required=False,
+                                  help='seed of the random scene, the same seed makes the same scene (default: 0)')
+    synthetic_parser.add_argument('--workers', type=int, default=1, required=False,
+                                  help='number of workers for fmask, see FmaskConfig.setNumWorkers (default: 1)')
+    synthetic_parser.add_argument('--work-dir', type=str, default=None, required=False,
+                                  help='directory for the scene and the fmask output, kept after the run '
+                                       '(default: a temporary directory, removed after the run)')
+    synthetic_parser.add_argument('--save', type=str, default=None, required=False,
+                                  help='save the results to this json file, to compare with later')
+    synthetic_parser.add_argument('--compare', type=str, default=None, required=False,
+                                  help='json file of results saved before (with --save) to compare with')
+    synthetic_parser.add_argument('--baseline-libs', type=str, default=None, required=False,
+                                  help='libs directory of another version of fmask to run and compare with, '
+                                       'e.g. a checkout of the previous version')
+    synthetic_parser.add_argument('--libs-dir', type=str, default=None, required=False,
+                                  help=argparse.SUPPRESS)
+
+    windows_parser = subparsers.add_parser(
+        'windows', help='read striped and tiled images with RIOS, with fixed and "auto" window sizes')
+    windows_parser.add_argument('--size', type=int, default=4000, required=False,
+                                help='size in pixels of the (square) images (default: 4000)')
+    windows_parser.add_argument('--window-sizes', type=int, nargs='*', default=[256, 512], required=False,
+                                help='fixed window sizes to compare with "auto" (default: 256 512, '
+                                     'the RIOS and the fmask window sizes)')
+    windows_parser.add_argument('--tile-size', type=int, default=256, required=False,
+                                help='size of the tiles of the tiled image (default: 256)')
+    windows_parser.add_argument('--cache-mb', type=int, default=None, required=False,
+                                help='size of the GDAL block cache in MB, smaller makes the re-reading of '
+                                     'blocks split by the windows more costly (default: the GDAL default)')
+    windows_parser.add_argument('--repeat', type=int, default=1, required=False,
+                                help='times to read each case, the best time is reported (default: 1)')
+    windows_parser.add_argument('--work-dir', type=str, default=None, required=False,
+                                help='directory for the images, kept after the run '
+                                     '(default: a temporary directory, removed after the run)')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'fillminima':
+        benchmark_fillminima(args)
+    if args.benchmark == 'firstpass':
+        benchmark_firstpass(args)
+    if args.benchmark == 'synthetic':
+        benchmark_synthetic(args)
+    if args.benchmark == 'windows':
+        benchmark_windows(args)
+
+
+def best_time(func, repeat):
+    """Run the function the given times, return the last result and the best time
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def load_extension(so_file, name):
+    """Load a compiled extension module from the given file
+    """
+    spec = importlib.util.spec_from_file_location(name, so_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def benchmark_fillminima(args):
+    """Time the filling of minima of a real band, whole and tiled, checking
+    that all the results are the same
+    """
+    from fmask import fillminima
+
+    ds = gdal.Open(args.image)
+    band = ds.GetRasterBand(args.band)
+    nullval = band.GetNoDataValue()
+    if nullval is None:
+        nullval = 0
+    img = band.ReadAsArray().astype(numpy.int16)
+    del ds
+    boundaryval = float(numpy.percentile(img[img != nullval], args.boundary_percentile))
+
+    print("\nImage: {} band {} ({} x {} pixels), boundary value {:.1f}\n".format(
+        os.path.basename(args.image), args.band, img.shape[1], img.shape[0], boundaryval))
+
+    # speeds are shown relative to the whole image fillMinima
+    reference, ref_time = best_time(lambda: fillminima.fillMinima(img, nullval, boundaryval), args.repeat)
+    print("{:<40} {:>8.2f} s".format("fillMinima (whole image)", ref_time))
+
+    if args.baseline is not None:
+        current_module = fillminima._fillminima
+        fillminima._fillminima = load_extension(args.baseline, '_fillminima')
+        try:
+            result, baseline_time = best_time(lambda: fillminima.fillMinima(img, nullval, boundaryval),
+                                              args.repeat)
+        finally:
+            fillminima._fillminima = current_module
+        print("{:<40} {:>8.2f} s  {:>5.2f}x  {}".format(
+            "fillMinima (baseline module)", baseline_time, ref_time / baseline_time,
+            "same" if numpy.array_equal(result, reference) else "DIFFERENT"))
+
+    for tile_size in args.tile_sizes:
+        for threads in args.threads:
+            result, tiled_time = best_time(
+                lambda: fillminima.fillMinimaTiled(img, nullval, boundaryval, tile_size, numThreads=threads),
+                args.repeat)
+            print("{:<40} {:>8.2f} s  {:>5.2f}x  {}".format(
+                "fillMinimaTiled ({} px, {} threads)".format(tile_size, threads), tiled_time,
+                ref_time / tiled_time, "same" if numpy.array_equal(result, reference) else "DIFFERENT"))
+
+
+# sensor names for the firstpass benchmark, and if they have thermal
+FIRSTPASS_SENSORS = {'landsat47': True, 'landsat8': True, 'sentinel2': False}
+
+
+def make_firstpass_block(fmask_config, block_size, with_thermal, seed):
+    """Make the inputs and otherargs of a synthetic block for the first pass,
+    as set up by doPotentialCloudFirstPass, with some null and saturated pixels
+    """
+    from fmask import config
+
+    rng = numpy.random.default_rng(seed)
+    num_bands = max(fmask_config.bands.values()) + 1
+    inputs = types.SimpleNamespace()
+    inputs.toaref = rng.integers(1, 8000, (num_bands, block_size, block_size)).astype(numpy.int16)
+    inputs.toaref[:, :block_size // 10] = 0
+    inputs.saturationMask = (rng.random((3, block_size, block_size)) > 0.99).astype(numpy.uint8)
+    otherargs = types.SimpleNamespace()
+    otherargs.fmaskConfig = fmask_config
+    otherargs.refBands = fmask_config.bands
+    otherargs.refNull = 0
+    otherargs.bandsForRefNull = numpy.array(list(fmask_config.bands.values()))
+    if with_thermal:
+        # constants of the Landsat 8 band 10
+        otherargs.thermalInfo = config.ThermalFileInfo(0, 0.0003342, 0.1, 774.8853, 1321.0789)
+        otherargs.thermalNull = 0
+        inputs.thermal = rng.integers(20000, 35000, (1, block_size, block_size)).astype(numpy.uint16)
+    return inputs, otherargs
+
+
+def run_firstpass(args, use_numexpr):
+    """Run the first pass on the synthetic blocks, return the mean time per block
+    and the peak memory allocated while running one block
+    """
+    from fmask import fmask, config
+
+    sensor = {'landsat47': config.FMASK_LANDSAT47, 'landsat8': config.FMASK_LANDSAT8,
+              'sentinel2': config.FMASK_SENTINEL2}[args.sensor]
+    fmask_config = config.FmaskConfig(sensor)
+    if use_numexpr:
+        fmask_config.setUseNumexpr(True)
+    blocks = [make_firstpass_block(fmask_config, args.block_size, FIRSTPASS_SENSORS[args.sensor], seed)
+              for seed in range(min(args.blocks, 4))]
+
+    # the first block is not timed, to allocate any scratch arrays
+    inputs, otherargs = blocks[0]
+    fmask.potentialCloudFirstPass(None, inputs, types.SimpleNamespace(), otherargs)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for n in range(args.blocks):
+        inputs, otherargs = blocks[n % len(blocks)]
+        fmask.potentialCloudFirstPass(None, inputs, types.SimpleNamespace(), otherargs)
+    block_time = (time.perf_counter() - start) / args.blocks
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return block_time, peak_memory
+
+
+def benchmark_firstpass(args):
+    """Time the first pass of the potential cloud layer, per block, with its
+    peak memory, with and without numexpr and for a baseline version if given
+    """
+    if args.libs_dir is not None:
+        # running the baseline, in its own process
+        sys.path.insert(0, args.libs_dir)
+        block_time, peak_memory = run_firstpass(args, False)
+        print("{:<40} {:>8.1f} ms {:>8.1f} MB".format("baseline", block_time * 1000, peak_memory / 1e6))
+        return
+
+    print("\nFirst pass: {} blocks of {} x {} pixels, {}\n".format(
+        args.blocks, args.block_size, args.block_size, args.sensor))
+    print("{:<40} {:>11} {:>11}".format("", "per block", "peak memory"))
+    sys.stdout.flush()
+    if args.baseline_libs is not None:
+        subprocess.run([sys.executable, os.path.realpath(__file__), 'firstpass', '--sensor', args.sensor,
+                        '--block-size', str(args.block_size), '--blocks', str(args.blocks),
+                        '--libs-dir', os.path.abspath(args.baseline_libs)], check=True)
+
+    block_time, peak_memory = run_firstpass(args, False)
+    print("{:<40} {:>8.1f} ms {:>8.1f} MB".format("numpy", block_time * 1000, peak_memory / 1e6))
+
+    try:
+        import numexpr
+    except ImportError:
+        print("{:<40} {:>11}".format("numexpr", "not installed"))
+        return
+    block_time, peak_memory = run_firstpass(args, True)
+    print("{:<40} {:>8.1f} ms {:>8.1f} MB  ({} threads)".format(
+        "numexpr", block_time * 1000, peak_memory / 1e6, numexpr.get_num_threads()))
+
+
+# Landsat 8 band 10 constants of the synthetic scenes
+SYNTHETIC_THERMAL_MULT = 3.342e-4
+SYNTHETIC_THERMAL_ADD = 0.1
+SYNTHETIC_THERMAL_K1 = 774.8853
+SYNTHETIC_THERMAL_K2 = 1321.0789
+# sun angles (degrees) of the synthetic scenes, and the shadow offset in pixels they give
+SYNTHETIC_SUN_ZENITH = 35.0
+SYNTHETIC_SUN_AZIMUTH = 120.0
+# TOA reflectances (coastal, blue, green, red, nir, swir1, swir2, cirrus) and
+# temperature (deg C) of the land, water and clouds of the synthetic scenes
+SYNTHETIC_LAND = ([0.07, 0.06, 0.08, 0.07, 0.30, 0.22, 0.12, 0.001], 25.0)
+SYNTHETIC_WATER = ([0.08, 0.07, 0.06, 0.03, 0.02, 0.01, 0.005, 0.001], 18.0)
+SYNTHETIC_CLOUD = ([0.50, 0.52, 0.53, 0.54, 0.55, 0.42, 0.30, 0.02], -15.0)
+# size of the blocks to run potentialCloudFirstPass on its own, as the RIOS default window
+SYNTHETIC_FIRSTPASS_BLOCK_SIZE = 256
+
+
+def synthetic_scene_arrays(size, cloud_fraction, seed):
+    """Make the arrays of a deterministic synthetic Landsat 8 scene: the TOA
+    reflectance (scaled by 10000, 8 bands) and thermal (DN of bands 10 and 11)
+    stacks, with land, a lake, clouds (from a smooth random field), their shadows
+    on the land and a null border
+    """
+    rng = numpy.random.default_rng(seed)
+    shape = (size, size)
+    smooth = max(1, size // 60)
+
+    def smooth_field():
+        field = ndimage.gaussian_filter(rng.random(shape), smooth)
+        return (field - field.min()) / (field.max() - field.min())
+
+    rows, cols = numpy.mgrid[0:size, 0:size]
+    water = ((rows - size * 0.7) ** 2 + (cols - size * 0.3) ** 2) < (size / 6.0) ** 2
+    cloud_field = smooth_field()
+    cloud = cloud_field > numpy.quantile(cloud_field, 1 - cloud_fraction)
+    # shadows away from the sun, for clouds about 1.5km high in 30m pixels
+    shift = 50 * numpy.tan(numpy.radians(SYNTHETIC_SUN_ZENITH))
+    azimuth = numpy.radians(SYNTHETIC_SUN_AZIMUTH)
+    shadow = ndimage.shift(cloud, (shift * numpy.cos(azimuth), -shift * numpy.sin(azimuth)), order=0)
+    shadow &= ~cloud & ~water
+    null = numpy.ones(shape, dtype=bool)
+    border = size // 20
+    null[border:-border, border:-border] = False
+
+    texture = 0.85 + 0.3 * smooth_field()
+    reflectance = numpy.empty((8,) + shape, dtype=numpy.float32)
+    temperature = numpy.empty(shape, dtype=numpy.float32)
+    for mask, (values, temp) in [(~water, SYNTHETIC_LAND), (water, SYNTHETIC_WATER), (cloud, SYNTHETIC_CLOUD)]:
+        for band, value in enumerate(values):
+            reflectance[band][mask] = value
+        temperature[mask] = temp
+    reflectance *= texture
+    reflectance[:, shadow] *= 0.3
+    reflectance += rng.normal(0, 0.002, reflectance.shape).astype(numpy.float32)
+    temperature += rng.normal(0, 0.5, shape).astype(numpy.float32)
+
+    toa = numpy.clip(reflectance * 10000, 1, 32767).astype(numpy.int16)
+    toa[:, null] = 0
+    # inverse of the brightness temperature of fmask.config.ThermalFileInfo
+    radiance = SYNTHETIC_THERMAL_K1 / (numpy.exp(SYNTHETIC_THERMAL_K2 / (temperature + 273.15)) - 1)
+    thermal_band = numpy.clip((radiance - SYNTHETIC_THERMAL_ADD) / SYNTHETIC_THERMAL_MULT, 1, 65535)
+    thermal = numpy.array([thermal_band, thermal_band]).astype(numpy.uint16)
+    thermal[:, null] = 0
+    return toa, thermal
+
+
+def write_synthetic_raster(filename, bands, gdal_type):
+    """Write the bands to a GeoTIFF with the projection of the synthetic scenes (UTM 55S, 30m)
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(filename, bands.shape[2], bands.shape[1], bands.shape[0], gdal_type,
+                       ['TILED=YES', 'INTERLEAVE=BAND'])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32755)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform((500000, 30, 0, 7000000, 0, -30))
+    for n in range(bands.shape[0]):
+        ds.GetRasterBand(n + 1).WriteArray(bands[n])
+    ds.FlushCache()
+    del ds
+
+
+def make_synthetic_scene(work_dir, size, cloud_fraction, seed):
+    """Write a synthetic Landsat 8 scene to the work dir: the TOA reflectance and
+    thermal stacks, an empty saturation mask and the MTL file with the thermal
+    constants. Returns a dict with the file names
+    """
+    toa, thermal = synthetic_scene_arrays(size, cloud_fraction, seed)
+    files = {name: os.path.join(work_dir, "synthetic_" + name + ".tif") for name in ("toa", "thermal", "saturation")}
+    files["mtl"] = os.path.join(work_dir, "synthetic_MTL.txt")
+    write_synthetic_raster(files["toa"], toa, gdal.GDT_Int16)
+    write_synthetic_raster(files["thermal"], thermal, gdal.GDT_UInt16)
+    write_synthetic_raster(files["saturation"], numpy.zeros((3, size, size), dtype=numpy.uint8), gdal.GDT_Byte)
+    with open(files["mtl"], "w") as f:
+        f.write('GROUP = L1_METADATA_FILE\n'
+                '    SPACECRAFT_ID = "LANDSAT_8"\n'
+                '    SENSOR_ID = "OLI_TIRS"\n'
+                '    SUN_AZIMUTH = {}\n'
+                '    SUN_ELEVATION = {}\n'
+                '    RADIANCE_MULT_BAND_10 = {}\n'
+                '    RADIANCE_ADD_BAND_10 = {}\n'
+                '    K1_CONSTANT_BAND_10 = {}\n'
+                '    K2_CONSTANT_BAND_10 = {}\n'
+                'END_GROUP = L1_METADATA_FILE\n'
+                'END\n'.format(SYNTHETIC_SUN_AZIMUTH, 90 - SYNTHETIC_SUN_ZENITH, SYNTHETIC_THERMAL_MULT,
+                                SYNTHETIC_THERMAL_ADD, SYNTHETIC_THERMAL_K1, SYNTHETIC_THERMAL_K2))
+    return files
+
+
+def measure_stage(stage, func):
+    """Run func, returns a result dict with the stage, its seconds and the peak memory
+    allocated while it ran (traced with tracemalloc), and the value returned by func
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"stage": stage, "seconds": seconds, "peak": peak_memory}, value
+
+
+def run_synthetic(args, work_dir):
+    """Run fmask, profiling its stages if this version can, and some of its
+    stage functions on their own, on the synthetic scene. Returns a list of
+    results, dicts with the stage, seconds and peak memory. The peak memory of
+    the profiled stages is the peak resident memory (or None), and of the rest
+    the peak allocated while running them
+    """
+    from fmask import fmask, config, fillminima, valueindexes
+    try:
+        from fmask import profiling
+    except ImportError:
+        # older version, without profiling
+        profiling = None
+
+    files = make_synthetic_scene(work_dir, args.size, args.cloud_fraction, args.seed)
+
+    fmask_filenames = config.FmaskFilenames()
+    fmask_filenames.setTOAReflectanceFile(files["toa"])
+    fmask_filenames.setThermalFile(files["thermal"])
+    fmask_filenames.setSaturationMask(files["saturation"])
+    fmask_filenames.setOutputCloudMaskFile(os.path.join(work_dir, "synthetic_fmask.tif"))
+    fmask_config = config.FmaskConfig(config.FMASK_LANDSAT8)
+    fmask_config.setThermalInfo(config.readThermalInfoFromLandsatMTL(files["mtl"]))
+    fmask_config.setAnglesInfo(config.AngleConstantInfo(
+        numpy.radians(SYNTHETIC_SUN_ZENITH), numpy.radians(SYNTHETIC_SUN_AZIMUTH), 0.0, 0.0))
+    fmask_config.setTempDir(work_dir)
+    # the intermediates are needed to run matchShadows on its own
+    fmask_config.setKeepIntermediates(True)
+    if args.workers > 1:
+        fmask_config.setNumWorkers(args.workers)
+    profiler = None
+    if profiling is not None:
+        profiler = profiling.StageProfiler()
+        fmask_config.setProfiler(profiler)
+
+    results = []
+    result, intermediates = measure_stage("doFmask", lambda: fmask.doFmask(fmask_filenames, fmask_config))
+    results.append(result)
+    if profiler is not None:
+        results.extend({"stage": "  " + record["stage"], "seconds": record["wallTime"], "peak": record["peakRSS"]}
+                       for record in profiler.records)
+
+    # some stages on their own
+    num_blocks = -(-args.size * args.size // SYNTHETIC_FIRSTPASS_BLOCK_SIZE ** 2)
+    blocks = [make_firstpass_block(fmask_config, SYNTHETIC_FIRSTPASS_BLOCK_SIZE, True, seed)
+              for seed in range(min(num_blocks, 4))]
+
+    def run_firstpass_blocks():
+        for n in range(num_blocks):
+            inputs, otherargs = blocks[n % len(blocks)]
+            fmask.potentialCloudFirstPass(None, inputs, types.SimpleNamespace(), otherargs)
+    results.append(measure_stage("potentialCloudFirstPass", run_firstpass_blocks)[0])
+
+    # the inputs of matchShadows, made again from the intermediates of doFmask
+    pass1 = fmask.doPotentialCloudFirstPass(fmask_filenames, fmask_config, False)
+    (Tlow, Thigh) = pass1[2:4]
+    fmask.deleteRaster(pass1[0])
+    clumps, num_clumps = fmask.clumpClouds(intermediates["interimCloud"])
+    cloud_shape, cloud_base_temp, cloud_clump_ndx = fmask.make3Dclouds(
+        fmask_filenames, fmask_config, clumps, num_clumps, False)
+    del clumps
+    shadow_shapes = fmask.makeCloudShadowShapes(fmask_filenames, fmask_config, cloud_shape, cloud_clump_ndx)
+    result, shadow_mask = measure_stage("matchShadows", lambda: fmask.matchShadows(
+        fmask_config, intermediates["interimCloud"], intermediates["potentialShadows"], shadow_shapes,
+        cloud_base_temp, Tlow, Thigh, intermediates["pass1"]))
+    results.append(result)
+    for filename in [shadow_mask] + list(intermediates.values()):
+        fmask.deleteRaster(filename)
+
+    toa, thermal = synthetic_scene_arrays(args.size, args.cloud_fraction, args.seed)
+    nir = toa[fmask_config.bands[config.BAND_NIR]]
+    results.append(measure_stage("fillMinima", lambda: fillminima.fillMinima(
+        nir, 0, float(numpy.percentile(nir[nir != 0], 17.5))))[0])
+
+    clumps, _ = ndimage.label(nir > numpy.percentile(nir, 70), structure=numpy.ones((3, 3)))
+    results.append(measure_stage("ValueIndexes", lambda: valueindexes.ValueIndexes(clumps, nullVals=[0]))[0])
+    return results
+
+
+def benchmark_synthetic(args):
+    """Benchmark fmask on a synthetic scene, with the throughput of each stage
+    in megapixels per second, comparing with a baseline version or saved results
+    """
+    if args.libs_dir is not None:
+        # running the baseline, in its own process, results in the --save file
+        sys.path.insert(0, args.libs_dir)
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="fmask_benchmark_")
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        results = run_synthetic(args, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump({"size": args.size, "cloud_fraction": args.cloud_fraction, "seed": args.seed,
+                       "workers": args.workers, "results": results}, f, indent=1)
+    if args.libs_dir is not None:
+        return
+
+    baseline = None
+    if args.baseline_libs is not None:
+        fd, baseline_file = tempfile.mkstemp(prefix="fmask_baseline_", suffix=".json")
+        os.close(fd)
+        try:
+            subprocess.run([sys.executable, os.path.realpath(__file__), 'synthetic', '--size', str(args.size),
+                            '--cloud-fraction', str(args.cloud_fraction), '--seed', str(args.seed),
+                            '--workers', str(args.workers), '--save', baseline_file,
+                            '--libs-dir', os.path.abspath(args.baseline_libs)], check=True)
+            with open(baseline_file) as f:
+                baseline = json.load(f)
+        finally:
+            os.remove(baseline_file)
+    elif args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline["size"], baseline["seed"]) != (args.size, args.seed):
+            print("WARNING: the results to compare with are for a different scene (size {}, seed {})".format(
+                baseline["size"], baseline["seed"]))
+    baseline_times = {}
+    if baseline is not None:
+        baseline_times = {result["stage"]: result["seconds"] for result in baseline["results"]}
+
+    megapixels = args.size * args.size / 1e6
+    print("\nSynthetic scene: {0} x {0} pixels, {1:.0%} cloud, seed {2}, {3} workers\n".format(
+        args.size, args.cloud_fraction, args.seed, args.workers))
+    print("{:<22} {:>10} {:>10} {:>10} {:>10}".format("", "seconds", "MP/s", "peak MB",
+                                                      "speedup" if baseline is not None else ""))
+    for result in results:
+        peak = "{:.0f}".format(result["peak"] / 1e6) if result["peak"] is not None else "-"
+        speedup = ""
+        if baseline_times.get(result["stage"]):
+            speedup = "{:.2f}x".format(baseline_times[result["stage"]] / result["seconds"])
+        print("{:<22} {:>10.2f} {:>10.2f} {:>10} {:>10}".format(
+            result["stage"], result["seconds"], megapixels / result["seconds"], peak, speedup))
+
+
+WINDOWS_LAYOUTS = ('striped', 'tiled')
+
+
+def make_windows_image(filename, layout, size, tile_size):
+    """Write the TOA reflectance of a synthetic scene as a LZW compressed GeoTIFF,
+    in strips (as the Landsat products) or in tiles. Returns its native block size
+    """
+    toa, _ = synthetic_scene_arrays(size, 0.3, 0)
+    options = ['COMPRESS=LZW', 'INTERLEAVE=BAND']
+    if layout == 'tiled':
+        options += ['TILED=YES', 'BLOCKXSIZE={}'.format(tile_size), 'BLOCKYSIZE={}'.format(tile_size)]
+    ds = gdal.GetDriverByName('GTiff').Create(filename, size, size, toa.shape[0], gdal.GDT_Int16, options)
+    ds.SetGeoTransform((500000, 30, 0, 7000000, 0, -30))
+    for n in range(toa.shape[0]):
+        ds.GetRasterBand(n + 1).WriteArray(toa[n])
+    block_size = ds.GetRasterBand(1).GetBlockSize()
+    del ds
+    return block_size
+
+
+def read_with_rios(filename, window_size):
+    """Read all the blocks of the image with a RIOS ImageReader, returns the
+    window size it used
+    """
+    from rios import imagereader
+    reader = imagereader.ImageReader(filename, windowxsize=window_size, windowysize=window_size)
+    info = None
+    for info, block in reader:
+        pass
+    return info.getWindowSize()
+
+
+# Small images which "auto" reads in a single window, which is not a power of 2 in size
+AUTOWINDOW_WRITE_CASES = (('tiled', 300, 300), ('striped', 500, 30))
+
+
+def check_auto_window_writes(work_dir):
+    """Copy small striped and tiled images through a RIOS apply() with "auto" windows,
+    to a GTiff, and check that the copies are the same. Raises an error if not
+    """
+    from rios import applier
+
+    for layout, xsize, ysize in AUTOWINDOW_WRITE_CASES:
+        in_file = os.path.join(work_dir, "auto_write_{}_in.tif".format(layout))
+        out_file = os.path.join(work_dir, "auto_write_{}_out.tif".format(layout))
+        options = ['TILED=YES'] if layout == 'tiled' else []
+        ds = gdal.GetDriverByName('GTiff').Create(in_file, xsize, ysize, 1, gdal.GDT_Int16, options)
+        ds.SetGeoTransform((500000, 30, 0, 7000000, 0, -30))
+        image = numpy.arange(xsize * ysize, dtype=numpy.int16).reshape((ysize, xsize))
+        ds.GetRasterBand(1).WriteArray(image)
+        del ds
+
+        infiles = applier.FilenameAssociations()
+        infiles.image = in_file
+        outfiles = applier.FilenameAssociations()
+        outfiles.image = out_file
+        controls = applier.ApplierControls()
+        controls.setWindowXsize(applier.AUTOWINDOW)
+        controls.setWindowYsize(applier.AUTOWINDOW)
+        controls.setOutputDriverName('GTiff')
+        controls.setCalcStats(False)
+
+        def copy_block(info, inputs, outputs):
+            outputs.image = inputs.image
+
+        applier.apply(copy_block, infiles, outfiles, controls=controls)
+        ds = gdal.Open(out_file)
+        if not numpy.array_equal(ds.GetRasterBand(1).ReadAsArray(), image):
+            raise ValueError("auto window copy of the {} {}x{} image differs".format(layout, xsize, ysize))
+        print("auto window copy of the {} {}x{} image: same".format(layout, xsize, ysize))
+        del ds
+
+
+def benchmark_windows(args):
+    """Benchmark reading striped and tiled images with RIOS, with fixed window
+    sizes and with the windows aligned to the native blocks ("auto")
+    """
+    from rios import imagereader
+
+    if args.cache_mb is not None:
+        gdal.SetCacheMax(args.cache_mb * 1024 * 1024)
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="fmask_benchmark_")
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    megapixels = args.size * args.size / 1e6
+    try:
+        print()
+        check_auto_window_writes(work_dir)
+        print("\nImages: {0} x {0} pixels, 8 bands, Int16, LZW\n".format(args.size))
+        print("{:<10} {:>12} {:>16} {:>10} {:>10} {:>10}".format(
+            "layout", "native block", "window", "seconds", "MP/s", "speedup"))
+        for layout in WINDOWS_LAYOUTS:
+            filename = os.path.join(work_dir, "windows_" + layout + ".tif")
+            block_size = make_windows_image(filename, layout, args.size, args.tile_size)
+            first_time = None
+            for window_size in list(args.window_sizes) + [imagereader.AUTOWINDOW]:
+                window, seconds = best_time(lambda: read_with_rios(filename, window_size), args.repeat)
+                if first_time is None:
+                    first_time = seconds
+                print("{:<10} {:>12} {:>16} {:>10.2f} {:>10.2f} {:>10}".format(
+                    layout, "{}x{}".format(*block_size),
+                    "{}x{}".format(*window) + (" (auto)" if window_size == imagereader.AUTOWINDOW else ""),
+                    seconds, megapixels / seconds, "{:.2f}x".format(first_time / seconds)))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    script()
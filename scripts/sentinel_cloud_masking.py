@@ -14,15 +14,37 @@ from __future__ import unicode_literals
 
 import os, sys
 import argparse
-import shutil
+import glob
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-# add project dir to pythonpath
-from subprocess import call
+import numpy
 
+# add project dir to pythonpath
 libs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "libs")
 if libs_dir not in sys.path:
     sys.path.append(libs_dir)
 
+from osgeo import gdal
+from fmask import fmask, config, sen2meta
+
+# names of the tile metadata files to process
+TILE_METADATA_NAMES = ("metadata.xml", "MTD_TL.xml")
+# name of the product metadata file, with the scaling and offsets of the reflectance
+PRODUCT_METADATA_NAME = "MTD_MSIL1C.xml"
+# bands of the stack, in the order of fmask.config for FMASK_SENTINEL2
+STACK_BANDS = ("B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12")
+# band names of the product metadata (sen2meta) for the fmask bands
+FMASK_BAND_NAMES = {config.BAND_BLUE: "B02", config.BAND_GREEN: "B03", config.BAND_RED: "B04",
+                    config.BAND_NIR: "B08", config.BAND_SWIR1: "B11", config.BAND_SWIR2: "B12",
+                    config.BAND_CIRRUS: "B10", config.BAND_S2CDI_NIR8A: "B08A",
+                    config.BAND_S2CDI_NIR7: "B07", config.BAND_WATERVAPOUR: "B09"}
+# resolution in meters of the fmask process and of the final cloud mask
+FMASK_RESOLUTION = 20
+OUTPUT_RESOLUTION = 10
+# the angles image holds radians multiplied by this, as int16
+ANGLES_SCALE = 1000
+
 
 def script():
     """Run as a script with arguments
@@ -31,7 +53,15 @@ def script():
         prog='sentinel-cloud-masking',
         description='Compute and generate the cloud mask (fmask) for all Sentinel input')
 
-    parser.add_argument('inputs', type=str, help='directories or MTL files to process', nargs='*')
+    parser.add_argument('--cloud-prob-thresh', type=float, default=0.2, required=False)
+    parser.add_argument('--cloud-buffer-distance', type=float, default=150, required=False,
+                        help='distance in meters to buffer the clouds (default: 150)')
+    parser.add_argument('--shadow-buffer-distance', type=float, default=300, required=False,
+                        help='distance in meters to buffer the cloud shadows (default: 300)')
+    parser.add_argument('--jobs', type=int, default=1, required=False,
+                        help='number of tiles to process in parallel (default: 1)')
+
+    parser.add_argument('inputs', type=str, help='directories or tile metadata files to process', nargs='*')
 
     args = parser.parse_args()
 
@@ -40,36 +70,185 @@ def script():
     metadata_files = []
     for _input in args.inputs:
         if os.path.isfile(_input):
-            if _input == "metadata.xml":
+            if os.path.basename(_input) in TILE_METADATA_NAMES:
                 metadata_files.append(os.path.abspath(_input))
         elif os.path.isdir(_input):
             for root, dirs, files in os.walk(_input):
                 if len(files) != 0:
-                    files = [os.path.join(root, x) for x in files if x == "metadata.xml"]
+                    files = [os.path.join(root, x) for x in files if x in TILE_METADATA_NAMES]
                     [metadata_files.append(os.path.abspath(file)) for file in files]
     print("{} Sentinel to process\n".format(len(metadata_files)))
 
-    for metadata_file in metadata_files:
-
-        process_dir = os.path.dirname(metadata_file)
-        print("PROCESSING: " + os.path.basename(process_dir))
-
-        call("gdalbuildvrt -resolution user -tr 20 20 -separate allbands.vrt B0[1-8].jp2 B8A.jp2 B09.jp2 B1[0-2].jp2",
-             shell=True, cwd=process_dir)
-
-        call("export PYTHONPATH='{}' && ".format(libs_dir) + "python3 " + libs_dir+"/fmask/bin/fmask_sentinel2makeAnglesImage.py " + "-i metadata.xml -o angles.img",
-             shell=True, cwd=process_dir)
-
-        call("export PYTHONPATH='{}' && ".format(libs_dir) + "python3 " + libs_dir+"/fmask/bin/fmask_sentinel2Stacked.py " + "-a allbands.vrt -z angles.img -o cloud20x20.img",
-             shell=True, cwd=process_dir)
-
-        call("gdal_translate -tr 10 10 cloud20x20.img cloud10x10.img", shell=True, cwd=process_dir)
+    fmask_args = (args.cloud_prob_thresh, args.cloud_buffer_distance, args.shadow_buffer_distance)
+
+    results = []
+    jobs = max(1, min(args.jobs, len(metadata_files)))
+    if jobs == 1:
+        for metadata_file in metadata_files:
+            results.append(process_tile(metadata_file, *fmask_args))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(process_tile, metadata_file, *fmask_args): metadata_file
+                       for metadata_file in metadata_files}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    # the worker process died (e.g. killed by out of memory)
+                    results.append({"tile": os.path.dirname(futures[future]), "success": False,
+                                    "error": traceback.format_exc()})
+
+    ### summary of the processing
+    failed = [result for result in results if not result["success"]]
+    print("\nSUMMARY: {} tiles processed, {} succeeded, {} failed".format(
+        len(results), len(results) - len(failed), len(failed)))
+    for result in failed:
+        print("\nFAILED: {}\n{}".format(result["tile"], result["error"]))
+
+    if failed:
+        sys.exit(1)
+
+
+def process_tile(metadata_file, cloud_prob_thresh=0.2, cloud_buffer_distance=150, shadow_buffer_distance=300):
+    """Make the cloud mask of one tile, all in this process: the stack of the
+    bands and the angles image are made in memory (/vsimem), fmask makes the
+    cloud mask at 20m (cloud20x20.img) and the 10m mask (cloud10x10.vrt) is
+    a virtual raster over it, not a copy.
+
+    Returns a dict with the tile dir, the success and the error traceback (if
+    any), catching any error so that one bad tile does not stop the rest.
+    """
+    process_dir = os.path.dirname(metadata_file)
+    tile = os.path.basename(process_dir)
+    print("PROCESSING: " + tile)
+    # in memory files of this tile, tiles run in their own processes
+    stack_file = "/vsimem/sentinel_cloud_masking/{}/allbands.vrt".format(tile)
+    angles_file = "/vsimem/sentinel_cloud_masking/{}/angles.tif".format(tile)
+    angles_vrt_file = "/vsimem/sentinel_cloud_masking/{}/angles.vrt".format(tile)
+    cloud_20m_file = os.path.join(process_dir, "cloud20x20.img")
+
+    try:
+        tile_meta = sen2meta.Sen2TileMeta(filename=metadata_file)
+        make_stack_vrt(stack_file, [find_band_file(process_dir, band) for band in STACK_BANDS])
+        make_angles_image(angles_file, tile_meta)
+        resample_to(angles_vrt_file, angles_file, stack_file, "bilinear")
+
+        fmask_filenames = config.FmaskFilenames()
+        fmask_filenames.setTOAReflectanceFile(stack_file)
+        fmask_filenames.setOutputCloudMaskFile(cloud_20m_file)
+
+        angles_info = config.AnglesFileInfo(angles_vrt_file, 3, angles_vrt_file, 2,
+                                            angles_vrt_file, 1, angles_vrt_file, 0)
+        angles_info.setScaleToRadians(1.0 / ANGLES_SCALE)
+
+        fmask_config = config.FmaskConfig(config.FMASK_SENTINEL2)
+        fmask_config.setAnglesInfo(angles_info)
+        fmask_config.setTempDir(process_dir)
+        scaling, offsets = reflectance_scaling(process_dir)
+        fmask_config.setTOARefScaling(scaling)
+        fmask_config.setTOARefOffsetDict(offsets)
+        fmask_config.setEqn17CloudProbThresh(cloud_prob_thresh)
+        fmask_config.setCloudBufferSize(int(cloud_buffer_distance / FMASK_RESOLUTION))
+        fmask_config.setShadowBufferSize(int(shadow_buffer_distance / FMASK_RESOLUTION))
+
+        fmask.doFmask(fmask_filenames, fmask_config)
+
+        # the 10m mask reads the 20m mask, nearest neighbour
+        vrt_options = gdal.BuildVRTOptions(resolution="user", xRes=OUTPUT_RESOLUTION, yRes=OUTPUT_RESOLUTION)
+        ds = gdal.BuildVRT(os.path.join(process_dir, "cloud10x10.vrt"), [cloud_20m_file], options=vrt_options)
+        ds.FlushCache()
+        del ds
+    except Exception:
+        print("ERROR: " + tile)
+        return {"tile": process_dir, "success": False, "error": traceback.format_exc()}
+    finally:
+        for filename in (stack_file, angles_file, angles_vrt_file):
+            if gdal.VSIStatL(filename) is not None:
+                gdal.Unlink(filename)
+
+    ### ending fmask process
+    print("DONE: " + tile)
+    return {"tile": process_dir, "success": True, "error": None}
+
+
+def find_band_file(process_dir, band):
+    """Return the jp2 file of the band in the tile dir, named as the band (B01.jp2)
+    or as in the SAFE format (IMG_DATA/<tile>_<date>_B01.jp2)
+    """
+    for pattern in (band + ".jp2", "*_" + band + ".jp2", os.path.join("IMG_DATA", "*_" + band + ".jp2")):
+        band_files = glob.glob(os.path.join(process_dir, pattern))
+        if band_files:
+            return band_files[0]
+    raise IOError("Cannot find the band {} in {}".format(band, process_dir))
 
-        os.remove(os.path.join(process_dir, "allbands.vrt"))
-        os.remove(os.path.join(process_dir, "angles.img"))
 
-        ### ending fmask process
-        print("DONE\n")
+def make_stack_vrt(stack_file, band_files):
+    """Stack the band files, one band per file, in a virtual raster at the
+    resolution of fmask
+    """
+    vrt_options = gdal.BuildVRTOptions(separate=True, resolution="user", xRes=FMASK_RESOLUTION,
+                                       yRes=FMASK_RESOLUTION)
+    ds = gdal.BuildVRT(stack_file, band_files, options=vrt_options)
+    ds.FlushCache()
+    del ds
+
+
+def make_angles_image(angles_file, tile_meta):
+    """Make the image of the angles grid of the tile metadata (sen2meta.Sen2TileMeta),
+    with the bands: satellite azimuth, satellite zenith, sun azimuth and sun zenith,
+    in radians multiplied by ANGLES_SCALE. The view angles are the average of the
+    angles of all the bands, the cells without them (outside of the swath) get the
+    average of the tile
+    """
+    view_azimuth = numpy.nanmean(numpy.array(list(tile_meta.viewAzimuthDict.values())), axis=0)
+    view_zenith = numpy.nanmean(numpy.array(list(tile_meta.viewZenithDict.values())), axis=0)
+    angles = numpy.array([view_azimuth, view_zenith, tile_meta.sunAzimuthGrid, tile_meta.sunZenithGrid])
+    for band in angles:
+        band[numpy.isnan(band)] = numpy.nanmean(band)
+    angles = numpy.round(numpy.radians(angles) * ANGLES_SCALE).astype(numpy.int16)
+
+    (nrows, ncols) = tile_meta.anglesGridShape
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(angles_file, ncols, nrows, 4, gdal.GDT_Int16)
+    (ulx, uly) = tile_meta.anglesULXY
+    ds.SetGeoTransform((ulx, tile_meta.angleGridXres, 0, uly, 0, -tile_meta.angleGridYres))
+    ds.SetProjection("EPSG:" + tile_meta.epsg)
+    for n in range(4):
+        ds.GetRasterBand(n + 1).WriteArray(angles[n])
+    ds.FlushCache()
+    del ds
+
+
+def resample_to(dst_file, src_file, like_file, resample_alg):
+    """Resample the src file to the pixel grid of the like file, as a virtual
+    raster, fmask needs the angles in the same grid as the reflectance
+    """
+    ds = gdal.Open(like_file)
+    (ulx, xres, _, uly, _, yres) = ds.GetGeoTransform()
+    bounds = (ulx, uly + yres * ds.RasterYSize, ulx + xres * ds.RasterXSize, uly)
+    del ds
+    warp_options = gdal.WarpOptions(format="VRT", outputBounds=bounds, xRes=xres, yRes=abs(yres),
+                                    resampleAlg=resample_alg)
+    ds = gdal.Warp(dst_file, src_file, options=warp_options)
+    ds.FlushCache()
+    del ds
+
+
+def reflectance_scaling(process_dir):
+    """Return the scaling and the offsets (dict of fmask bands) of the reflectance
+    of the tile, from the product metadata (MTD_MSIL1C.xml) in the tile dir or
+    above it (as in the SAFE format). Without it, the scaling is 10000 with no
+    offsets, as in the products before the processing baseline 04.00
+    """
+    for up_dir in (".", "..", os.path.join("..", "..")):
+        product_metadata_file = os.path.normpath(os.path.join(process_dir, up_dir, PRODUCT_METADATA_NAME))
+        if os.path.isfile(product_metadata_file):
+            product_meta = sen2meta.Sen2ZipfileMeta(xmlfilename=product_metadata_file)
+            offsets = {band: product_meta.offsetValDict[name] for band, name in FMASK_BAND_NAMES.items()}
+            return product_meta.scaleVal, offsets
+    print("WARNING: {} not found for {}, assuming no reflectance offsets".format(
+        PRODUCT_METADATA_NAME, os.path.basename(process_dir)))
+    return 10000.0, {band: 0 for band in FMASK_BAND_NAMES}
 
 
 if __name__ == '__main__':